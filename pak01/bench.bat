@@ -0,0 +1,2 @@
+python bench.py
+pause
\ No newline at end of file
@@ -0,0 +1,421 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+import traceback
+import importlib.util
+import multiprocessing
+
+# Benchmarks for the build/ship pipeline on a synthetic pak01. Everything is generated
+# from a seed, so two runs with the same settings work on identical inputs.
+#
+# Each benchmark runs in its own process, so its peak RSS isn't mixed up with the others
+# (or with the generator), and the working directory changes vpk.py needs stay contained.
+
+BENCH_VERSION = 1
+HERE = os.path.dirname(os.path.abspath(__file__))
+SPLIT_DIR = os.path.join(HERE, "cc-game")
+SMD_DIR = os.path.join(HERE, "other", "models_compile")
+
+# (folder, sub folders, extension, share of the files, relative file size)
+TREE_SHAPE = [
+    ("materials", ["models/weapons", "models/player", "decals", "overlays"], ".vmt", 0.28, 0.02),
+    ("materials", ["models/weapons", "models/player", "decals", "overlays"], ".vtf", 0.28, 1.0),
+    ("models", ["weapons", "player", "props"], ".mdl", 0.06, 0.4),
+    ("models", ["weapons", "player", "props"], ".vvd", 0.06, 0.6),
+    ("models", ["weapons", "player", "props"], ".vtx", 0.06, 0.3),
+    ("models", ["weapons", "player", "props"], ".phy", 0.03, 0.1),
+    ("sound", ["weapons", "music", "ui"], ".wav", 0.10, 2.0),
+    ("particles", [""], ".pcf", 0.03, 0.3),
+    ("scripts", ["", "items"], ".txt", 0.05, 0.05),
+    ("resource", ["", "flash"], ".res", 0.05, 0.02),
+]
+TEXT_EXTENSIONS = (".vmt", ".txt", ".res")
+WORDS = ("weapon ak47 m4a1 awp knife glove sticker paint kit rarity legendary ancient "
+         "common $basetexture $bumpmap $phong $envmap models player ct t ui hud").split()
+
+DEFAULT_CONFIG = {
+    "seed": 1,
+    "files": 2000,
+    "tree_mb": 64,
+    "vpk_chunk_mb": 16,
+    "codec": "lzma2",
+    "level": 6,
+    "threads": 2,
+    "policy": "auto",
+    "kv_entries": 50000,
+    "split_mb": 256,
+    "split_chunk_mb": 32,
+    "smd_frames": 2000,
+    "smd_triangles": 20000,
+}
+
+def text_blob(rng, size):
+    out = []
+    length = 0
+    while length < size:
+        line = f'"{rng.choice(WORDS)}" "{rng.choice(WORDS)}/{rng.choice(WORDS)}_{rng.randrange(1000)}"\n'
+        out.append(line)
+        length += len(line)
+    return "".join(out).encode()[:size]
+
+def binary_pool(rng, size):
+    # Roughly how VPK contents compress: DXT texture data barely shrinks, headers and vertex data do
+    half = size // 2
+    repeated = bytes(rng.randrange(64) for _ in range(4096)) * (half // 4096 + 1)
+    return rng.randbytes(half) + repeated[:size - half]
+
+def generate_tree(root, config):
+    """Write the synthetic pak01 folder, returns (file count, total bytes)."""
+    rng = random.Random(config["seed"])
+    pool = binary_pool(rng, 8 * 1024 * 1024)
+    total_weight = sum(share * size for _, _, _, share, size in TREE_SHAPE)
+    mean = config["tree_mb"] * 1024 * 1024 / (config["files"] * total_weight)
+
+    files = 0
+    total = 0
+    for folder, sub_folders, ext, share, size in TREE_SHAPE:
+        for i in range(max(1, round(config["files"] * share))):
+            rel_dir = os.path.join(folder, rng.choice(sub_folders), f"set{i % 16:02d}")
+            os.makedirs(os.path.join(root, rel_dir), exist_ok=True)
+            length = max(16, int(mean * size * rng.uniform(0.5, 1.5)))
+            if ext in TEXT_EXTENSIONS:
+                data = text_blob(rng, length)
+            else:
+                start = rng.randrange(len(pool) - min(length, len(pool)) + 1)
+                data = (f"{rel_dir}/{i}".encode() + pool[start:start + length])[:length]
+            with open(os.path.join(root, rel_dir, f"asset_{i:05d}{ext}"), "wb") as f:
+                f.write(data)
+            files += 1
+            total += len(data)
+    return files, total
+
+def generate_localization(path, config, variant):
+    """A csgo_english style file, variant 1 has some tokens changed, removed and added."""
+    rng = random.Random(config["seed"] + 100)
+    entries = config["kv_entries"]
+    lines = ['"lang"', "{", '\t"Language"\t\t"english"', '\t"Tokens"', "\t{"]
+    for i in range(entries):
+        roll = rng.random()
+        if variant and roll < 0.01:
+            continue
+        value = " ".join(rng.choice(WORDS) for _ in range(rng.randrange(3, 12)))
+        if variant and roll < 0.06:
+            value += " (updated)"
+        lines.append(f'\t\t"Token_{i:06d}"\t\t"{value}"')
+    if variant:
+        lines += [f'\t\t"NewToken_{i:05d}"\t\t"{rng.choice(WORDS)}"' for i in range(entries // 100)]
+    lines += ["\t}", "}", ""]
+    with open(path, "w", encoding="utf-16", newline="\r\n") as f:
+        f.write("\n".join(lines))
+
+def generate_smd(path, config):
+    """An animated SMD with a small bone hierarchy, plus a reference mesh."""
+    rng = random.Random(config["seed"] + 200)
+    bones = 24
+    with open(path, "w") as f:
+        f.write("version 1\nnodes\n")
+        f.write('  0 "root" -1\n')
+        for b in range(1, bones):
+            f.write(f'  {b} "bone{b}" {rng.randrange(b)}\n')
+        f.write("end\nskeleton\n")
+        for frame in range(config["smd_frames"]):
+            f.write(f"  time {frame}\n")
+            for b in range(bones):
+                values = " ".join(f"{rng.uniform(-10, 10):.6f}" for _ in range(3))
+                angles = " ".join(f"{rng.uniform(-3, 3):.6f}" for _ in range(3))
+                f.write(f"    {b} {values} {angles}\n")
+        f.write("end\ntriangles\n")
+        for _ in range(config["smd_triangles"]):
+            f.write("material\n")
+            for _ in range(3):
+                values = " ".join(f"{rng.uniform(-10, 10):.6f}" for _ in range(6))
+                f.write(f"  {rng.randrange(bones)} {values} {rng.random():.6f} {rng.random():.6f} 1 0 1.000000\n")
+        f.write("end\n")
+
+def generate_split_file(path, config):
+    rng = random.Random(config["seed"] + 300)
+    pool = binary_pool(rng, 4 * 1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(config["split_mb"] // 4):
+            f.write(pool)
+
+def prepare(work, config):
+    """Generate the inputs once per work folder, a config change starts over."""
+    stamp = os.path.join(work, "inputs.json")
+    if os.path.exists(stamp):
+        with open(stamp, "r") as f:
+            inputs = json.load(f)
+        if inputs["config"] == config:
+            return inputs
+        shutil.rmtree(work)
+    os.makedirs(work, exist_ok=True)
+
+    print(f"Generating inputs in {work}...")
+    start = time.perf_counter()
+    files, total = generate_tree(os.path.join(work, "pak01"), config)
+    generate_localization(os.path.join(work, "english_old.txt"), config, 0)
+    generate_localization(os.path.join(work, "english_new.txt"), config, 1)
+    generate_smd(os.path.join(work, "anim.smd"), config)
+    os.makedirs(os.path.join(work, "split"), exist_ok=True)
+    generate_split_file(os.path.join(work, "split", "game.7z"), config)
+
+    inputs = {"config": config, "tree_files": files, "tree_bytes": total}
+    with open(stamp, "w") as f:
+        json.dump(inputs, f, indent=2)
+    print(f"Generated {files} files ({total / 1024 / 1024:.1f} MB) and the other inputs "
+          f"in {time.perf_counter() - start:.1f}s")
+    return inputs
+
+def vpk_files(directory):
+    return sorted(f for f in os.listdir(directory) if f.endswith(".vpk"))
+
+def folder_size(directory, names):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+
+def clean(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+# Every benchmark sets up what it needs, times only the call being measured
+# and returns (seconds, files, bytes).
+
+def bench_process_folders(work, config, inputs):
+    import vpk
+    os.chdir(work)
+    clean(["pak01.kv.txt", "pak01.hashcache.json"])
+    processor = vpk.AssetProcessor("pak01", rehash_all=True)
+    start = time.perf_counter()
+    processor.create_kv_file()
+    processor.process_folders()
+    return time.perf_counter() - start, inputs["tree_files"], inputs["tree_bytes"]
+
+def bench_pack_native(work, config, inputs):
+    import vpk
+    os.chdir(work)
+    if not os.path.exists("pak01.kv.txt"):
+        bench_process_folders(work, config, inputs)
+    clean(vpk_files(work) + ["pak01.kv.txt.bak"])
+    processor = vpk.AssetProcessor("pak01", chunk_size=str(config["vpk_chunk_mb"]), layout="full")
+    start = time.perf_counter()
+    if not processor.pack_native():
+        raise RuntimeError("Packing failed")
+    return time.perf_counter() - start, inputs["tree_files"], inputs["tree_bytes"]
+
+def bench_process_vpk_files(work, config, inputs):
+    import vpk_compress
+    if not vpk_files(work):
+        bench_pack_native(work, config, inputs)
+    dest_dir = os.path.join(work, "compressed")
+    clean([dest_dir])
+    options = {"codec": config["codec"], "level": config["level"], "threads": config["threads"],
+               "policy": config["policy"], "split": True, "volume_size": 95 * 1024 * 1024}
+    names = vpk_files(work)
+    start = time.perf_counter()
+    vpk_compress.process_vpk_files(work, dest_dir, options)
+    return time.perf_counter() - start, len(names), folder_size(work, names)
+
+def bench_process_7z_files(work, config, inputs):
+    import release_manifest
+    import vpk_decompress
+    compressed = os.path.join(work, "compressed")
+    if not os.path.exists(os.path.join(compressed, release_manifest.MANIFEST_NAME)):
+        bench_process_vpk_files(work, config, inputs)
+    extract_dir = os.path.join(work, "extracted")
+    clean([extract_dir])
+    shutil.copytree(compressed, extract_dir)
+    start = time.perf_counter()
+    vpk_decompress.process_7z_files(extract_dir)
+    elapsed = time.perf_counter() - start
+    names = vpk_files(extract_dir)
+    return elapsed, len(names), folder_size(extract_dir, names)
+
+def bench_compare_files(work, config, inputs):
+    import diff
+    old_path = os.path.join(work, "english_old.txt")
+    new_path = os.path.join(work, "english_new.txt")
+    start = time.perf_counter()
+    diff.compare_files(old_path, new_path, os.path.join(work, "english_diff.txt"))
+    return time.perf_counter() - start, 2, os.path.getsize(old_path) + os.path.getsize(new_path)
+
+def bench_split_file(work, config, inputs):
+    sys.path.insert(0, SPLIT_DIR)
+    import split
+    path = os.path.join(work, "split", "game.7z")
+    # A fresh split every time, resuming would skip the work being measured
+    clean([os.path.join(work, "split", "game_chunks")])
+    start = time.perf_counter()
+    split.split_file(path, config["split_chunk_mb"])
+    return time.perf_counter() - start, 1, os.path.getsize(path)
+
+def bench_modify_smd(work, config, inputs):
+    sys.path.insert(0, SMD_DIR)
+    import scale
+    path = os.path.join(work, "anim.smd")
+    start = time.perf_counter()
+    scale.modify_smd(path, os.path.join(work, "anim_scaled.smd"), 0.35, 3, 15)
+    return time.perf_counter() - start, 1, os.path.getsize(path)
+
+# name -> (function, modules that must already be installed)
+# The tools install missing packages with pip on import, which can't happen offline
+BENCHMARKS = {
+    "process_folders": (bench_process_folders, []),
+    "pack_native": (bench_pack_native, []),
+    "process_vpk_files": (bench_process_vpk_files, ["py7zr"]),
+    "process_7z_files": (bench_process_7z_files, ["py7zr"]),
+    "compare_files": (bench_compare_files, []),
+    "split_file": (bench_split_file, []),
+    "modify_smd": (bench_modify_smd, ["numpy"]),  # smd.py transforms with numpy
+}
+
+def peak_rss_mb():
+    """Peak RSS of this process and of the largest process it started, None where it can't be read."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(max(own, children) / scale, 1)
+
+def run_child(name, work, config, inputs, queue, verbose):
+    if not verbose:
+        # On the file descriptor, so the tools' own worker processes are quiet too
+        os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    sys.path.insert(0, HERE)
+    try:
+        seconds, files, size = BENCHMARKS[name][0](work, config, inputs)
+        queue.put({"seconds": seconds, "files": files, "bytes": size, "peak_rss_mb": peak_rss_mb()})
+    except Exception:
+        queue.put({"error": traceback.format_exc()})
+
+def run_benchmark(name, work, config, inputs, verbose):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=run_child, args=(name, work, config, inputs, queue, verbose))
+    process.start()
+    process.join()
+    if queue.empty():
+        return {"error": f"benchmark process exited with code {process.exitcode}"}
+    return queue.get()
+
+def run_suite(names, work, config, repeat, verbose):
+    inputs = prepare(work, config)
+    results = {}
+    for name in names:
+        missing = [m for m in BENCHMARKS[name][1] if importlib.util.find_spec(m) is None]
+        if missing:
+            print(f"{name:<20} skipped, needs {', '.join(missing)}")
+            results[name] = {"skipped": f"needs {', '.join(missing)}"}
+            continue
+
+        # Best of repeat runs, the slower ones are mostly noise from other processes
+        best = None
+        for _ in range(repeat):
+            result = run_benchmark(name, work, config, inputs, verbose)
+            if "error" in result:
+                best = result
+                break
+            if best is None or result["seconds"] < best["seconds"]:
+                peak = max(result["peak_rss_mb"] or 0, (best or {}).get("peak_rss_mb") or 0) or None
+                best = dict(result, peak_rss_mb=peak)
+        if "error" in best:
+            print(f"{name:<20} FAILED\n{best['error']}")
+            results[name] = best
+            continue
+
+        seconds = max(best["seconds"], 1e-9)
+        best["files_per_s"] = round(best["files"] / seconds, 1)
+        best["mb_per_s"] = round(best["bytes"] / 1024 / 1024 / seconds, 1)
+        best["seconds"] = round(best["seconds"], 4)
+        results[name] = best
+        rss = f"{best['peak_rss_mb']:.0f} MB" if best["peak_rss_mb"] is not None else "n/a"
+        print(f"{name:<20} {best['seconds']:>8.2f}s {best['files_per_s']:>10.1f} files/s "
+              f"{best['mb_per_s']:>8.1f} MB/s   peak RSS {rss}")
+    return results
+
+def compare_results(results, baseline, threshold):
+    """Print the change against a baseline run, returns the names that got slower or bigger than threshold."""
+    if baseline.get("config") != results["config"]:
+        print("Warning: the baseline was run with different settings, the numbers may not be comparable")
+    regressions = []
+    print(f"\nCompared to {baseline.get('created', 'baseline')} (threshold {threshold:.0%}):")
+    for name, result in results["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old or "seconds" not in old or "seconds" not in result:
+            continue
+        time_change = result["seconds"] / max(old["seconds"], 1e-9) - 1
+        line = f"  {name:<20} time {time_change:+.1%}"
+        regressed = time_change > threshold
+        if result.get("peak_rss_mb") and old.get("peak_rss_mb"):
+            rss_change = result["peak_rss_mb"] / old["peak_rss_mb"] - 1
+            line += f", peak RSS {rss_change:+.1%}"
+            regressed = regressed or rss_change > threshold
+        if regressed:
+            regressions.append(name)
+            line += "  REGRESSION"
+        print(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pak01 build/ship tools on generated inputs (works offline)')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help=f'Benchmarks to run: {", ".join(BENCHMARKS)} (default: all)')
+    parser.add_argument('--output', default='bench_results.json', help='Results file (default: bench_results.json)')
+    parser.add_argument('--baseline', help='Results file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='Slowdown or peak RSS growth counted as a regression (default: 0.15 = 15%%)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per benchmark, the fastest one counts (default: 1)')
+    parser.add_argument('--workdir', help='Keep the generated inputs here and reuse them next time '
+                                          '(default: a temp folder removed afterwards)')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the tools being measured')
+    for key, value in DEFAULT_CONFIG.items():
+        parser.add_argument(f'--{key.replace("_", "-")}', type=type(value), default=value,
+                            help=f'(default: {value})')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark {', '.join(unknown)}")
+
+    config = {key: getattr(args, key) for key in DEFAULT_CONFIG}
+    names = args.benchmarks or list(BENCHMARKS)
+    work = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="pak01_bench_")
+    try:
+        results = {
+            "version": BENCH_VERSION,
+            "created": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                        "cpu_count": os.cpu_count()},
+            "config": config,
+            "results": run_suite(names, work, config, max(1, args.repeat), args.verbose),
+        }
+    finally:
+        if not args.workdir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    failed = [name for name, result in results["results"].items() if "error" in result]
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare_results(results, json.load(f), args.threshold)
+    if failed or regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
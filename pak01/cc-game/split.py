@@ -1,42 +1,174 @@
 import os
-import subprocess
-import hashlib
+import sys
+import json
+import argparse
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def split_file(file_path, chunk_size_mb=485):
+# hashing.py lives one folder up with the rest of the pak01 tools
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import hashing
+
+# The launcher reads this manifest to know which chunks to download and what their hashes are:
+# {"version", "file", "size", "md5", "chunk_size", "complete", "chunks": [{"name", "offset", "size", "md5"}]}
+# "complete" stays false until every chunk and the whole file hash are in.
+MANIFEST_VERSION = 1
+DEFAULT_CHUNK_SIZE_MB = 485
+
+def chunk_name(file_path, chunk_num):
+    return f"{os.path.basename(file_path)}.{chunk_num:03d}"
+
+def manifest_path(output_dir, file_path):
+    return os.path.join(output_dir, f"{os.path.basename(file_path)}.manifest.json")
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+        print(f"Ignoring {path} with unknown version {manifest.get('version')}")
+    except Exception as e:
+        print(f"Error reading {path}: {e}")
+    return None
+
+def save_manifest(path, manifest):
+    # Written to a temp file and swapped in, so the launcher never sees a half written manifest
+    manifest["created"] = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+def write_chunk(file_path, output_path, offset, size):
+    """Write one chunk through a .part file, returns the md5 of the bytes copied into it."""
+    part_path = output_path + ".part"
+    try:
+        # Hashed on the way through a small buffer, so a chunk is read once and never held whole
+        with open(file_path, "rb") as src, open(part_path, "wb") as dst:
+            src.seek(offset)
+            copied, chunk_md5 = hashing.copy_and_hash(src, dst, size, "md5")
+        if copied != size:
+            raise IOError(f"Copied {copied} of {size} bytes, did {file_path} change?")
+        os.replace(part_path, output_path)
+        return chunk_md5
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+def reusable_chunks(old, file_path, size, mtime_ns, chunk_size, output_dir, verify, workers):
+    """{chunk name: md5} of chunks left by an earlier run of the same file that can be kept."""
+    if not old or old.get("size") != size or old.get("mtime_ns") != mtime_ns or old.get("chunk_size") != chunk_size:
+        return {}
+    existing = [c for c in old["chunks"]
+                if os.path.exists(os.path.join(output_dir, c["name"]))
+                and os.path.getsize(os.path.join(output_dir, c["name"])) == c["size"]]
+    if verify and existing:
+        print(f"Verifying {len(existing)} existing chunks...")
+        hashes = hashing.hash_files([os.path.join(output_dir, c["name"]) for c in existing], "md5", workers=workers)
+        existing = [c for c, h in zip(existing, hashes) if h == c["md5"]]
+    return {c["name"]: c["md5"] for c in existing}
+
+def remove_stale_chunks(output_dir, file_path, chunk_count):
+    chunk_num = chunk_count + 1
+    while os.path.exists(os.path.join(output_dir, chunk_name(file_path, chunk_num))):
+        os.remove(os.path.join(output_dir, chunk_name(file_path, chunk_num)))
+        chunk_num += 1
+
+def split_file(file_path, chunk_size_mb=DEFAULT_CHUNK_SIZE_MB, workers=None, verify=False):
     # Convert chunk size to bytes
     chunk_size = chunk_size_mb * 1024 * 1024
-   
+
     # Create output directory
     base_name = os.path.splitext(file_path)[0]
     output_dir = f"{base_name}_chunks"
     os.makedirs(output_dir, exist_ok=True)
-   
-    # Read and split the file
-    with open(file_path, 'rb') as f:
-        chunk_num = 1
-        while True:
-            chunk = f.read(chunk_size)
-            if not chunk:
-                break
-           
-            output_path = os.path.join(output_dir, f"{os.path.basename(file_path)}.{chunk_num:03d}")
-            
-            # Calculate MD5 hash
-            chunk_hash = hashlib.md5(chunk).hexdigest()
-            
-            # Write chunk to file
-            with open(output_path, 'wb') as chunk_file:
-                chunk_file.write(chunk)
-            
-            # Print chunk filename and its hash
-            print(f"Chunk: {os.path.basename(output_path)}")
-            print(f"MD5:   {chunk_hash}")
-            print("-" * 70)
-            
-            chunk_num += 1
-   
-    print(f"\nSplit complete! Created {chunk_num-1} chunks in '{output_dir}'")
+
+    stat = os.stat(file_path)
+    chunk_count = max(1, -(-stat.st_size // chunk_size))
+    if workers is None:
+        workers = min(4, os.cpu_count() or 1)
+
+    path = manifest_path(output_dir, file_path)
+    old = load_manifest(path)
+    reuse = reusable_chunks(old, file_path, stat.st_size, stat.st_mtime_ns, chunk_size, output_dir, verify, workers)
+    file_md5 = old.get("md5") if reuse and old.get("complete") else None
+
+    chunks = []
+    for i in range(chunk_count):
+        offset = i * chunk_size
+        name = chunk_name(file_path, i + 1)
+        chunks.append({"name": name, "offset": offset, "size": min(chunk_size, stat.st_size - offset),
+                       "md5": reuse.get(name)})
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "file": os.path.basename(file_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "md5": file_md5,
+        "chunk_size": chunk_size,
+        "complete": False,
+        "chunks": chunks,
+    }
+    todo = [c for c in chunks if c["md5"] is None]
+    if reuse:
+        print(f"Keeping {chunk_count - len(todo)} of {chunk_count} chunks from the last run")
+
+    # The manifest is saved after every chunk so an interrupted split picks up where it stopped
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers + 1) as executor:
+        # The whole file hash runs next to the chunk writers, its reads mostly come from the page cache
+        file_hash = executor.submit(hashing.hash_file, file_path, "md5") if file_md5 is None else None
+        futures = {executor.submit(write_chunk, file_path, os.path.join(output_dir, c["name"]), c["offset"], c["size"]): c
+                   for c in todo}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                chunk["md5"] = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Error writing {chunk['name']}: {e}")
+                continue
+            save_manifest(path, manifest)
+        if file_hash is not None:
+            manifest["md5"] = file_hash.result()
+
+    remove_stale_chunks(output_dir, file_path, chunk_count)
+
+    # Print chunk filenames and their hashes
+    for chunk in chunks:
+        print(f"Chunk: {chunk['name']}")
+        print(f"MD5:   {chunk['md5'] or 'FAILED'}")
+        print("-" * 70)
+    print(f"File:  {os.path.basename(file_path)}")
+    print(f"MD5:   {manifest['md5']}")
+
+    manifest["complete"] = not failed
+    save_manifest(path, manifest)
+    if failed:
+        print(f"\n{failed} chunks failed, run again to retry them")
+        return False
+    print(f"\nSplit complete! {len(todo)} chunks written, {chunk_count - len(todo)} kept, in '{output_dir}'")
+    print(f"Manifest: {path}")
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description='Split a file into chunks for upload, with a JSON manifest of their hashes')
+    parser.add_argument('file_path', nargs='?', help='File to split (asked for if not given)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE_MB,
+                        help=f'Chunk size in MB (default: {DEFAULT_CHUNK_SIZE_MB})')
+    parser.add_argument('--workers', type=int, default=None, help='Chunks written at once (default: up to 4)')
+    parser.add_argument('--verify', action='store_true',
+                        help='Rehash chunks kept from the last run instead of trusting their size')
+    args = parser.parse_args()
+
+    file_path = args.file_path or input("Enter the path to your .7z archive: ")
+    if not split_file(file_path, args.chunk_size, args.workers, args.verify):
+        sys.exit(1)
 
 if __name__ == "__main__":
-    file_path = input("Enter the path to your .7z archive: ")
-    split_file(file_path)
\ No newline at end of file
+    main()
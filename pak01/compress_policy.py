@@ -0,0 +1,165 @@
+import os
+import lzma
+import re
+
+import sevenzip
+import vpk_file
+
+# Picks how vpk_compress compresses each VPK instead of running LZMA2 preset 9 over all of them.
+#
+# What's in a chunk (bytes per file extension) comes from the entries the packer just wrote into
+# it, or from the finished _dir.vpk next to it when vpk_compress runs on its own. How well it
+# compresses comes from compressing a few samples spread over the file with a fast preset:
+#
+#   - content that barely shrinks (mp3/ogg sounds, png/jpg, DXT textures) is stored as is
+#   - content with a small gain gets a cheap preset, nearly all of the gain for a fraction of the time
+#   - the rest gets the full level, with delta in front for PCM .wav audio (or BCJ for
+#     executables) when the samples show it helps, and a dictionary no bigger than the file
+#
+# The choice goes into the release manifest next to the ratio the archive actually got.
+
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 128 * 1024
+SAMPLE_PRESET = 1
+# Filters are tried at the full level, on this many of the samples to keep it cheap
+FILTER_SAMPLES = 4
+# Sampled ratio (packed / unpacked) above which a VPK is stored uncompressed
+STORE_RATIO = 0.98
+# Above this the full preset only finds a little more than a cheap one
+LOW_GAIN_RATIO = 0.90
+LOW_GAIN_LEVEL = 3
+# A filter is kept when it makes the samples at least this much smaller at the level being used,
+# it has to pay for compressing on one thread (see sevenzip.compress_lzma2_solid)
+FILTER_GAIN = 0.97
+# Share of the chunk an asset type needs before its filters are tried
+FILTER_SHARE = 0.3
+MIN_DICT_SIZE = 1 << 20
+
+# Filters worth trying for the file types that benefit from them
+FILTER_CANDIDATES = {
+    "wav": ["delta:2", "delta:4"],  # 16 bit mono/stereo PCM
+    "dll": ["x86"],
+    "exe": ["x86"],
+}
+CHUNK_NAME = re.compile(r"^(.*)_(\d{3})\.vpk$")
+
+def find_directory(vpk_path):
+    """(dir path, archive index) when vpk_path is a chunk of a VPK whose _dir.vpk is next to it, else None."""
+    match = CHUNK_NAME.match(os.path.basename(vpk_path))
+    if not match:
+        return None
+    dir_path = os.path.join(os.path.dirname(vpk_path), vpk_file.dir_file_name(match.group(1)))
+    if not os.path.exists(dir_path):
+        return None
+    return dir_path, int(match.group(2))
+
+def entries_mix(entries):
+    """{extension: share of the bytes} of VPKEntry objects stored in one chunk, None if they're all empty."""
+    sizes = {}
+    seen = set()
+    for entry in entries:
+        # Deduplicated files point at the same bytes, count them once
+        if not entry.length or (entry.offset, entry.length) in seen:
+            continue
+        seen.add((entry.offset, entry.length))
+        ext = os.path.splitext(entry.path)[1].lstrip(".").lower() or "(none)"
+        sizes[ext] = sizes.get(ext, 0) + entry.length
+    total = sum(sizes.values())
+    if not total:
+        return None
+    return {ext: size / total for ext, size in sorted(sizes.items(), key=lambda item: -item[1])}
+
+def asset_mix(vpk_path):
+    """entries_mix of a chunk read from its _dir.vpk, None if there isn't one.
+
+    Only for a finished build, while packing the directory is either missing or the old one.
+    """
+    found = find_directory(vpk_path)
+    if not found:
+        return None
+    dir_path, archive_index = found
+    try:
+        _, entries, _ = vpk_file.read_directory(dir_path)
+    except ValueError:
+        return None
+    return entries_mix(e for e in entries if e.archive_index == archive_index)
+
+def read_samples(path, count=SAMPLE_COUNT, size=SAMPLE_SIZE):
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if file_size <= count * size:
+            return [f.read()]
+        samples = []
+        step = (file_size - size) // (count - 1)
+        for i in range(count):
+            f.seek(i * step)
+            samples.append(f.read(size))
+        return samples
+
+def dict_size_for(level, file_size):
+    # A dictionary bigger than the file only costs memory when unpacking
+    dict_size = sevenzip.PRESET_DICT_SIZES[level]
+    while dict_size // 2 >= max(file_size, MIN_DICT_SIZE):
+        dict_size //= 2
+    return dict_size
+
+def sample_ratio(samples, filters=(), preset=SAMPLE_PRESET):
+    dict_size = dict_size_for(preset, max(len(sample) for sample in samples))
+    chain = [sevenzip.pre_filter(spec)[0] for spec in filters] + [sevenzip.lzma2_filter(preset, dict_size)]
+    unpacked = sum(len(sample) for sample in samples)
+    packed = sum(len(lzma.compress(sample, format=lzma.FORMAT_RAW, filters=chain)) for sample in samples)
+    return packed / max(unpacked, 1)
+
+def choose_policy(vpk_path, level=9, mix=None):
+    """How to compress vpk_path with LZMA2 at most at level, returned as a manifest ready dict.
+
+    mix is the chunk's entries_mix when the caller knows it, otherwise it's read from the _dir.vpk.
+    """
+    if mix is None:
+        mix = asset_mix(vpk_path)
+    samples = read_samples(vpk_path)
+    ratio = sample_ratio(samples)
+    policy = {
+        "method": "lzma2",
+        "level": level,
+        "filters": [],
+        "dict_size": None,
+        "sampled_ratio": round(ratio, 4),
+        "assets": {ext: round(share, 3) for ext, share in list(mix.items())[:5]} if mix else None,
+    }
+
+    if ratio > STORE_RATIO:
+        policy.update(method="copy", level=None, reason="incompressible")
+        return policy
+
+    if ratio > LOW_GAIN_RATIO:
+        policy.update(level=min(level, LOW_GAIN_LEVEL), reason="low_gain")
+    else:
+        policy["reason"] = "full"
+        # Without a directory to go by every filter gets a try, it's only a few samples
+        if mix is None:
+            candidates = sorted({spec for specs in FILTER_CANDIDATES.values() for spec in specs})
+        else:
+            candidates = [spec for ext, share in mix.items() if share >= FILTER_SHARE
+                          for spec in FILTER_CANDIDATES.get(ext, [])]
+        # The fast preset flatters filters the full one doesn't need, so these compare at the real level
+        trial = samples[::max(1, len(samples) // FILTER_SAMPLES)]
+        best = sample_ratio(trial, preset=level) if candidates else ratio
+        for spec in candidates:
+            filtered = sample_ratio(trial, [spec], level)
+            if filtered < best * FILTER_GAIN:
+                best = filtered
+                policy.update(filters=[spec], sampled_ratio=round(filtered, 4), reason="filtered")
+
+    policy["dict_size"] = dict_size_for(policy["level"], os.path.getsize(vpk_path))
+    return policy
+
+def describe(policy):
+    text = "stored" if policy["method"] == "copy" else f"lzma2 level {policy['level']}"
+    if policy["filters"]:
+        text += " + " + ", ".join(policy["filters"])
+    text += f" ({policy['reason'].replace('_', ' ')}, sampled ratio {policy['sampled_ratio']:.3f}"
+    if policy["assets"]:
+        ext, share = next(iter(policy["assets"].items()))
+        text += f", {share:.0%} .{ext}"
+    return text + ")"
@@ -1,46 +1,99 @@
+import sys
+import time
+import argparse
+
+from keyvalues import read_text, tokenize, unquote
+
+def parse_tokens(text):
+   """Map every key/value pair in a KeyValues file by (lowercased key, conditional).
+
+   Values are (key, value, raw text of the entry), the first duplicate wins.
+   """
+   tokens = {}
+   key = None
+   pending = None  # last pair, held back in case a [$PLATFORM] conditional follows it
+
+   def flush(conditional='', end=None):
+      ident = (pending[0].lower(), conditional)
+      if ident not in tokens:
+         tokens[ident] = (pending[0], pending[1], text[pending[2]:end or pending[3]])
+
+   for kind, token, start, end in tokenize(text):
+      if kind == 'space':
+         continue
+      if pending:
+         if kind == 'conditional':
+            flush(token, end)
+            pending = None
+            continue
+         flush()
+         pending = None
+
+      if kind in ('open', 'close'):
+         key = None
+      elif kind == 'conditional':
+         continue
+      elif key is None:
+         key = unquote(token)
+         key_start = text.rfind('\n', 0, start) + 1
+      else:
+         pending = (key, unquote(token), key_start, end)
+         key = None
+   if pending:
+      flush()
+   return tokens
+
+def write_section(out, title, entries, newline):
+   out.write(f'// {title} ({len(entries)}){newline}')
+   for raw in entries:
+      out.write(raw + newline)
+   out.write(newline)
+
 def compare_files(file1_path, file2_path, output_path):
-   encodings = ['utf-8', 'utf-16', 'latin1', 'cp1252']
-   
-   for enc in encodings:
-       try:
-           with open(file1_path, 'r', encoding=enc) as f1, open(file2_path, 'r', encoding=enc) as f2:
-               # Read as binary to preserve newlines
-               content1 = f1.read()
-               content2 = f2.read()
-               
-               lines1 = content1.splitlines(keepends=True)
-               lines2 = content2.splitlines(keepends=True)
-               
-               differences = []
-               seen = set()
-               
-               for i, line in enumerate(lines1):
-                   if line not in lines2 and line not in seen:
-                       differences.append((i, line))
-                       seen.add(line)
-               
-               for i, line in enumerate(lines2):
-                   if line not in lines1 and line not in seen:
-                       differences.append((i, line))
-                       seen.add(line)
-               
-               differences.sort(key=lambda x: x[0])
-               
-               with open(output_path, 'w', encoding=enc) as out:
-                   for _, line in differences:
-                       out.write(line)
-               return
-       except UnicodeError:
-           continue
-   raise Exception("Could not read files with any supported encoding")
+   """Diff two KeyValues files by token key, returns (added, removed, changed) counts.
+
+   The output is written in the encoding of file2, so added/changed entries can be pasted straight back.
+   """
+   text1, _ = read_text(file1_path)
+   text2, enc = read_text(file2_path)
+   tokens1 = parse_tokens(text1)
+   tokens2 = parse_tokens(text2)
+   newline = '\r\n' if '\r\n' in text2 else '\n'
+
+   added = [raw for ident, (_, _, raw) in tokens2.items() if ident not in tokens1]
+   removed = [raw for ident, (_, _, raw) in tokens1.items() if ident not in tokens2]
+   changed = []
+   for ident, (_, value, raw) in tokens2.items():
+      old = tokens1.get(ident)
+      if old is not None and old[1] != value:
+         # Old entry commented out above the new one
+         changed.append(''.join('// ' + line for line in old[2].splitlines(keepends=True)) + newline + raw)
+
+   with open(output_path, 'w', encoding=enc, errors='surrogatepass', newline='') as out:
+      write_section(out, 'Added', added, newline)
+      write_section(out, 'Removed', removed, newline)
+      write_section(out, 'Changed', changed, newline)
+   return len(added), len(removed), len(changed)
+
+def main():
+   parser = argparse.ArgumentParser(description='Compare two KeyValues/localization files by token key')
+   parser.add_argument('file1', nargs='?', help='Old file')
+   parser.add_argument('file2', nargs='?', help='New file')
+   parser.add_argument('output', nargs='?', help='Output file for the differences')
+   args = parser.parse_args()
+
+   file1 = args.file1 or input("Enter first file path: ")
+   file2 = args.file2 or input("Enter second file path: ")
+   output = args.output or input("Enter output file path: ")
 
-if __name__ == "__main__":
-   file1 = input("Enter first file path: ")
-   file2 = input("Enter second file path: ")
-   output = input("Enter output file path: ")
-   
    try:
-       compare_files(file1, file2, output)
-       print(f"Differences written to {output}")
+      start = time.perf_counter()
+      added, removed, changed = compare_files(file1, file2, output)
+      print(f"{added} added, {removed} removed, {changed} changed in {time.perf_counter() - start:.2f}s")
+      print(f"Differences written to {output}")
    except Exception as e:
-       print(f"Error: {e}")
\ No newline at end of file
+      print(f"Error: {e}")
+      sys.exit(1)
+
+if __name__ == "__main__":
+   main()
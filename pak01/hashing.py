@@ -0,0 +1,112 @@
+import os
+import mmap
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# xxhash is optional, it's only used for internal caches when it's installed
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024  # 4 MiB reads instead of 4 KiB
+MIN_BLOCK_SIZE = 1 * 1024 * 1024
+MAX_BLOCK_SIZE = 8 * 1024 * 1024
+
+# md5 stays the default since that's what goes into the .kv files and hash files
+DEFAULT_ALGORITHM = "md5"
+# fast algorithm for caches that never leave the build machine
+CACHE_ALGORITHM = "xxh3_128" if xxhash else "blake2b"
+
+def available_algorithms():
+    algorithms = ["md5", "sha1", "sha256", "blake2b", "blake2s"]
+    if xxhash:
+        algorithms += ["xxh64", "xxh3_64", "xxh3_128"]
+    return algorithms
+
+def new_hasher(algorithm=DEFAULT_ALGORITHM):
+    if algorithm.startswith("xxh"):
+        if not xxhash:
+            raise ValueError(f"{algorithm} needs the xxhash package (pip install xxhash)")
+        return getattr(xxhash, algorithm)()
+    if algorithm == "blake2b":
+        # 128 bit digest is plenty for change detection and keeps caches small
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.new(algorithm)
+
+def clamp_block_size(block_size):
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+def hash_bytes(data, algorithm=DEFAULT_ALGORITHM):
+    hasher = new_hasher(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+def hash_file(file_path, algorithm=DEFAULT_ALGORITHM, block_size=DEFAULT_BLOCK_SIZE, use_mmap=False):
+    hasher = new_hasher(algorithm)
+    block_size = clamp_block_size(block_size)
+
+    with open(file_path, "rb", buffering=0) as f:
+        if use_mmap:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    view = memoryview(mm)
+                    try:
+                        for offset in range(0, size, block_size):
+                            hasher.update(view[offset:offset + block_size])
+                    finally:
+                        view.release()
+            return hasher.hexdigest()
+
+        # Reuse one buffer for the whole file, hashlib drops the GIL on large updates
+        buf = bytearray(block_size)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigest()
+
+def _hash_file_args(args):
+    return hash_file(*args)
+
+def hash_files(file_paths, algorithm=DEFAULT_ALGORITHM, workers=None, use_processes=False,
+               block_size=DEFAULT_BLOCK_SIZE, use_mmap=False):
+    """Hash many files in parallel, returns the hex digests in the same order as file_paths."""
+    file_paths = list(file_paths)
+    if not file_paths:
+        return []
+
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) * 2)
+    workers = max(1, min(workers, len(file_paths)))
+
+    jobs = [(str(p), algorithm, block_size, use_mmap) for p in file_paths]
+    if workers == 1:
+        return [_hash_file_args(job) for job in jobs]
+
+    pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_class(max_workers=workers) as executor:
+        chunksize = max(1, len(jobs) // (workers * 8)) if use_processes else 1
+        return list(executor.map(_hash_file_args, jobs, chunksize=chunksize))
+
+def copy_and_hash(src, dst, length=None, algorithm=DEFAULT_ALGORITHM, block_size=DEFAULT_BLOCK_SIZE):
+    """Copy up to length bytes from one open file to another, hashing them on the way.
+
+    Returns (bytes_copied, hexdigest).
+    """
+    hasher = new_hasher(algorithm)
+    buf = bytearray(clamp_block_size(block_size))
+    view = memoryview(buf)
+    copied = 0
+    while length is None or copied < length:
+        want = len(buf) if length is None else min(len(buf), length - copied)
+        n = src.readinto(view[:want])
+        if not n:
+            break
+        hasher.update(view[:n])
+        dst.write(view[:n])
+        copied += n
+    return copied, hasher.hexdigest()
@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import datetime
+import threading
+import contextlib
+from functools import partial
+
+# Named spans and counters for the build/ship tools, so a run can say where its time went.
+#
+#   with instrument.span("hash", folder="materials"):
+#       ...
+#   instrument.count("bytes_read", size)
+#
+# Recording is always on and costs a list append per span. Nothing is written unless the
+# tool was started with --report/--trace/--profile (see add_arguments and session).
+# Spans and counters recorded inside ProcessPoolExecutor workers come back through pool_map.
+
+class Recorder:
+    def __init__(self, tool=None, profile=()):
+        self.tool = tool
+        self.started = time.perf_counter()
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.spans = []  # [name, start, end, pid, tid, depth, attrs]
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profile = set(profile or ())
+        self.profiles = []  # (span name, pstats.Stats)
+
+    def depth(self):
+        return getattr(self.local, "depth", 0)
+
+    def start_profiler(self, name, depth):
+        """A running cProfile.Profile if span name at depth should be profiled on this thread, else None."""
+        if not (name in self.profile or ("all" in self.profile and depth == 0)):
+            return None
+        # cProfile can't nest, so the outermost profiled span of each thread gets it
+        # and the inner ones show up inside it
+        if getattr(self.local, "profiling", False):
+            return None
+        profiler = cProfile.Profile()
+        with self.lock:
+            try:
+                profiler.enable()
+            except ValueError:
+                # Python 3.12+ allows one profiler for all threads, the one running already sees this span
+                return None
+        self.local.profiling = True
+        return profiler
+
+_recorder = Recorder()
+
+def start(tool, profile=()):
+    """Start recording for a tool run, forgets anything recorded before."""
+    global _recorder
+    _recorder = Recorder(tool, profile)
+    return _recorder
+
+def count(name, value=1):
+    with _recorder.lock:
+        _recorder.counters[name] = _recorder.counters.get(name, 0) + value
+
+def gauge(name, value):
+    _recorder.gauges[name] = value
+
+def add_span(name, start, end, pid=None, tid=None, depth=None, attrs=None):
+    """Record a span that was timed elsewhere (time.perf_counter values), nested in the current span by default."""
+    if depth is None:
+        depth = _recorder.depth()
+    with _recorder.lock:
+        _recorder.spans.append([name, start, end, pid or os.getpid(), tid or threading.get_ident(),
+                                depth, attrs or {}])
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    recorder = _recorder
+    depth = recorder.depth()
+    profiler = recorder.start_profiler(name, depth)
+    recorder.local.depth = depth + 1
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        end_time = time.perf_counter()
+        recorder.local.depth = depth
+        if profiler:
+            profiler.disable()
+            recorder.local.profiling = False
+            with recorder.lock:
+                recorder.profiles.append((name, pstats.Stats(profiler)))
+        add_span(name, start_time, end_time, depth=depth, attrs=attrs)
+
+def call_timed(fn, job):
+    """Runs fn(job) in a pool worker, returns (result, task span, spans and counters recorded by fn)."""
+    recorder = _recorder
+    # A forked worker starts with a copy of the parent's recorder, only what fn adds goes back
+    with recorder.lock:
+        first_span = len(recorder.spans)
+        counters_before = dict(recorder.counters)
+    start_time = time.perf_counter()
+    result = fn(job)
+    end_time = time.perf_counter()
+    with recorder.lock:
+        spans = recorder.spans[first_span:]
+        counters = {k: v - counters_before.get(k, 0) for k, v in recorder.counters.items()
+                    if v != counters_before.get(k, 0)}
+    return result, (start_time, end_time, os.getpid(), threading.get_ident()), spans, counters
+
+class PoolTimer:
+    """Records a span per ProcessPoolExecutor task and the pool's utilisation, for jobs that trickle in.
+
+    label(job) names the task in the report and the trace.
+    """
+
+    def __init__(self, name, workers, label=None):
+        self.name = name
+        self.workers = workers
+        self.label = label
+        self.started = time.perf_counter()
+        self.busy = 0.0
+        self.tasks = 0
+
+    def submit(self, executor, fn, job):
+        future = executor.submit(call_timed, fn, job)
+        future.job = job
+        return future
+
+    def result(self, future):
+        result, (task_start, task_end, pid, tid), spans, counters = future.result()
+        self.record(future.job, task_start, task_end, pid, tid, spans, counters)
+        return result
+
+    def record(self, job, task_start, task_end, pid, tid, spans, counters):
+        add_span(self.name, task_start, task_end, pid, tid, None, {"item": self.label(job)} if self.label else None)
+        # The worker's own spans nest under its task
+        depth = _recorder.depth() + 1
+        with _recorder.lock:
+            _recorder.spans.extend(s[:5] + [s[5] + depth, s[6]] for s in spans)
+        for counter, value in counters.items():
+            count(counter, value)
+        self.busy += task_end - task_start
+        self.tasks += 1
+
+    def finish(self):
+        wall = time.perf_counter() - self.started
+        if self.tasks and wall > 0:
+            # Share of the workers' time spent on tasks, low values mean the pool waited on something
+            gauge(f"{self.name}.utilisation", round(self.busy / (self.workers * wall), 3))
+
+def pool_map(executor, fn, jobs, name, workers, label=None, chunksize=1):
+    """executor.map(fn, jobs) for a ProcessPoolExecutor, recording a span per task and the pool's utilisation."""
+    jobs = list(jobs)
+    timer = PoolTimer(name, workers, label)
+    for job, (result, task, spans, counters) in zip(jobs, executor.map(partial(call_timed, fn), jobs,
+                                                                       chunksize=chunksize)):
+        timer.record(job, *task, spans, counters)
+        yield result
+    timer.finish()
+
+def phase_totals(spans):
+    totals = {}
+    for name, start_time, end_time, _, _, _, _ in spans:
+        total = totals.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+        total["count"] += 1
+        total["seconds"] += end_time - start_time
+        total["max_seconds"] = max(total["max_seconds"], end_time - start_time)
+    for total in totals.values():
+        total["seconds"] = round(total["seconds"], 6)
+        total["max_seconds"] = round(total["max_seconds"], 6)
+    return totals
+
+def span_dicts(recorder):
+    main_pid = os.getpid()
+    for name, start_time, end_time, pid, tid, depth, attrs in recorder.spans:
+        entry = {"name": name, "start": round(start_time - recorder.started, 6),
+                 "seconds": round(end_time - start_time, 6), "depth": depth}
+        if pid != main_pid:
+            entry["pid"] = pid
+        if attrs:
+            entry["attrs"] = attrs
+        yield entry
+
+def build_report(recorder, wall):
+    return {
+        "tool": recorder.tool,
+        "argv": sys.argv[1:],
+        "started": recorder.started_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "wall_seconds": round(wall, 6),
+        "phases": phase_totals(recorder.spans),
+        "counters": recorder.counters,
+        "gauges": recorder.gauges,
+        "spans": list(span_dicts(recorder)),
+    }
+
+def write_report(path, report):
+    if path.endswith(".ndjson"):
+        # One line per span plus a summary line, appended so runs pile up in one file for comparing
+        with open(path, "a") as f:
+            run = {"type": "run", **{k: v for k, v in report.items() if k != "spans"}}
+            f.write(json.dumps(run) + "\n")
+            for entry in report["spans"]:
+                f.write(json.dumps({"type": "span", "tool": report["tool"], "run": report["started"], **entry}) + "\n")
+        return
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+def write_trace(path, recorder, wall):
+    """Chrome trace event file, open it in chrome://tracing or ui.perfetto.dev."""
+    events = [{"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": recorder.tool}}]
+    for name, start_time, end_time, pid, tid, _, attrs in recorder.spans:
+        events.append({"name": name, "ph": "X", "pid": pid, "tid": tid,
+                       "ts": round((start_time - recorder.started) * 1e6, 1),
+                       "dur": round((end_time - start_time) * 1e6, 1), "args": attrs})
+    for name, value in recorder.counters.items():
+        events.append({"name": name, "ph": "C", "pid": os.getpid(), "ts": round(wall * 1e6, 1),
+                       "args": {"value": value}})
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def print_summary(recorder, wall):
+    top = [(name, total) for name, total in phase_totals(
+        [s for s in recorder.spans if s[5] == 0 and s[3] == os.getpid()]).items()]
+    if not top:
+        return
+    print(f"\nTimings ({wall:.2f}s total):")
+    for name, total in sorted(top, key=lambda item: -item[1]["seconds"]):
+        print(f"  {name:<24} {total['seconds']:>9.2f}s {total['seconds'] / max(wall, 1e-9):>6.1%}")
+    for name, value in sorted(recorder.counters.items()):
+        print(f"  {name:<24} {value:>10,}" if isinstance(value, int) else f"  {name:<24} {value:>10.2f}")
+    for name, value in sorted(recorder.gauges.items()):
+        print(f"  {name:<24} {value:>10}")
+
+def finish(report_path=None, trace_path=None, profile_dir=None):
+    recorder = _recorder
+    wall = time.perf_counter() - recorder.started
+    print_summary(recorder, wall)
+    if report_path:
+        write_report(report_path, build_report(recorder, wall))
+        print(f"Wrote run report to {report_path}")
+    if trace_path:
+        write_trace(trace_path, recorder, wall)
+        print(f"Wrote trace to {trace_path}")
+    for i, (name, stats) in enumerate(recorder.profiles):
+        prof_path = os.path.join(profile_dir or ".", f"{recorder.tool}.{name}.{i}.prof")
+        stats.dump_stats(prof_path)
+        print(f"\nProfile of {name} (full profile in {prof_path}):")
+        stats.sort_stats("cumulative").print_stats(15)
+
+def add_arguments(parser):
+    group = parser.add_argument_group('instrumentation')
+    group.add_argument('--report', metavar='PATH',
+                       help='Write a JSON run report with phase timings and counters (appends NDJSON if PATH ends in .ndjson)')
+    group.add_argument('--trace', metavar='PATH',
+                       help='Write a Chrome trace of every phase (open in chrome://tracing or ui.perfetto.dev)')
+    group.add_argument('--profile', metavar='PHASE', action='append', default=[],
+                       help="Run PHASE under cProfile, repeatable, 'all' profiles every top level phase")
+
+@contextlib.contextmanager
+def session(tool, args):
+    """Record a whole tool run and write what add_arguments asked for when it ends."""
+    start(tool, args.profile)
+    try:
+        yield
+    finally:
+        profile_dir = os.path.dirname(os.path.abspath(args.report)) if args.report else None
+        finish(args.report, args.trace, profile_dir)
@@ -0,0 +1,2 @@
+python item_schema_compile.py items_game.txt
+pause
\ No newline at end of file
@@ -0,0 +1,340 @@
+import os
+import sys
+import mmap
+import struct
+import argparse
+import traceback
+
+import hashing
+import keyvalues
+
+# Compiles items_game.txt into a flat binary schema the GC can mmap at startup instead
+# of parsing 2 MB of KeyValues text. items_game.txt stays the source of truth, the
+# binary carries the md5 of the text it was built from so a stale one can be spotted.
+#
+# Layout (little endian, every section 8 byte aligned):
+#   header    magic, version, section count, source size, source md5
+#   sections  (id, offset, count, record size) for each section below
+#   tables    fixed size records sorted by def_index, strings are offsets into the pool
+#   indexes   u32 record numbers sorted by name, for the lookups the GC does by name
+#   pool      NUL terminated UTF-8 strings, offset 0 is the empty string
+#
+# What ends up in the tables follows gc-server/gc_server/item_schema.cpp: like its text
+# loader only the first block of each section (items, prefabs, paint_kits, ...) is read.
+
+SCHEMA_MAGIC = b"CCSCHEMA"
+SCHEMA_VERSION = 1
+
+HEADER = struct.Struct("<8sIIQ16s")
+SECTION = struct.Struct("<IIII")
+
+SECTION_ITEMS = 1
+SECTION_PAINT_KITS = 2
+SECTION_STICKER_KITS = 3
+SECTION_RARITIES = 4
+SECTION_PAINT_KITS_BY_NAME = 5
+SECTION_STICKER_KITS_BY_NAME = 6
+SECTION_STRINGS = 7
+
+# def_index, name, item_name, rarity, quality, supply crate series, tournament event id, reserved
+ITEM_RECORD = struct.Struct("<IIIIIIII")
+# def_index, name, description_tag, rarity, wear_remap_min, wear_remap_max
+PAINT_KIT_RECORD = struct.Struct("<IIIIff")
+# def_index, name, item_name, description_tag, rarity, reserved
+STICKER_KIT_RECORD = struct.Struct("<IIIIII")
+# value, name, loc_key, loc_key_weapon, color, next_rarity, drop_sound, weight
+RARITY_RECORD = struct.Struct("<IIIIIIII")
+INDEX_RECORD = struct.Struct("<I")
+
+# Fallbacks item_schema.cpp uses for names it doesn't know
+DEFAULT_RARITY = "common"
+DEFAULT_QUALITY = "unique"
+
+class StringPool:
+    def __init__(self):
+        self.data = bytearray(b"\0")
+        self.offsets = {"": 0}
+
+    def add(self, value):
+        offset = self.offsets.get(value)
+        if offset is None:
+            offset = self.offsets[value] = len(self.data)
+            self.data += value.encode("utf-8", "surrogatepass") + b"\0"
+        return offset
+
+class SchemaCompiler:
+    def __init__(self, doc):
+        self.items_game = doc.find("items_game")
+        self.errors = []
+        self.warnings = []
+        if self.items_game is None:
+            raise ValueError("No items_game block found")
+
+        # Only the first block of each section is used, the same as the GC's GetSubkey
+        self.sections = {}
+        for block in self.items_game:
+            if block.is_block and block.key not in self.sections:
+                self.sections[block.key] = block
+            elif block.is_block:
+                self.warnings.append(f"Repeated section '{block.key}' is ignored by the GC")
+
+        self.rarities = self.named_values("rarities")
+        self.qualities = self.named_values("qualities")
+        self.prefabs = {p.key: p for p in self.section("prefabs")}
+
+    def section(self, name):
+        block = self.sections.get(name)
+        return block.value if block else []
+
+    def named_values(self, name):
+        values = {}
+        for node in self.section(name):
+            value = node.get("value")
+            if value is None or not value.value.isdigit():
+                self.errors.append(f"{name}/{node.key} has no numeric value")
+            else:
+                values[node.key] = int(value.value)
+        return values
+
+    def def_index(self, section, node):
+        if not node.key.isdigit():
+            self.errors.append(f"{section}/{node.key} is not a numeric def_index")
+            return None
+        return int(node.key)
+
+    def rarity(self, name, where):
+        if name not in self.rarities:
+            self.warnings.append(f"{where}: unknown rarity '{name}', using {DEFAULT_RARITY}")
+            name = DEFAULT_RARITY
+        return self.rarities.get(name, 1)
+
+    def resolve_item(self, node, where, chain=()):
+        """Fields of an item with its prefabs applied first, the way ParseItemRecursive does it."""
+        fields = {}
+        prefab_name = node["prefab"] if node.get("prefab") and not node.get("prefab").is_block else ""
+        if prefab_name:
+            prefab = self.prefabs.get(prefab_name)
+            if prefab is None:
+                self.warnings.append(f"{where}: prefab '{prefab_name}' not found")
+            elif prefab_name in chain:
+                self.errors.append(f"{where}: prefab loop {' -> '.join(chain + (prefab_name,))}")
+            else:
+                fields = self.resolve_item(prefab, where, chain + (prefab_name,))
+
+        for key in ("name", "item_name", "item_quality", "item_rarity"):
+            child = node.get(key)
+            if child is not None and not child.is_block and child.value:
+                fields[key] = child.value
+        attributes = node.get("attributes")
+        if attributes is not None and attributes.is_block:
+            for key, field in (("set supply crate series", "supply_crate_series"),
+                               ("tournament event id", "tournament_event_id")):
+                attribute = attributes.get(key)
+                if attribute is not None and attribute.is_block:
+                    value = attribute.get("value")
+                    fields[field] = self.number(value.value if value else "0", f"{where}/attributes/{key}")
+        return fields
+
+    def number(self, value, where, kind=int):
+        try:
+            return kind(float(value)) if kind is int else kind(value)
+        except ValueError:
+            self.errors.append(f"{where}: '{value}' is not a number")
+            return kind(0)
+
+    def compile(self):
+        pool = StringPool()
+
+        items = {}
+        for node in self.section("items"):
+            if node.key == "default":
+                continue
+            def_index = self.def_index("items", node)
+            if def_index is None:
+                continue
+            if def_index in items:
+                self.errors.append(f"items/{def_index} is defined twice")
+                continue
+            fields = self.resolve_item(node, f"items/{def_index}")
+            quality = fields.get("item_quality", DEFAULT_QUALITY)
+            if quality not in self.qualities:
+                self.warnings.append(f"items/{def_index}: unknown quality '{quality}', using {DEFAULT_QUALITY}")
+                quality = DEFAULT_QUALITY
+            items[def_index] = ITEM_RECORD.pack(
+                def_index, pool.add(fields.get("name", "")), pool.add(fields.get("item_name", "")),
+                self.rarity(fields.get("item_rarity", DEFAULT_RARITY), f"items/{def_index}"),
+                self.qualities.get(quality, 4), fields.get("supply_crate_series", 0),
+                fields.get("tournament_event_id", 0), 0)
+
+        paint_kit_rarities = {}
+        for node in self.section("paint_kits_rarity"):
+            if not node.is_block:
+                paint_kit_rarities[node.key] = node.value
+
+        paint_kits = {}
+        paint_kit_names = {}
+        for node in self.section("paint_kits"):
+            def_index = self.def_index("paint_kits", node)
+            if def_index is None:
+                continue
+            where = f"paint_kits/{def_index}"
+            name = node["name"] if node.get("name") else ""
+            if name in paint_kit_names:
+                self.errors.append(f"{where}: name '{name}' is already used by paint kit {paint_kit_names[name]}")
+                continue
+            paint_kit_names[name] = def_index
+            wear_min = self.number(node["wear_remap_min"] if node.get("wear_remap_min") else "0", where, float)
+            wear_max = self.number(node["wear_remap_max"] if node.get("wear_remap_max") else "1", where, float)
+            if not 0.0 <= wear_min <= wear_max <= 1.0:
+                self.errors.append(f"{where}: wear range {wear_min}-{wear_max} is invalid")
+            rarity = paint_kit_rarities.pop(name, DEFAULT_RARITY)
+            description = node["description_tag"] if node.get("description_tag") else ""
+            paint_kits[def_index] = (name, PAINT_KIT_RECORD.pack(
+                def_index, pool.add(name), pool.add(description), self.rarity(rarity, where), wear_min, wear_max))
+        for name in paint_kit_rarities:
+            self.warnings.append(f"paint_kits_rarity/{name}: no such paint kit")
+
+        sticker_kits = {}
+        sticker_kit_names = set()
+        for node in self.section("sticker_kits"):
+            def_index = self.def_index("sticker_kits", node)
+            if def_index is None:
+                continue
+            where = f"sticker_kits/{def_index}"
+            name = node["name"] if node.get("name") else ""
+            if name in sticker_kit_names:
+                self.warnings.append(f"{where}: name '{name}' is used by more than one sticker kit")
+            sticker_kit_names.add(name)
+            rarity = node["item_rarity"] if node.get("item_rarity") else "default"
+            sticker_kits[def_index] = (name, STICKER_KIT_RECORD.pack(
+                def_index, pool.add(name), pool.add(node["item_name"] if node.get("item_name") else ""),
+                pool.add(node["description_tag"] if node.get("description_tag") else ""),
+                self.rarity(rarity, where), 0))
+
+        rarities = {}
+        for node in self.section("rarities"):
+            if node.key not in self.rarities:
+                continue
+            def text(key):
+                child = node.get(key)
+                return pool.add(child.value if child is not None and not child.is_block else "")
+            weight = node.get("weight")
+            rarities[self.rarities[node.key]] = RARITY_RECORD.pack(
+                self.rarities[node.key], pool.add(node.key), text("loc_key"), text("loc_key_weapon"),
+                text("color"), text("next_rarity"), text("drop_sound"),
+                self.number(weight.value, f"rarities/{node.key}") if weight is not None else 0)
+
+        paint_kit_order = sorted(paint_kits)
+        sticker_kit_order = sorted(sticker_kits)
+        tables = [
+            (SECTION_ITEMS, ITEM_RECORD.size, [items[i] for i in sorted(items)]),
+            (SECTION_PAINT_KITS, PAINT_KIT_RECORD.size, [paint_kits[i][1] for i in paint_kit_order]),
+            (SECTION_STICKER_KITS, STICKER_KIT_RECORD.size, [sticker_kits[i][1] for i in sticker_kit_order]),
+            (SECTION_RARITIES, RARITY_RECORD.size, [rarities[v] for v in sorted(rarities)]),
+            (SECTION_PAINT_KITS_BY_NAME, INDEX_RECORD.size, name_index(paint_kit_order, paint_kits)),
+            (SECTION_STICKER_KITS_BY_NAME, INDEX_RECORD.size, name_index(sticker_kit_order, sticker_kits)),
+            (SECTION_STRINGS, 1, [bytes(pool.data)]),
+        ]
+        return tables
+
+def name_index(order, records):
+    """Record numbers sorted by name (bytewise, the way the GC compares string_views)."""
+    by_name = sorted(range(len(order)), key=lambda i: records[order[i]][0].encode("utf-8", "surrogatepass"))
+    return [INDEX_RECORD.pack(i) for i in by_name]
+
+def align(offset):
+    return (offset + 7) & ~7
+
+def write_schema(tables, source_data, out_path):
+    sections_start = HEADER.size
+    offset = align(sections_start + SECTION.size * len(tables))
+    section_headers = []
+    for section_id, record_size, records in tables:
+        size = sum(len(r) for r in records)
+        count = size if section_id == SECTION_STRINGS else len(records)
+        section_headers.append(SECTION.pack(section_id, offset, count, record_size))
+        offset = align(offset + size)
+
+    header = HEADER.pack(SCHEMA_MAGIC, SCHEMA_VERSION, len(tables), len(source_data),
+                         bytes.fromhex(hashing.hash_bytes(source_data, "md5")))
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(b"".join(section_headers))
+        for section_id, _, records in tables:
+            f.write(b"\0" * (align(f.tell()) - f.tell()))
+            f.write(b"".join(records))
+        f.write(b"\0" * (align(f.tell()) - f.tell()))
+    os.replace(tmp_path, out_path)
+
+def read_schema(path):
+    """Load a compiled schema back into dicts, used to check what was written."""
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, section_count, source_size, source_md5 = HEADER.unpack_from(data)
+        if magic != SCHEMA_MAGIC or version != SCHEMA_VERSION:
+            raise ValueError(f"{path} is not a version {SCHEMA_VERSION} item schema")
+        sections = {}
+        for i in range(section_count):
+            section_id, offset, count, record_size = SECTION.unpack_from(data, HEADER.size + i * SECTION.size)
+            sections[section_id] = (offset, count, record_size)
+
+        offset, size, _ = sections[SECTION_STRINGS]
+        strings = bytes(data[offset:offset + size])
+
+        def string(at):
+            return strings[at:strings.index(b"\0", at)].decode("utf-8", "surrogatepass")
+
+        def records(section_id, record):
+            offset, count, _ = sections[section_id]
+            return [record.unpack_from(data, offset + i * record.size) for i in range(count)]
+
+        return {
+            "source_size": source_size,
+            "source_md5": source_md5.hex(),
+            "items": [(r[0], string(r[1]), string(r[2])) + r[3:7] for r in records(SECTION_ITEMS, ITEM_RECORD)],
+            "paint_kits": [(r[0], string(r[1]), string(r[2])) + r[3:] for r in records(SECTION_PAINT_KITS, PAINT_KIT_RECORD)],
+            "sticker_kits": [(r[0], string(r[1]), string(r[2]), string(r[3]), r[4])
+                             for r in records(SECTION_STICKER_KITS, STICKER_KIT_RECORD)],
+            "rarities": [(r[0], string(r[1])) for r in records(SECTION_RARITIES, RARITY_RECORD)],
+        }
+    finally:
+        data.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate items_game.txt and compile it into a binary item schema')
+    parser.add_argument('input', nargs='?', default="items_game.txt", help='items_game.txt (default: items_game.txt)')
+    parser.add_argument('output', nargs='?', default=None, help='Output file (default: next to the input, .bin)')
+    parser.add_argument('--strict', action='store_true', help='Treat warnings as errors')
+    parser.add_argument('--quiet', action='store_true', help="Only print the warning count, not every warning")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.input)[0] + ".bin"
+    try:
+        with open(args.input, "rb") as f:
+            source_data = f.read()
+        compiler = SchemaCompiler(keyvalues.load(args.input))
+        tables = compiler.compile()
+    except Exception:
+        print(traceback.format_exc())
+        sys.exit(1)
+
+    if not args.quiet:
+        for warning in compiler.warnings:
+            print(f"Warning: {warning}")
+    for error in compiler.errors:
+        print(f"Error: {error}")
+    print(f"{len(compiler.errors)} errors, {len(compiler.warnings)} warnings")
+    if compiler.errors or (args.strict and compiler.warnings):
+        print(f"Not writing {output}")
+        sys.exit(1)
+
+    write_schema(tables, source_data, output)
+    counts = {section_id: len(records) for section_id, _, records in tables}
+    print(f"Wrote {output}: {counts[SECTION_ITEMS]} items, {counts[SECTION_PAINT_KITS]} paint kits, "
+          f"{counts[SECTION_STICKER_KITS]} sticker kits, {counts[SECTION_RARITIES]} rarities, "
+          f"{os.path.getsize(output)} bytes")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import sys
+import json
+import time
+import bisect
+import argparse
+import traceback
+
+import hashing
+import keyvalues
+
+# Structural diff/patch for items_game.txt. Nodes are matched by their key path
+# (items_game/items/507, items_game/paint_kits/1200, ...) through a dict per block,
+# so both diffing and applying stay linear in the size of the schema.
+#
+# A patch is JSON: {"version", "base_md5", "target_md5", "ops": [...]} where every op is
+#   ["set", path, old value, new value]
+#   ["add", path, KeyValues text of the node, segment of the sibling it follows or None if it's first]
+#   ["del", path, md5 of the removed node's text]
+#   ["move", path, segment of the sibling it now follows or None if it's first]
+# and a path is a list of lowercased keys, a repeated key is written as [key, n] for its nth copy.
+# Version 1 patches have no sibling in add ops (those nodes go at the end of their parent)
+# and no moves.
+
+PATCH_VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+
+def child_index(block):
+    """{path segment: child} for one block, the nth repeat of a key gets the segment [key, n]."""
+    index = {}
+    seen = {}
+    for child in block:
+        key = child.key.lower()
+        count = seen.get(key, 0)
+        seen[key] = count + 1
+        index[key if count == 0 else (key, count)] = child
+    return index
+
+def segment_json(segment):
+    return list(segment) if isinstance(segment, tuple) else segment
+
+def segment_key(segment):
+    return tuple(segment) if isinstance(segment, list) else segment
+
+def path_str(path):
+    return "/".join(s if isinstance(s, str) else f"{s[0]}#{s[1]}" for s in path)
+
+def node_md5(node, depth):
+    return hashing.hash_bytes(keyvalues.dumps_node(node, depth).strip().encode("utf-8", "surrogatepass"))
+
+def same_node(a, b):
+    if a.is_block != b.is_block:
+        return False
+    if not a.is_block:
+        return a.value == b.value
+    if len(a.value) != len(b.value):
+        return False
+    return all(x.key.lower() == y.key.lower() and same_node(x, y) for x, y in zip(a.value, b.value))
+
+def staying_segments(old_index, new_index):
+    """Segments of both blocks that keep their place, the longest run of them already in the new order.
+
+    Every other common child gets a move, so the patched block ends up in the new order.
+    """
+    old_positions = {segment: i for i, segment in enumerate(old_index)}
+    common = [segment for segment in new_index if segment in old_positions]
+    tails = []  # old position ending the best run of each length
+    tail_items = []
+    links = {}  # common index -> index of the one before it in its run
+    for i, segment in enumerate(common):
+        length = bisect.bisect_left(tails, old_positions[segment])
+        if length == len(tails):
+            tails.append(old_positions[segment])
+            tail_items.append(i)
+        else:
+            tails[length] = old_positions[segment]
+            tail_items[length] = i
+        links[i] = tail_items[length - 1] if length else None
+    staying = set()
+    i = tail_items[-1] if tail_items else None
+    while i is not None:
+        staying.add(common[i])
+        i = links[i]
+    return staying
+
+def diff_blocks(old, new, path, depth, ops):
+    old_index = child_index(old)
+    new_index = child_index(new)
+    staying = staying_segments(old_index, new_index)
+
+    # Last first, removing a repeated key renumbers the copies after it
+    for segment, old_child in reversed(old_index.items()):
+        if segment not in new_index:
+            ops.append(["del", path + [segment_json(segment)], node_md5(old_child, depth)])
+
+    previous = None
+    for segment, new_child in new_index.items():
+        child_path = path + [segment_json(segment)]
+        old_child = old_index.get(segment)
+        if old_child is None:
+            ops.append(["add", child_path, keyvalues.dumps_node(new_child, depth), previous])
+            previous = segment_json(segment)
+            continue
+        if segment not in staying:
+            ops.append(["move", child_path, previous])
+        if old_child.is_block and new_child.is_block:
+            diff_blocks(old_child, new_child, child_path, depth + 1, ops)
+        elif not old_child.is_block and not new_child.is_block:
+            if old_child.value != new_child.value:
+                ops.append(["set", child_path, old_child.value, new_child.value])
+        else:
+            # A value turned into a block or the other way around
+            ops.append(["del", child_path, node_md5(old_child, depth)])
+            ops.append(["add", child_path, keyvalues.dumps_node(new_child, depth), previous])
+        previous = segment_json(segment)
+
+def make_patch(old_path, new_path):
+    old = keyvalues.load(old_path)
+    new = keyvalues.load(new_path)
+    ops = []
+    diff_blocks(old, new, [], 0, ops)
+    return {
+        "version": PATCH_VERSION,
+        "base_md5": hashing.hash_file(old_path),
+        "target_md5": hashing.hash_file(new_path),
+        "ops": ops,
+    }
+
+class PathResolver:
+    """Finds nodes by path, indexing each block the first time it's visited."""
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.indexes = {}
+
+    def index(self, block):
+        index = self.indexes.get(id(block))
+        if index is None:
+            index = self.indexes[id(block)] = child_index(block)
+        return index
+
+    def find(self, path):
+        node = self.doc
+        for segment in path:
+            if not node.is_block:
+                return None
+            node = self.index(node).get(segment_key(segment))
+            if node is None:
+                return None
+        return node
+
+    def changed(self, block):
+        self.indexes.pop(id(block), None)
+
+def insert_position(resolver, parent, segment):
+    """Index in parent right after the child at segment, 0 for None and the end if it's missing."""
+    if segment is None:
+        return 0
+    sibling = resolver.index(parent).get(segment_key(segment))
+    return len(parent.value) if sibling is None else parent.value.index(sibling) + 1
+
+def apply_patch(doc, patch, force=False):
+    """Apply patch ops to doc in place, returns (applied, skipped, conflicts)."""
+    resolver = PathResolver(doc)
+    applied = 0
+    skipped = 0
+    conflicts = []
+
+    for op in patch["ops"]:
+        kind, path = op[0], op[1]
+        parent = resolver.find(path[:-1])
+        node = resolver.find(path)
+
+        if kind == "set":
+            old_value, new_value = op[2], op[3]
+            if node is None or node.is_block:
+                conflicts.append((path, "missing"))
+            elif node.value == new_value:
+                skipped += 1
+            elif node.value != old_value and not force:
+                conflicts.append((path, f"base has {node.value!r}, patch expects {old_value!r}"))
+            else:
+                node.value = new_value
+                applied += 1
+
+        elif kind == "add":
+            if parent is None or not parent.is_block:
+                conflicts.append((path, "parent missing"))
+                continue
+            added = keyvalues.loads(op[2]).value
+            if node is not None:
+                if len(added) == 1 and same_node(node, added[0]):
+                    skipped += 1
+                    continue
+                if not force:
+                    conflicts.append((path, "already exists with different contents"))
+                    continue
+                parent.value[parent.value.index(node)] = added[0]
+            else:
+                # Version 1 adds go at the end
+                position = insert_position(resolver, parent, op[3]) if len(op) > 3 else len(parent.value)
+                parent.value[position:position] = added
+            resolver.changed(parent)
+            applied += 1
+
+        elif kind == "move":
+            if node is None:
+                conflicts.append((path, "missing"))
+                continue
+            current = parent.value.index(node)
+            parent.value.remove(node)
+            position = insert_position(resolver, parent, op[2])
+            parent.value.insert(position, node)
+            resolver.changed(parent)
+            if position == current:
+                skipped += 1
+            else:
+                applied += 1
+
+        elif kind == "del":
+            if node is None:
+                skipped += 1
+                continue
+            if node_md5(node, len(path) - 1) != op[2] and not force:
+                conflicts.append((path, "changed in base, not removing"))
+                continue
+            parent.remove(node)
+            resolver.changed(parent)
+            applied += 1
+
+        else:
+            raise ValueError(f"Unknown patch op {kind!r}")
+
+    return applied, skipped, conflicts
+
+def summarize(ops):
+    """Op counts per top level section, e.g. {'items': {'add': 3}}."""
+    summary = {}
+    for op in ops:
+        section = path_str(op[1][1:2] or op[1][:1])
+        counts = summary.setdefault(section, {})
+        counts[op[0]] = counts.get(op[0], 0) + 1
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Structural diff and patch for items_game.txt')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    diff_parser = commands.add_parser('diff', help='Write a patch that turns OLD into NEW')
+    diff_parser.add_argument('old', help='Base items_game file (e.g. items_game_2016.txt)')
+    diff_parser.add_argument('new', help='Changed items_game file (e.g. items_game.txt)')
+    diff_parser.add_argument('patch', help='Output patch file (.json)')
+
+    apply_parser = commands.add_parser('apply', help='Apply a patch to a base file')
+    apply_parser.add_argument('base', help='items_game file to patch')
+    apply_parser.add_argument('patch', help='Patch file written by diff')
+    apply_parser.add_argument('output', help='Output file (may be the same as base)')
+    apply_parser.add_argument('--force', action='store_true',
+                              help='Apply ops even where the base differs from what the patch expects, '
+                                   'and write the output even if there are conflicts')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        if args.command == 'diff':
+            patch = make_patch(args.old, args.new)
+            with open(args.patch, "w", encoding="utf-8") as f:
+                json.dump(patch, f, separators=(",", ":"), ensure_ascii=False)
+            for section, counts in sorted(summarize(patch["ops"]).items()):
+                print(f"  {section}: " + ", ".join(f"{n} {op}" for op, n in sorted(counts.items())))
+            print(f"Wrote {len(patch['ops'])} ops to {args.patch} in {time.perf_counter() - start:.2f}s")
+
+        elif args.command == 'apply':
+            with open(args.patch, "r", encoding="utf-8") as f:
+                patch = json.load(f)
+            if patch.get("version") not in SUPPORTED_VERSIONS:
+                print(f"Unsupported patch version {patch.get('version')}")
+                sys.exit(1)
+            doc = keyvalues.load(args.base)
+            applied, skipped, conflicts = apply_patch(doc, patch, args.force)
+            for path, reason in conflicts:
+                print(f"  Conflict at {path_str(path)}: {reason}")
+            print(f"Applied {applied} ops, {skipped} already present, {len(conflicts)} conflicts "
+                  f"in {time.perf_counter() - start:.2f}s")
+            if conflicts and not args.force:
+                print(f"Not writing {args.output}, resolve the conflicts or use --force")
+                sys.exit(1)
+            keyvalues.save(doc, args.output)
+    except Exception:
+        print(traceback.format_exc())
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
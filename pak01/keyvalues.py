@@ -0,0 +1,492 @@
+import gc
+import os
+import re
+import codecs
+import marshal
+import contextlib
+
+import hashing
+
+# Valve KeyValues text (items_game.txt, game_sounds_*.txt, csgo_english*.txt).
+#
+# Every node remembers the exact source text it was parsed from, so a tree that is
+# loaded and saved again comes out byte for byte identical, and editing one value
+# only rewrites that one line. Keys and values are kept as written, escapes included
+# (\n stays a backslash and an n), so a value set in code has to be escaped text too,
+# escape() turns plain text into that.
+
+# Whitespace runs and comments only ever match whole, so when a token after them doesn't
+# match there's no shorter split to back off into (and no comment turning into a bare token)
+SPACE_PATTERN = r'(?:\s+(?!\s)|//[^\n]*(?![^\n]))+'
+VALUE_PATTERN = r'''
+    (?P<quoted>"[^"\\]*(?:\\.[^"\\]*)*"?)
+  | (?P<open>\{)
+  | (?P<close>\})
+  | (?P<conditional>\[[^\]\n]*\])
+  | (?P<bare>(?!//)[^\s{}"\[\]]+)
+'''
+SPACE_RE = re.compile(SPACE_PATTERN)
+TOKEN_RE = re.compile(r'(?P<space>' + SPACE_PATTERN + r')|' + VALUE_PATTERN, re.X | re.S)
+# The same tokens with the whitespace before them folded in, half as many matches for parse_nodes
+HEADED_TOKEN_RE = re.compile(r'(?:' + SPACE_PATTERN + r')?(?:' + VALUE_PATTERN + r')', re.X | re.S)
+
+# A string body as the tokenizer reads it, any " in it escaped
+ESCAPED_RE = re.compile(r'(?:[^"\\]|\\.)*', re.S)
+ESCAPES = {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\t": "\\t"}
+UNESCAPES = {v: k for k, v in ESCAPES.items()}
+
+BOMS = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+CACHE_MAGIC = b"KVC1"
+CACHE_EXTENSION = ".kvcache"
+
+class KeyValuesError(ValueError):
+    pass
+
+def detect_encoding(data):
+    """Pick the encoding from the BOM, localization files are UTF-16 LE with a BOM."""
+    for bom, enc in BOMS:
+        if data.startswith(bom):
+            return enc
+    try:
+        data.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1252"
+
+def read_text(file_path):
+    """Read a text file once, returns (text, encoding)."""
+    with open(file_path, "rb") as f:
+        data = f.read()
+    return decode(data)
+
+def decode(data):
+    enc = detect_encoding(data)
+    # surrogatepass keeps the odd broken character in the CS2 files instead of failing the whole file
+    return data.decode(enc, errors="surrogatepass"), enc
+
+def unquote(token):
+    if token.startswith('"'):
+        return token[1:-1] if len(token) > 1 and token.endswith('"') else token[1:]
+    return token
+
+def escape(text):
+    """Plain text as a KeyValues string body: backslashes, quotes, newlines and tabs escaped."""
+    return re.sub(r'[\\"\n\t]', lambda m: ESCAPES[m.group()], text)
+
+def unescape(value):
+    """The plain text of an escaped string body, unknown escapes are left as they are."""
+    return re.sub(r'\\.', lambda m: UNESCAPES.get(m.group(), m.group()), value, flags=re.S)
+
+def quote(value):
+    """Wrap an escaped string body in quotes, refuses one that wouldn't parse back as the same value."""
+    if not ESCAPED_RE.fullmatch(value):
+        raise KeyValuesError(f"{value!r} has an unescaped '\"' or ends in a lone '\\', use escape() on plain text")
+    return f'"{value}"'
+
+def tokenize(text):
+    """Yield (kind, value, start, end) for every token, whitespace and comments come out as 'space'."""
+    pos = 0
+    for match in TOKEN_RE.finditer(text):
+        start, end = match.span()
+        if start != pos:
+            break
+        yield match.lastgroup, match.group(), start, end
+        pos = end
+    if pos < len(text):
+        raise KeyValuesError(f"Unexpected character {text[pos]!r} at offset {pos}")
+
+def _headed_tokens(text):
+    """tokenize without separate 'space' tokens, a token's start is where the whitespace before it starts."""
+    pos = 0
+    for match in HEADED_TOKEN_RE.finditer(text):
+        start, end = match.span()
+        if start != pos:
+            break
+        kind = match.lastgroup
+        yield kind, match.group(kind), start, end
+        pos = end
+    if pos < len(text):
+        space = SPACE_RE.match(text, pos)
+        if space is None or space.end() < len(text):
+            pos = space.end() if space else pos
+            raise KeyValuesError(f"Unexpected character {text[pos]!r} at offset {pos}")
+        yield "space", space.group(), pos, len(text)
+
+class KVNode:
+    """A key with either a string value or a list of child nodes. Keys may repeat."""
+
+    __slots__ = ("key", "value", "conditional", "head", "tail", "source")
+
+    def __init__(self, key, value=None, conditional=None):
+        self.key = key
+        self.value = [] if value is None else value
+        self.conditional = conditional
+        self.head = None  # source text from the whitespace before the key up to the value or '{'
+        self.tail = None  # source text from the end of the last child up to '}'
+        self.source = None  # (key, value, conditional) as parsed, to spot edits
+
+    @property
+    def is_block(self):
+        return isinstance(self.value, list)
+
+    def __iter__(self):
+        return iter(self.value) if self.is_block else iter(())
+
+    def __len__(self):
+        return len(self.value) if self.is_block else 0
+
+    def __bool__(self):
+        # An empty block or a plain value is still a node that exists
+        return True
+
+    def __repr__(self):
+        if self.is_block:
+            return f"KVNode({self.key!r}, [{len(self.value)} children])"
+        return f"KVNode({self.key!r}, {self.value!r})"
+
+    def get_all(self, key):
+        key = key.lower()
+        return [child for child in self if child.key.lower() == key]
+
+    def get(self, key, default=None):
+        """First child with this key (case insensitive like the engine)."""
+        key = key.lower()
+        for child in self:
+            if child.key.lower() == key:
+                return child
+        return default
+
+    def __getitem__(self, key):
+        child = self.get(key)
+        if child is None:
+            raise KeyError(key)
+        return child.value
+
+    def find(self, path):
+        """Follow a path like 'items_game/items/507', returns None if any part is missing."""
+        node = self
+        for part in path.strip("/").split("/"):
+            node = node.get(part)
+            if node is None:
+                return None
+        return node
+
+    def add(self, key, value=None, conditional=None):
+        node = KVNode(key, value, conditional)
+        self.value.append(node)
+        return node
+
+    def remove(self, child):
+        self.value.remove(child)
+
+    def to_dict(self):
+        """Plain nested dicts, the first of any duplicate keys wins."""
+        if not self.is_block:
+            return self.value
+        result = {}
+        for child in self:
+            result.setdefault(child.key, child.to_dict())
+        return result
+
+    def _to_tuple(self):
+        value = tuple(child._to_tuple() for child in self.value) if self.is_block else self.value
+        return (self.key, value, self.conditional, self.head, self.tail, self.source is not None)
+
+    @classmethod
+    def _from_tuple(cls, data):
+        key, value, conditional, head, tail, parsed = data
+        node = cls(key, [cls._from_tuple(child) for child in value] if isinstance(value, tuple) else value,
+                   conditional)
+        node.head = head
+        node.tail = tail
+        if parsed:
+            node.source = (key, None if node.is_block else value, conditional)
+        return node
+
+class KVDocument(KVNode):
+    """The root of a file, its children are the top level keys (usually just one)."""
+
+    __slots__ = ("encoding", "newline")
+
+    def __init__(self, encoding="utf-8", newline="\n"):
+        super().__init__(None)
+        self.encoding = encoding
+        self.newline = newline
+
+def _finish_pair(node, text, head_start, end):
+    node.head = text[head_start:end]
+    node.source = (node.key, None if node.is_block else node.value, node.conditional)
+
+def parse_nodes(text, tokens, root):
+    """Build nodes from tokens into root.
+
+    Tokens are tokenize's or _headed_tokens', where start includes the whitespace before
+    the token, so errors point at end - len(value).
+    """
+    stack = [root]
+    node = None  # pair waiting for its value
+    last = None  # finished pair a [$CONDITIONAL] could still attach to
+    space_start = None
+
+    for kind, value, start, end in tokens:
+        if kind == "space":
+            if space_start is None:
+                space_start = start
+            continue
+        head_start = start if space_start is None else space_start
+        space_start = None
+
+        if kind == "conditional":
+            target = node or last
+            if target is None:
+                raise KeyValuesError(f"Conditional {value} without a key at offset {end - len(value)}")
+            target.conditional = value
+            if target is last:
+                _finish_pair(last, text, last_start, end)
+            continue
+
+        if node is None:
+            if kind == "close":
+                if len(stack) == 1:
+                    raise KeyValuesError(f"Unmatched '}}' at offset {end - len(value)}")
+                stack[-1].tail = text[head_start:end]
+                stack.pop()
+                last = None
+                continue
+            if kind == "open":
+                raise KeyValuesError(f"Block without a key at offset {end - len(value)}")
+            node = KVNode(unquote(value))
+            node_start = head_start
+        else:
+            if kind == "open":
+                node.value = []
+                stack[-1].value.append(node)
+                _finish_pair(node, text, node_start, end)
+                stack.append(node)
+                node = None
+                last = None
+                continue
+            if kind == "close":
+                raise KeyValuesError(f"Key {node.key!r} without a value at offset {end - len(value)}")
+            # _finish_pair inlined, this is the line most nodes go through
+            node.value = value = unquote(value)
+            stack[-1].value.append(node)
+            node.head = text[node_start:end]
+            node.source = (node.key, value, node.conditional)
+            last, last_start = node, node_start
+            node = None
+
+    if node is not None:
+        raise KeyValuesError(f"Key {node.key!r} without a value at end of file")
+    if len(stack) > 1:
+        raise KeyValuesError(f"Block {stack[-1].key!r} is never closed")
+    if space_start is not None:
+        root.tail = text[space_start:]
+
+@contextlib.contextmanager
+def _paused_gc():
+    # items_game.txt is a couple hundred thousand nodes and none of them are garbage,
+    # the collector walking them over and over while they're built is a good part of the time
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def loads(text, encoding="utf-8"):
+    doc = KVDocument(encoding, "\r\n" if "\r\n" in text else "\n")
+    doc.tail = ""
+    with _paused_gc():
+        parse_nodes(text, _headed_tokens(text), doc)
+    return doc
+
+def _serialize(node, depth, newline, out):
+    if node.head is not None and node.source == (node.key, None if node.is_block else node.value, node.conditional):
+        out.append(node.head)
+    else:
+        # New or edited pair, leading whitespace is kept and the rest is written fresh
+        indent = "\t" * depth
+        if node.head is not None:
+            match = TOKEN_RE.match(node.head)
+            out.append(match.group() if match and match.lastgroup == "space" else newline + indent)
+        else:
+            out.append(newline + indent)
+        out.append(quote(node.key))
+        if node.is_block:
+            if node.conditional:
+                out.append(" " + node.conditional)
+            out.append(newline + indent + "{")
+        else:
+            out.append("\t\t" + quote(node.value))
+            if node.conditional:
+                out.append(" " + node.conditional)
+
+    if node.is_block:
+        for child in node.value:
+            _serialize(child, depth + 1, newline, out)
+        out.append(node.tail if node.tail is not None else newline + "\t" * depth + "}")
+
+def dumps(doc):
+    out = []
+    for child in doc.value:
+        _serialize(child, 0, doc.newline, out)
+    out.append(doc.tail if doc.tail is not None else doc.newline)
+    text = "".join(out)
+    # A document built from scratch shouldn't start with a blank line
+    return text.lstrip("\r\n") if doc.value and doc.value[0].head is None else text
+
+def dumps_node(node, depth=0, newline="\n"):
+    """Text of one node and its children as it would appear at depth in a file."""
+    out = []
+    _serialize(node, depth, newline, out)
+    return "".join(out)
+
+def save(doc, file_path):
+    with open(file_path, "w", encoding=doc.encoding, errors="surrogatepass", newline="") as f:
+        f.write(dumps(doc))
+
+def cache_path(file_path):
+    return file_path + CACHE_EXTENSION
+
+def load(file_path, use_cache=True):
+    """Parse a KeyValues file, reusing {file}.kvcache when the file's hash hasn't changed."""
+    with open(file_path, "rb") as f:
+        data = f.read()
+    digest = hashing.hash_bytes(data, hashing.CACHE_ALGORITHM).encode("ascii")
+    cache_file = cache_path(file_path)
+
+    if use_cache and os.path.exists(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                cached = f.read()
+            header = CACHE_MAGIC + digest
+            if cached.startswith(header):
+                encoding, newline, tail, children = marshal.loads(cached[len(header):])
+                doc = KVDocument(encoding, newline)
+                doc.tail = tail
+                with _paused_gc():
+                    doc.value = [KVNode._from_tuple(child) for child in children]
+                return doc
+        except (OSError, EOFError, ValueError, TypeError):
+            pass  # stale or broken cache, parse again
+
+    text, encoding = decode(data)
+    doc = loads(text, encoding)
+    if use_cache:
+        with _paused_gc():
+            payload = marshal.dumps((doc.encoding, doc.newline, doc.tail, tuple(child._to_tuple() for child in doc.value)))
+        tmp_path = cache_file + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(CACHE_MAGIC + digest + payload)
+            os.replace(tmp_path, cache_file)
+        except OSError as e:
+            print(f"Could not write {cache_file}: {e}")
+    return doc
+
+def iter_block(file_path, path):
+    """Yield the children of the block at path (e.g. 'items_game/items') one at a time.
+
+    Nothing outside that block is turned into nodes and each child is built only when
+    it's reached, so walking one section of a big file never holds the whole tree.
+    """
+    text, _ = read_text(file_path)
+    parts = [part.lower() for part in path.strip("/").split("/")]
+    tokens = tokenize(text)
+
+    depth = 0  # how many parts of the path we're inside
+    skip = 0  # nesting depth inside a block that's off the path
+    key = None
+    for kind, value, start, end in tokens:
+        if kind in ("space", "conditional"):
+            continue
+        if skip:
+            if kind == "open":
+                skip += 1
+            elif kind == "close":
+                skip -= 1
+            continue
+
+        if kind == "close":
+            if depth == 0:
+                raise KeyValuesError(f"Unmatched '}}' at offset {start}")
+            depth -= 1
+            key = None
+        elif kind == "open":
+            if key is None:
+                raise KeyValuesError(f"Block without a key at offset {start}")
+            if key != parts[depth]:
+                skip = 1
+            elif depth + 1 < len(parts):
+                depth += 1
+            else:
+                # Found it, build its children one at a time until its closing brace
+                pushback = []
+                while True:
+                    child_tokens = _next_child(tokens, pushback)
+                    if child_tokens is None:
+                        return
+                    holder = KVNode(None)
+                    parse_nodes(text, iter(child_tokens), holder)
+                    yield from holder.value
+            key = None
+        elif key is None:
+            key = unquote(value).lower()
+        else:
+            key = None  # plain pair, nothing to descend into
+
+def _next_child(tokens, pushback):
+    """Tokens of the next child in the current block, None once the block closes."""
+    collected = []
+    trailing = []  # whitespace after a finished child belongs to the next one
+    nesting = 0
+    strings = 0  # key and value seen at this level, 2 means the child is complete
+    while True:
+        token = pushback.pop() if pushback else next(tokens, None)
+        if token is None:
+            if nesting or strings == 1:
+                raise KeyValuesError("Unexpected end of file")
+            return collected if strings else None
+        kind = token[0]
+
+        if nesting:
+            collected.append(token)
+            if kind == "open":
+                nesting += 1
+            elif kind == "close":
+                nesting -= 1
+                if nesting == 0:
+                    strings = 2
+            continue
+
+        if kind == "space":
+            (trailing if strings == 2 else collected).append(token)
+        elif kind == "conditional":
+            collected.extend(trailing)
+            trailing = []
+            collected.append(token)
+        elif strings == 2 or (kind == "close" and strings == 0):
+            # Next child (or the end of the block), hand the lookahead back
+            pushback.append(token)
+            pushback.extend(reversed(trailing))
+            if strings == 0:
+                pushback.clear()
+                return None
+            return collected
+        elif kind == "close":
+            raise KeyValuesError(f"Key without a value at offset {token[2]}")
+        elif kind == "open":
+            if strings != 1:
+                raise KeyValuesError(f"Block without a key at offset {token[2]}")
+            collected.append(token)
+            nesting = 1
+        else:
+            collected.append(token)
+            strings += 1
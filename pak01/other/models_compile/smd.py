@@ -0,0 +1,248 @@
+import sys
+import json
+import math
+import subprocess
+
+# Try to import numpy, install if not present
+try:
+    import numpy as np
+except ImportError:
+    print("numpy package not found. Installing...")
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "numpy"])
+    import numpy as np
+    print("numpy installed successfully!")
+
+# Streaming SMD transformer. The file is read line by line and the data lines of each
+# section are transformed in fixed size batches, so memory stays flat no matter how
+# many frames an animation has.
+#
+# Vertices (triangles and vertexanimation) are in model space and take the full matrix.
+# Skeleton bones are stored relative to their parent, so only root bones (parent -1)
+# take the matrix, child bones only take its scale.
+
+BATCH_LINES = 65536
+SECTIONS = ('nodes', 'skeleton', 'triangles', 'vertexanimation')
+
+def rotation_matrix(x_degrees=0, y_degrees=0, z_degrees=0):
+    """4x4 rotation, X first, then Y, then Z."""
+    cx, sx = math.cos(math.radians(x_degrees)), math.sin(math.radians(x_degrees))
+    cy, sy = math.cos(math.radians(y_degrees)), math.sin(math.radians(y_degrees))
+    cz, sz = math.cos(math.radians(z_degrees)), math.sin(math.radians(z_degrees))
+    rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    matrix = np.eye(4)
+    matrix[:3, :3] = rz @ ry @ rx
+    return matrix
+
+def build_matrix(scale=1.0, rotate=(0, 0, 0), translate=(0, 0, 0)):
+    """Scale, then rotate (degrees around X, Y, Z), then translate, as one 4x4 matrix."""
+    scale_matrix = np.diag([scale, scale, scale, 1.0])
+    move = np.eye(4)
+    move[:3, 3] = translate
+    return move @ rotation_matrix(*rotate) @ scale_matrix
+
+def load_preset(path):
+    """A JSON preset is either {"matrix": 4x4 rows} or {"scale", "rotate": [x, y, z], "translate": [x, y, z]}."""
+    with open(path, 'r') as f:
+        preset = json.load(f)
+    if 'matrix' in preset:
+        return parse_matrix(preset['matrix'])
+    return build_matrix(preset.get('scale', 1.0), preset.get('rotate', (0, 0, 0)), preset.get('translate', (0, 0, 0)))
+
+def parse_matrix(values):
+    """16 numbers, row major, from a string or (nested) list."""
+    if isinstance(values, str):
+        values = values.replace(',', ' ').split()
+    matrix = np.array(values, dtype=np.float64).reshape(4, 4)
+    if not np.allclose(matrix[3], [0, 0, 0, 1]):
+        raise ValueError("The last row of the matrix must be 0 0 0 1")
+    return matrix
+
+def euler_to_matrices(angles):
+    """(n, 3) SMD euler angles in radians to (n, 3, 3) rotation matrices (Rz @ Ry @ Rx)."""
+    cx, cy, cz = np.cos(angles).T
+    sx, sy, sz = np.sin(angles).T
+    m = np.empty((len(angles), 3, 3))
+    m[:, 0, 0] = cy * cz
+    m[:, 0, 1] = sx * sy * cz - cx * sz
+    m[:, 0, 2] = cx * sy * cz + sx * sz
+    m[:, 1, 0] = cy * sz
+    m[:, 1, 1] = sx * sy * sz + cx * cz
+    m[:, 1, 2] = cx * sy * sz - sx * cz
+    m[:, 2, 0] = -sy
+    m[:, 2, 1] = sx * cy
+    m[:, 2, 2] = cx * cy
+    return m
+
+def matrices_to_euler(m):
+    sy = np.clip(-m[:, 2, 0], -1.0, 1.0)
+    y = np.arcsin(sy)
+    gimbal = np.abs(sy) > 1 - 1e-9
+    x = np.where(gimbal, np.arctan2(-m[:, 1, 2], m[:, 1, 1]), np.arctan2(m[:, 2, 1], m[:, 2, 2]))
+    z = np.where(gimbal, 0.0, np.arctan2(m[:, 1, 0], m[:, 0, 0]))
+    return np.stack((x, y, z), axis=1)
+
+class SMDTransform:
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        linear = self.matrix[:3, :3]
+        # Normals take the inverse transpose of the linear part, renormalized after
+        self.normal_matrix = np.linalg.inv(linear).T
+
+        # Bones can only follow a rotation with uniform scale, anything else can't be put in a skeleton
+        det = np.linalg.det(linear)
+        self.bone_scale = abs(det) ** (1 / 3)
+        self.bone_rotation = linear / self.bone_scale
+        self.similarity = det > 0 and np.allclose(self.bone_rotation @ self.bone_rotation.T, np.eye(3), atol=1e-6)
+
+    def vertices(self, values):
+        """(n, 6) x y z nx ny nz, transformed."""
+        positions = values[:, :3] @ self.matrix[:3, :3].T + self.matrix[:3, 3]
+        normals = values[:, 3:] @ self.normal_matrix.T
+        # The inverse transpose only gets the direction right, each normal keeps the length it had
+        # (so a normal the matrix doesn't turn comes out as it went in)
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        old_lengths = np.linalg.norm(values[:, 3:], axis=1, keepdims=True)
+        normals = np.multiply(normals, np.divide(old_lengths, lengths, out=np.zeros_like(lengths), where=lengths > 0),
+                              out=normals)
+        return np.hstack((positions, normals))
+
+    def bones(self, values, is_root):
+        """(n, 6) x y z rx ry rz bone transforms, is_root marks the bones without a parent."""
+        if not self.similarity:
+            raise ValueError("Skeletons can only be rotated, moved and scaled uniformly, not sheared or mirrored")
+        out = values.copy()
+        out[:, :3] *= self.bone_scale
+        if is_root.any():
+            roots = values[is_root]
+            out[is_root, :3] = roots[:, :3] @ self.matrix[:3, :3].T + self.matrix[:3, 3]
+            out[is_root, 3:] = matrices_to_euler(self.bone_rotation @ euler_to_matrices(roots[:, 3:]))
+        return out
+
+def split_table(lines, columns_min):
+    """Split lines into an (n, columns) array of strings with a single str.split().
+
+    Works when every line has the same number of columns, which is the usual case (one
+    link count per file). Returns None otherwise so the caller splits line by line.
+    """
+    tokens = "".join(lines).split()
+    columns = len(lines[0].split())
+    if columns < columns_min or len(tokens) != columns * len(lines):
+        return None
+    table = np.array(tokens, dtype=object).reshape(-1, columns)
+    if columns_min == 9 and columns > 9:
+        # The link count says how many columns a vertex has, so a mix of lengths can't slip through
+        if (columns - 10) % 2 or not (table[:, 9].astype(np.int64) == (columns - 10) // 2).all():
+            return None
+    elif columns != columns_min:
+        return None
+    return table
+
+def format_rows(table, indent):
+    """Write the table back with the 6 transformed columns as %.6f, using one % for the whole batch."""
+    line_format = indent + "%s" + " %.6f" * 6 + " %s" * (table.shape[1] - 7) + "\n"
+    return (line_format * len(table)) % tuple(table.ravel().tolist())
+
+def clean_zeros(new_values, values):
+    """Make results that print as 0.000000 carry the sign of the value they came from, in place.
+
+    Rotating a 0 gives -0.0 or something like -1e-17, which %.6f prints as -0.000000.
+    """
+    zero = np.abs(new_values) < 5e-7
+    new_values[zero] = np.where(np.abs(values[zero]) < 5e-7, np.copysign(0.0, values[zero]), 0.0)
+    return new_values
+
+def transform_rows(lines, transform_values, columns_min, indent):
+    """Transform columns 1-6 of data lines like 'index a b c d e f [...]'."""
+    table = split_table(lines, columns_min)
+    if table is None:
+        rows = [line.split() for line in lines]
+        if any(len(row) < columns_min for row in rows):
+            raise ValueError("Malformed line: " + next(l for l, r in zip(lines, rows) if len(r) < columns_min).strip())
+        values = np.array([row[1:7] for row in rows], dtype=np.float64)
+        new_values = clean_zeros(transform_values(values), values).tolist()
+        return "".join(indent + row[0] + "".join(" %.6f" % v for v in new) + "".join(" " + c for c in row[7:]) + "\n"
+                       for row, new in zip(rows, new_values))
+    values = table[:, 1:7].astype(np.float64)
+    table[:, 1:7] = clean_zeros(transform_values(values), values)
+    return format_rows(table, indent)
+
+class SMDWriter:
+    """Transforms an SMD while it's being read, section by section."""
+
+    def __init__(self, dst, transform):
+        self.dst = dst
+        self.transform = transform
+        self.roots = set()
+        self.section = None
+        self.pending = []  # data lines (and skeleton 'time' lines) waiting for the next batch
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.section == 'triangles':
+            self.flush_triangles()
+        elif self.section == 'skeleton':
+            self.flush_frames(self.flush_bones)
+        elif self.section == 'vertexanimation':
+            self.flush_frames(lambda lines: transform_rows(lines, self.transform.vertices, 7, "  "))
+        self.pending = []
+
+    def flush_triangles(self):
+        # Every 4th line is a material name, the others are bone x y z nx ny nz u v [links bone weight ...]
+        vertex_lines = [line for i, line in enumerate(self.pending) if i % 4]
+        vertices = transform_rows(vertex_lines, self.transform.vertices, 9, "  ").splitlines(keepends=True)
+        out = iter(vertices)
+        self.dst.write("".join(line if i % 4 == 0 else next(out) for i, line in enumerate(self.pending)))
+
+    def flush_frames(self, transform_lines):
+        # 'time N' lines stay where they are, the data lines around them go through in one batch
+        data = [line for line in self.pending if not line.lstrip().startswith('time')]
+        out = iter(transform_lines(data).splitlines(keepends=True) if data else [])
+        self.dst.write("".join(line if line.lstrip().startswith('time') else next(out) for line in self.pending))
+
+    def flush_bones(self, lines):
+        bones = [line.split(None, 1)[0] for line in lines]
+        is_root = np.array([bone in self.roots for bone in bones], dtype=bool)
+        return transform_rows(lines, lambda values: self.transform.bones(values, is_root), 7, "  ")
+
+    def write(self, line):
+        stripped = line.strip()
+        if self.section is None:
+            if stripped in SECTIONS:
+                self.section = stripped
+            self.dst.write(line)
+            return
+
+        if stripped == 'end':
+            self.flush()
+            self.section = None
+            self.dst.write(line)
+        elif not stripped:
+            if self.section != 'triangles':
+                self.dst.write(line)
+        elif self.section == 'nodes':
+            # id "name" parent
+            parts = line.rsplit(None, 1)
+            if parts[-1] == '-1':
+                self.roots.add(line.split(None, 1)[0])
+            self.dst.write(line)
+        else:
+            self.pending.append(line)
+            # Triangles are flushed on a whole triangle so material lines stay every 4th line
+            if len(self.pending) >= BATCH_LINES and (self.section != 'triangles' or len(self.pending) % 4 == 0):
+                self.flush()
+
+    def close(self):
+        if self.section is not None and self.pending:
+            raise ValueError(f"{self.section} section has no end")
+
+def transform_smd(input_file, output_file, matrix):
+    """Apply a 4x4 matrix to a reference or animation SMD, streaming from input_file to output_file."""
+    transform = SMDTransform(matrix)
+    with open(input_file, 'r') as src, open(output_file, 'w') as dst:
+        writer = SMDWriter(dst, transform)
+        for line in src:
+            writer.write(line)
+        writer.close()
@@ -0,0 +1,191 @@
+import os
+import queue
+import multiprocessing
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import compress_policy
+import instrument
+import release_manifest
+import vpk_file
+
+# The vpk.py build as one in-process pipeline:
+#
+#   scan + hash  ->  pack  ->  compress  ->  release manifest
+#
+# Every stage runs on its own thread and hands its results to the next one through a
+# bounded queue, so hashing, writing chunks and compressing them overlap instead of each
+# waiting for the whole previous step. The hash stage passes one folder of entries at a
+# time, the pack stage passes every chunk as soon as it's on disk, and compression starts
+# on the first chunk while the later ones are still being written.
+#
+# The stable layout needs every hash before it can decide which old chunks to keep, so with
+# it packing starts after hashing; chunks still go to compression one by one.
+
+DEFAULT_QUEUE_SIZE = 8
+END = object()
+
+class PipelineAborted(Exception):
+    """Another stage failed, this one stops without reporting an error of its own."""
+
+    def __init__(self):
+        super().__init__("stopped because another stage failed")
+
+class Channel:
+    """Bounded queue between two stages, both ends give up once the pipeline is aborted."""
+
+    def __init__(self, abort, maxsize=DEFAULT_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize)
+        self.abort = abort
+
+    def put(self, item):
+        while True:
+            if self.abort.is_set():
+                raise PipelineAborted()
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        self.put(END)
+
+    def __iter__(self):
+        while True:
+            if self.abort.is_set():
+                raise PipelineAborted()
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is END:
+                return
+            yield item
+
+class BuildPipeline:
+    def __init__(self, processor, dest_dir=None, options=None, queue_size=DEFAULT_QUEUE_SIZE):
+        """processor is vpk.AssetProcessor, archives and the release manifest go to dest_dir (None skips compression)."""
+        self.processor = processor
+        self.dest_dir = dest_dir
+        self.options = options or {}
+        self.abort = threading.Event()
+        self.errors = []
+        self.hashed = Channel(self.abort, queue_size)  # [VPKEntry] per folder
+        self.packed = Channel(self.abort, queue_size)  # (path, asset mix or None) of every finished .vpk
+
+    def hash_stage(self):
+        processor = self.processor
+        processor.create_kv_file()
+        for _, files, md5s in processor.iter_folders():
+            self.hashed.put([vpk_file.VPKEntry(vpk_file.normalize_path(rel_path), file_path, md5=md5_hash)
+                             for (file_path, rel_path), md5_hash in zip(files, md5s)])
+        self.hashed.close()
+
+    def chunk_packed(self, path, chunk_entries):
+        # The chunk's asset mix goes along, the _dir.vpk describing it isn't written until the end
+        self.packed.put((path, compress_policy.entries_mix(chunk_entries) if chunk_entries else None))
+
+    def pack_stage(self):
+        processor = self.processor
+        entries = (entry for batch in self.hashed for entry in batch)
+        if processor.packer == "native":
+            packed = processor.pack_native(entries, on_chunk=self.chunk_packed)
+        else:
+            # vpk.exe reads the finished kv file, so it has to wait for every hash
+            for _ in entries:
+                pass
+            packed = processor.run_vpk_exe()
+            if packed:
+                for filename in sorted(os.listdir(".")):
+                    if filename.startswith(f"{processor.input_folder}_") and filename.endswith(".vpk"):
+                        self.packed.put((filename, None))
+        if self.abort.is_set():
+            raise PipelineAborted()
+        if not packed:
+            raise RuntimeError("Packing failed")
+        with instrument.span("backup_kv"):
+            processor.backup_kv_file()
+        self.packed.close()
+
+    def compress_stage(self):
+        if not self.dest_dir:
+            for _ in self.packed:
+                pass
+            return
+
+        import vpk_compress
+        directory = os.getcwd()
+        vpk_compress.create_directory_if_not_exists(self.dest_dir)
+        manifest = release_manifest.load_manifest(self.dest_dir)
+        threads = self.options.get("threads", 1)
+        workers = self.options.get("workers") or vpk_compress.default_workers(threads)
+        print(f"Compressing with {workers} processes x {threads} threads as chunks are packed")
+
+        timer = instrument.PoolTimer("compress_vpk", workers, label=lambda job: job[0])
+        submitted = set()
+        futures = []
+        # Workers are started while the hash and pack threads run, a forked one could inherit a lock
+        # one of them holds (stdout, the instrument recorder) and hang, so they're spawned fresh
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            def submit(filename, asset_mix=None):
+                submitted.add(filename)
+                job = (filename, directory, self.dest_dir, self.options, manifest.get(filename), asset_mix)
+                futures.append(timer.submit(executor, vpk_compress.process_single_vpk, job))
+
+            for path, asset_mix in self.packed:
+                submit(os.path.basename(path), asset_mix)
+            # Chunks the stable layout kept as they were, and any other VPK next to them like vpk_compress does.
+            # The new _dir.vpk is finished by now, these read their asset mix from it
+            for filename in sorted(f for f in os.listdir(directory) if f.endswith(".vpk")):
+                if filename not in submitted:
+                    submit(filename)
+
+            files = {}
+            for future in futures:
+                filename, entry = timer.result(future)
+                if entry:
+                    files[filename] = entry
+        timer.finish()
+
+        # Failed VPKs are left out so the next run retries them
+        release_manifest.save_manifest(self.dest_dir, files)
+
+    def start_stage(self, name, target):
+        def run():
+            try:
+                with instrument.span(name):
+                    target()
+            except PipelineAborted:
+                pass
+            except Exception:
+                self.errors.append((name, traceback.format_exc()))
+                self.abort.set()
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        """Run every stage, returns False (after printing why) if one of them failed."""
+        stages = [self.start_stage("hash", self.hash_stage), self.start_stage("pack", self.pack_stage)]
+        try:
+            with instrument.span("compress" if self.dest_dir else "wait"):
+                self.compress_stage()
+        except PipelineAborted:
+            pass
+        except Exception:
+            self.errors.append(("compress", traceback.format_exc()))
+            self.abort.set()
+        except BaseException:
+            # Ctrl+C, stop the other stages before going down
+            self.abort.set()
+            raise
+        finally:
+            for stage in stages:
+                stage.join()
+
+        for name, error in self.errors:
+            print(f"\nERROR in the {name} stage:\n{error}")
+        return not self.errors
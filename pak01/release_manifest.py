@@ -0,0 +1,38 @@
+import os
+import json
+import datetime
+
+# release_manifest.json, written by vpk_compress next to the archives and read by
+# vpk_decompress --verify on the player's side:
+# {"version", "created", "files": {vpk name: {"source_md5", "source_size", "archive", "volumes", ...}}}
+
+MANIFEST_NAME = "release_manifest.json"
+MANIFEST_VERSION = 1
+
+def load_manifest(dest_dir):
+    manifest_path = os.path.join(dest_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest.get("files", {})
+        print(f"Ignoring {MANIFEST_NAME} with unknown version {manifest.get('version')}")
+    except Exception as e:
+        print(f"Error reading {manifest_path}: {e}")
+    return {}
+
+def save_manifest(dest_dir, files):
+    # Written to a temp file and swapped in, so readers never see a half written manifest
+    manifest_path = os.path.join(dest_dir, MANIFEST_NAME)
+    tmp_path = manifest_path + ".tmp"
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "files": dict(sorted(files.items())),
+    }
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    print(f"Wrote {manifest_path}")
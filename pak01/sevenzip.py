@@ -0,0 +1,264 @@
+import os
+import lzma
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Minimal 7z writer for a single file per archive. py7zr compresses on one thread,
+# this compresses LZMA2 blocks in parallel and stitches them into one stream the way
+# 7-Zip's own multithreaded LZMA2 mode does, so the output opens in 7-Zip/py7zr as usual.
+
+SIGNATURE = b"7z\xbc\xaf\x27\x1c"
+FORMAT_VERSION = (0, 4)
+SIGNATURE_HEADER_SIZE = 32
+
+# Property ids
+K_END = 0x00
+K_HEADER = 0x01
+K_MAIN_STREAMS_INFO = 0x04
+K_FILES_INFO = 0x05
+K_PACK_INFO = 0x06
+K_UNPACK_INFO = 0x07
+K_SIZE = 0x09
+K_CRC = 0x0A
+K_FOLDER = 0x0B
+K_CODERS_UNPACK_SIZE = 0x0C
+K_SUBSTREAMS_INFO = 0x08
+K_NAME = 0x11
+K_MTIME = 0x14
+
+# Coder ids
+CODER_COPY = b"\x00"
+CODER_DELTA = b"\x03"
+CODER_BCJ_X86 = b"\x03\x03\x01\x03"
+CODER_LZMA2 = b"\x21"
+CODER_ZSTD = b"\x04\xf7\x11\x01"
+
+DEFAULT_BLOCK_SIZE = 32 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+# liblzma's dictionary size for presets 0-9
+PRESET_DICT_SIZES = [256 << 10, 1 << 20, 2 << 20, 4 << 20, 4 << 20, 8 << 20, 8 << 20, 16 << 20, 32 << 20, 64 << 20]
+FILETIME_EPOCH = 116444736000000000  # 1970-01-01 in 100ns ticks since 1601
+
+def write_number(value):
+    """7z variable length integer: leading 1 bits of the first byte count the extra bytes."""
+    for extra in range(8):
+        if value < (1 << (7 * (extra + 1))):
+            first = ((0xFF << (8 - extra)) & 0xFF) | (value >> (8 * extra))
+            return bytes([first]) + (value & ((1 << (8 * extra)) - 1)).to_bytes(extra, "little")
+    return b"\xff" + value.to_bytes(8, "little")
+
+def lzma2_dict_size_prop(dict_size):
+    for prop in range(40):
+        if ((2 | (prop & 1)) << (prop // 2 + 11)) >= dict_size:
+            return prop
+    return 40
+
+def lzma2_filter(preset, dict_size=None):
+    lzma2 = {"id": lzma.FILTER_LZMA2, "preset": preset}
+    if dict_size:
+        lzma2["dict_size"] = dict_size
+    return lzma2
+
+def pre_filter(spec):
+    """(liblzma filter, 7z coder) for a filter run in front of LZMA2: "delta:<distance>" or "x86" (BCJ)."""
+    name, _, arg = spec.partition(":")
+    if name == "delta":
+        dist = int(arg or 1)
+        return {"id": lzma.FILTER_DELTA, "dist": dist}, (CODER_DELTA, bytes([dist - 1]))
+    if name == "x86":
+        return {"id": lzma.FILTER_X86}, (CODER_BCJ_X86, b"")
+    raise ValueError(f"Unknown filter {spec}")
+
+def compress_lzma2_block(data, filters):
+    # Each raw LZMA2 stream starts with a dictionary reset, dropping the end marker lets them be chained
+    compressed = lzma.compress(data, format=lzma.FORMAT_RAW, filters=filters)
+    return compressed[:-1]
+
+def iter_blocks(src, block_size, on_read=None):
+    while True:
+        block = src.read(block_size)
+        if not block:
+            return
+        if on_read:
+            on_read(block)
+        yield block
+
+class CompressResult:
+    __slots__ = ("unpack_size", "pack_size", "crc", "coders")
+
+    def __init__(self, unpack_size, pack_size, crc, coders):
+        self.unpack_size = unpack_size
+        self.pack_size = pack_size
+        self.crc = crc
+        self.coders = coders
+
+def compress_lzma2_stream(src, out, preset=9, dict_size=None, threads=1, block_size=DEFAULT_BLOCK_SIZE,
+                          on_read=None):
+    """Compress src into out as one LZMA2 stream made of independently compressed blocks."""
+    # No point in a dictionary bigger than a block
+    dict_size = min(dict_size or PRESET_DICT_SIZES[preset & 0x1F], block_size)
+    filters = [lzma2_filter(preset, dict_size)]
+    unpack_size = 0
+    pack_size = 0
+    crc = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        pending = []
+        for block in iter_blocks(src, block_size, on_read):
+            crc = zlib.crc32(block, crc)
+            unpack_size += len(block)
+            pending.append(executor.submit(compress_lzma2_block, block, filters))
+            # Keep a bounded number of blocks in flight and write them back in order
+            while len(pending) > threads:
+                data = pending.pop(0).result()
+                out.write(data)
+                pack_size += len(data)
+        for future in pending:
+            data = future.result()
+            out.write(data)
+            pack_size += len(data)
+
+    out.write(b"\x00")  # LZMA2 end marker
+    pack_size += 1
+    return CompressResult(unpack_size, pack_size, crc, [(CODER_LZMA2, bytes([lzma2_dict_size_prop(dict_size)]))])
+
+def compress_lzma2_solid(src, out, preset=9, dict_size=None, filters=(), on_read=None):
+    """Compress src into out as a single LZMA2 stream on one thread, behind the given pre_filter specs.
+
+    Delta and BCJ carry their state across the whole input, so unlike compress_lzma2_stream
+    this can't be cut into blocks compressed in parallel.
+    """
+    dict_size = dict_size or PRESET_DICT_SIZES[preset & 0x1F]
+    chain = [pre_filter(spec) for spec in filters]
+    compressor = lzma.LZMACompressor(format=lzma.FORMAT_RAW,
+                                     filters=[f for f, _ in chain] + [lzma2_filter(preset, dict_size)])
+    unpack_size = 0
+    pack_size = 0
+    crc = 0
+    for block in iter_blocks(src, READ_SIZE, on_read):
+        crc = zlib.crc32(block, crc)
+        unpack_size += len(block)
+        data = compressor.compress(block)
+        out.write(data)
+        pack_size += len(data)
+    data = compressor.flush()  # ends with the LZMA2 end marker
+    out.write(data)
+    pack_size += len(data)
+    # 7z lists the coders from the packed side: LZMA2 first, then the filters that undo the rest
+    coders = [(CODER_LZMA2, bytes([lzma2_dict_size_prop(dict_size)]))] + [coder for _, coder in reversed(chain)]
+    return CompressResult(unpack_size, pack_size, crc, coders)
+
+def copy_stream(src, out, on_read=None):
+    """Store src uncompressed, for content no codec shrinks enough to be worth the time."""
+    size = 0
+    crc = 0
+    for block in iter_blocks(src, READ_SIZE, on_read):
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+        out.write(block)
+    return CompressResult(size, size, crc, [(CODER_COPY, b"")])
+
+def compress_zstd_stream(src, out, level=3, threads=1, long_distance=True, on_read=None):
+    try:
+        from compression import zstd
+    except ImportError:
+        from backports import zstd  # installed alongside py7zr
+
+    options = {zstd.CompressionParameter.compression_level: level}
+    if threads > 1:
+        options[zstd.CompressionParameter.nb_workers] = threads
+    if long_distance:
+        options[zstd.CompressionParameter.enable_long_distance_matching] = True
+    compressor = zstd.ZstdCompressor(options=options)
+
+    unpack_size = 0
+    pack_size = 0
+    crc = 0
+    for block in iter_blocks(src, READ_SIZE, on_read):
+        crc = zlib.crc32(block, crc)
+        unpack_size += len(block)
+        data = compressor.compress(block)
+        out.write(data)
+        pack_size += len(data)
+    data = compressor.flush()
+    out.write(data)
+    pack_size += len(data)
+
+    props = struct.pack("BBBBB", zstd.zstd_version_info[0], zstd.zstd_version_info[1], level, 0, 0)
+    return CompressResult(unpack_size, pack_size, crc, [(CODER_ZSTD, props)])
+
+def build_header(result, name, mtime):
+    h = bytearray()
+    h += bytes([K_HEADER, K_MAIN_STREAMS_INFO])
+
+    h += bytes([K_PACK_INFO]) + write_number(0) + write_number(1)
+    h += bytes([K_SIZE]) + write_number(result.pack_size)
+    h += bytes([K_END])
+
+    h += bytes([K_UNPACK_INFO, K_FOLDER]) + write_number(1) + b"\x00"
+    h += write_number(len(result.coders))
+    for coder_id, props in result.coders:
+        h += bytes([len(coder_id) | (0x20 if props else 0)]) + coder_id
+        if props:
+            h += write_number(len(props)) + props
+    # Chain the coders: coder i+1 reads what coder i outputs, the first one reads the packed stream
+    for i in range(len(result.coders) - 1):
+        h += write_number(i + 1) + write_number(i)
+    h += bytes([K_CODERS_UNPACK_SIZE])
+    for _ in result.coders:
+        h += write_number(result.unpack_size)
+    h += bytes([K_END])
+
+    # One file per folder, so only its CRC needs listing
+    h += bytes([K_SUBSTREAMS_INFO, K_CRC, 1]) + struct.pack("<I", result.crc)
+    h += bytes([K_END])
+    h += bytes([K_END])
+
+    h += bytes([K_FILES_INFO]) + write_number(1)
+    name_bytes = b"\x00" + name.encode("utf-16-le") + b"\x00\x00"
+    h += bytes([K_NAME]) + write_number(len(name_bytes)) + name_bytes
+    filetime = int(mtime * 10_000_000) + FILETIME_EPOCH
+    h += bytes([K_MTIME]) + write_number(10) + b"\x01\x00" + struct.pack("<Q", filetime)
+    h += bytes([K_END])
+
+    h += bytes([K_END])
+    return bytes(h)
+
+def write_archive(input_path, out, codec="lzma2", level=9, threads=1, block_size=DEFAULT_BLOCK_SIZE,
+                  dict_size=None, arcname=None, on_read=None, filters=(), solid=False):
+    """Compress input_path into a .7z written to out (a seekable binary file object).
+
+    codec is lzma2, zstd or copy. filters (pre_filter specs) or solid=True make lzma2
+    one stream on a single thread instead of blocks compressed in parallel.
+
+    on_read is called with every block read from input_path, so the caller can hash
+    the source on the same pass. Returns the CompressResult for the packed stream.
+    """
+    arcname = arcname or os.path.basename(input_path)
+    start = out.tell()
+    out.write(b"\x00" * SIGNATURE_HEADER_SIZE)  # filled in once the header offset is known
+
+    with open(input_path, "rb") as src:
+        if codec == "lzma2" and (filters or solid):
+            result = compress_lzma2_solid(src, out, level, dict_size, filters, on_read)
+        elif codec == "lzma2":
+            result = compress_lzma2_stream(src, out, level, dict_size, threads, block_size, on_read)
+        elif codec == "zstd":
+            result = compress_zstd_stream(src, out, level, threads, on_read=on_read)
+        elif codec == "copy":
+            result = copy_stream(src, out, on_read)
+        else:
+            raise ValueError(f"Unknown codec {codec}")
+
+    header = build_header(result, arcname, os.path.getmtime(input_path))
+    out.write(header)
+    end = out.tell()
+
+    next_header = struct.pack("<QQI", result.pack_size, len(header), zlib.crc32(header))
+    signature_header = (SIGNATURE + bytes(FORMAT_VERSION) +
+                        struct.pack("<I", zlib.crc32(next_header)) + next_header)
+    out.seek(start)
+    out.write(signature_header)
+    out.seek(end)
+    return result
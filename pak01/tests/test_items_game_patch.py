@@ -0,0 +1,35 @@
+import items_game_patch
+import keyvalues
+
+OLD = '''"items_game"
+{
+	"items"
+	{
+		"1"		"a"
+		"3"		"c"
+		"2"		"b"
+	}
+}
+'''
+
+NEW = '''"items_game"
+{
+	"items"
+	{
+		"0"		"new first"
+		"1"		"a"
+		"2"		"b"
+		"3"		"c"
+		"4"		"new last"
+	}
+}
+'''
+
+def test_patch_keeps_target_child_order():
+    ops = []
+    items_game_patch.diff_blocks(keyvalues.loads(OLD), keyvalues.loads(NEW), [], 0, ops)
+
+    doc = keyvalues.loads(OLD)
+    applied, skipped, conflicts = items_game_patch.apply_patch(doc, {"ops": ops})
+    assert conflicts == []
+    assert keyvalues.dumps(doc) == NEW
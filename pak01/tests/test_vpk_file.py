@@ -0,0 +1,40 @@
+import os
+
+import vpk_archive
+import vpk_file
+
+def make_entries(src_dir, files):
+    entries = []
+    for path, data in files.items():
+        src_path = os.path.join(src_dir, path)
+        os.makedirs(os.path.dirname(src_path), exist_ok=True)
+        with open(src_path, "wb") as f:
+            f.write(data)
+        entries.append(vpk_file.VPKEntry(path, src_path))
+    return entries
+
+def test_stable_layout_keeps_file_after_empty_one(tmp_path):
+    src_dir = str(tmp_path / "src")
+    out_dir = str(tmp_path / "out")
+    os.makedirs(out_dir)
+    files = {
+        "scripts/a.txt": b"first file " * 100,
+        "scripts/empty.txt": b"",
+        "scripts/next.txt": b"stored right after the empty one " * 100,
+    }
+    vpk_file.VPKWriter("pak01", out_dir, stable_layout=True).write(make_entries(src_dir, files))
+
+    # Everything is unchanged, so the rebuild keeps every file where it was without compacting
+    writer = vpk_file.VPKWriter("pak01", out_dir, stable_layout=True)
+    dir_path = os.path.join(out_dir, "pak01_dir.vpk")
+    assert writer.plan_stable_layout(make_entries(src_dir, files), dir_path) == ({}, {0})
+    assert writer.duplicates == []
+
+    writer = vpk_file.VPKWriter("pak01", out_dir, stable_layout=True, compact_threshold=1.0)
+    writer.write(make_entries(src_dir, files))
+    assert writer.duplicates == []
+
+    with vpk_archive.VPKArchive(dir_path) as archive:
+        for path, data in files.items():
+            assert archive.check(path), path
+            assert archive.read(path) == data
@@ -0,0 +1,35 @@
+import os
+import random
+
+import vpk_file
+import vpk_patch
+
+def build_release(release_dir, files):
+    entries = []
+    for path, data in files.items():
+        src_path = os.path.join(release_dir, "src", path)
+        os.makedirs(os.path.dirname(src_path), exist_ok=True)
+        with open(src_path, "wb") as f:
+            f.write(data)
+        entries.append(vpk_file.VPKEntry(path, src_path))
+    vpk_file.VPKWriter("pak01", release_dir).write(entries)
+
+def test_insertion_mid_file_is_copied_around(tmp_path):
+    rng = random.Random(1)
+    old_data = rng.randbytes(300_000)
+    new_data = old_data[:123_457] + b"inserted in the middle" + old_data[123_457:]
+    other = rng.randbytes(50_000)
+
+    old_dir, new_dir, out_dir = (str(tmp_path / name) for name in ("old", "new", "patch"))
+    build_release(old_dir, {"models/big.mdl": old_data, "models/other.mdl": other})
+    build_release(new_dir, {"models/big.mdl": new_data, "models/other.mdl": other})
+
+    manifest = vpk_patch.generate_patches(old_dir, new_dir, out_dir)
+    info = manifest["files"]["pak01_000.vpk"]
+    # Random data doesn't compress, only matching past the shifted bytes keeps the delta small
+    assert info["delta_size"] < 2 * vpk_patch.BLOCK_SIZE
+
+    out_path = str(tmp_path / "patched.vpk")
+    assert vpk_patch.apply_delta(os.path.join(out_dir, info["delta"]), old_dir, out_path) == info["target_md5"]
+    with open(out_path, "rb") as patched, open(os.path.join(new_dir, "pak01_000.vpk"), "rb") as target:
+        assert patched.read() == target.read()
@@ -0,0 +1,224 @@
+import io
+import os
+import re
+import bisect
+
+import hashing
+
+DEFAULT_VOLUME_SIZE_MB = 95  # keeps every volume under 100 MB
+
+def volume_path(base_path, index):
+    return f"{base_path}.{index + 1:03d}"
+
+def find_volumes(base_path):
+    """Return the existing base_path.001, .002, ... in order."""
+    directory = os.path.dirname(base_path) or "."
+    pattern = re.compile(rf"^{re.escape(os.path.basename(base_path))}\.(\d{{3}})$")
+    numbered = []
+    for filename in os.listdir(directory):
+        match = pattern.match(filename)
+        if match:
+            numbered.append((int(match.group(1)), os.path.join(directory, filename)))
+    return [path for _, path in sorted(numbered)]
+
+def remove_volumes(base_path):
+    for path in find_volumes(base_path):
+        os.remove(path)
+
+class VolumeWriter:
+    """Seekable write-only file object that spreads its data over base_path.001, .002, ...
+
+    volume_size None writes a single file at base_path instead. Each volume is hashed while
+    it's written. The first patch_size bytes may be written again at the end (the 7z signature
+    header), so only those are kept in memory and the first volume is hashed on close, from
+    them and the rest of the file on disk. Any other volume written out of order is rehashed
+    once on close.
+    """
+
+    def __init__(self, base_path, volume_size, algorithm=hashing.DEFAULT_ALGORITHM, patch_size=0):
+        self.base_path = base_path
+        self.volume_size = volume_size
+        self.algorithm = algorithm
+        self.patch_size = patch_size
+        self.head = bytearray() if patch_size else None  # the first patch_size bytes, while they can still change
+        self.pos = 0
+        self.end = 0
+        self.current = None
+        self.current_index = None
+        self.hashers = {}  # index -> [hasher, bytes hashed so far]
+        self.dirty = set()
+        self.closed = False
+
+    def path(self, index):
+        return self.base_path if self.volume_size is None else volume_path(self.base_path, index)
+
+    def _switch(self, index):
+        if self.current_index == index:
+            return
+        if self.current:
+            self.current.close()
+        path = self.path(index)
+        if index in self.hashers:
+            self.current = open(path, "r+b")
+        else:
+            self.current = open(path, "wb")
+            self.hashers[index] = [hashing.new_hasher(self.algorithm), 0]
+        self.current_index = index
+
+    def write(self, data):
+        view = memoryview(data).cast("B")
+        written = len(view)
+        while view:
+            if self.volume_size is None:
+                index, offset, take = 0, self.pos, len(view)
+            else:
+                index, offset = divmod(self.pos, self.volume_size)
+                take = min(len(view), self.volume_size - offset)
+            self._switch(index)
+            if self.current.tell() != offset:
+                self.current.seek(offset)
+            self.current.write(view[:take])
+
+            state = self.hashers[index]
+            if index == 0 and self.head is not None:
+                # Hashed on close, only the header needs remembering
+                if offset < self.patch_size:
+                    if offset > len(self.head):
+                        self.head = None
+                        self.dirty.add(index)
+                    else:
+                        n = min(take, self.patch_size - offset)
+                        self.head[offset:offset + n] = view[:n]
+            elif index not in self.dirty and state[1] == offset:
+                state[0].update(view[:take])
+                state[1] += take
+            else:
+                self.dirty.add(index)
+
+            self.pos += take
+            self.end = max(self.end, self.pos)
+            view = view[take:]
+        return written
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.end
+        self.pos = offset
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def close(self):
+        """Close the last volume and return [(path, size, hexdigest)] for every volume."""
+        if self.closed:
+            return self.volumes
+        if self.current:
+            self.current.close()
+            self.current = None
+        self.closed = True
+
+        self.volumes = []
+        for index in sorted(self.hashers):
+            path = self.path(index)
+            if index == 0 and self.head is not None:
+                digest = self._hash_first_volume(path)
+                self.head = None
+            elif index in self.dirty:
+                digest = hashing.hash_file(path, self.algorithm)
+            else:
+                digest = self.hashers[index][0].hexdigest()
+            self.volumes.append((path, os.path.getsize(path), digest))
+        return self.volumes
+
+    def _hash_first_volume(self, path):
+        hasher = hashing.new_hasher(self.algorithm)
+        hasher.update(self.head)
+        with open(path, "rb") as f:
+            f.seek(len(self.head))
+            for block in iter(lambda: f.read(hashing.DEFAULT_BLOCK_SIZE), b""):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class VolumeReader(io.RawIOBase):
+    """Seekable read-only file object that presents base_path.001, .002, ... as one stream."""
+
+    def __init__(self, paths):
+        super().__init__()
+        self.paths = list(paths)
+        if not self.paths:
+            raise FileNotFoundError("No volumes to read")
+        self.starts = []
+        total = 0
+        for path in self.paths:
+            self.starts.append(total)
+            total += os.path.getsize(path)
+        self.size = total
+        self.pos = 0
+        self.current = None
+        self.current_index = None
+
+    def _volume_at(self, pos):
+        return bisect.bisect_right(self.starts, pos) - 1
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        parts = []
+        while size > 0 and self.pos < self.size:
+            index = self._volume_at(self.pos)
+            if self.current_index != index:
+                if self.current:
+                    self.current.close()
+                self.current = open(self.paths[index], "rb")
+                self.current_index = index
+            self.current.seek(self.pos - self.starts[index])
+            data = self.current.read(size)
+            if not data:
+                raise IOError(f"{self.paths[index]} is shorter than expected")
+            parts.append(data)
+            self.pos += len(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if self.current:
+            self.current.close()
+            self.current = None
+        super().close()
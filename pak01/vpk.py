@@ -25,13 +25,90 @@ def install_required_packages():
 install_required_packages()
 
 import os
-import hashlib
 import datetime
 import shutil
 import subprocess
 import argparse
+import json
+import time
 from pathlib import Path
 
+import hashing
+import instrument
+import pipeline
+import vpk_file
+
+class HashCache:
+    """On-disk MD5 cache keyed by relative path + size + mtime_ns (+ inode)."""
+
+    VERSION = 1
+
+    def __init__(self, cache_file, base_dir, use_inode=False):
+        self.cache_file = Path(cache_file)
+        self.base_dir = Path(base_dir)
+        self.use_inode = use_inode
+        self.entries = {}
+        self.by_key = {}
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        self.renamed = 0
+
+    def load(self):
+        if not self.cache_file.exists():
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION and data.get("use_inode") == self.use_inode:
+                self.entries = data.get("files", {})
+            else:
+                print(f"Ignoring {self.cache_file.name} (written with different settings)")
+        except Exception as e:
+            print(f"Error reading {self.cache_file.name}, rehashing everything: {e}")
+            self.entries = {}
+
+        for rel_path, entry in self.entries.items():
+            self.by_key.setdefault(tuple(entry[:3]), []).append(rel_path)
+
+    def _key(self, st):
+        return [st.st_size, st.st_mtime_ns, st.st_ino if self.use_inode else 0]
+
+    def lookup(self, rel_path, st):
+        key = self._key(st)
+        entry = self.entries.get(rel_path)
+        if entry is not None and entry[:3] == key:
+            self.hits += 1
+            return entry[3]
+        return None
+
+    def lookup_renamed(self, st):
+        # A file that was only moved/renamed keeps its inode, so reuse the hash of a cached path
+        # with the same inode, size and mtime that no longer exists on disk. Size and mtime alone
+        # match too many unrelated files (same size textures unpacked from one zip)
+        if not self.use_inode:
+            return None
+        for old_path in self.by_key.get(tuple(self._key(st)), ()):
+            if old_path not in self.seen and not (self.base_dir / old_path).exists():
+                self.renamed += 1
+                return self.entries[old_path][3]
+        return None
+
+    def store(self, rel_path, st, md5_hash):
+        self.entries[rel_path] = self._key(st) + [md5_hash]
+        self.seen.add(rel_path)
+
+    def save(self):
+        deleted = [p for p in self.entries if p not in self.seen]
+        for p in deleted:
+            del self.entries[p]
+
+        tmp_file = self.cache_file.with_name(self.cache_file.name + ".tmp")
+        with open(tmp_file, 'w') as f:
+            json.dump({"version": self.VERSION, "use_inode": self.use_inode, "files": self.entries}, f)
+        os.replace(tmp_file, self.cache_file)
+        return deleted
+
 class AssetProcessor:
     def check_and_create_move_dir(self, move_dir):
         if move_dir:
@@ -60,33 +137,46 @@ class AssetProcessor:
 
     def kv_to_current(self, move_dir):
         move_path = Path(move_dir)
-        bak_file = move_path / f"{self.input_folder}.kv.txt.bak"
-        if bak_file.exists():
-            try:
-                shutil.move(str(bak_file), f"{self.input_folder}.kv.txt.bak")
-                print(f"Moved {bak_file.name} from {move_dir} to current directory")
-            except Exception as e:
-                print(f"Error moving {bak_file.name}: {e}")
+        # The hash cache lives beside the .bak file and travels with it
+        for name in (f"{self.input_folder}.kv.txt.bak", self.hash_cache.cache_file.name):
+            bak_file = move_path / name
+            if bak_file.exists():
+                try:
+                    shutil.move(str(bak_file), name)
+                    print(f"Moved {bak_file.name} from {move_dir} to current directory")
+                except Exception as e:
+                    print(f"Error moving {bak_file.name}: {e}")
 
     def kv_to_move_dir(self, move_dir):
-        bak_file = Path(f"{self.input_folder}.kv.txt.bak")
-        if bak_file.exists():
-            move_path = Path(move_dir)
-            try:
-                shutil.move(str(bak_file), str(move_path / bak_file.name))
-                print(f"Moved {bak_file.name} back to {move_dir}")
-            except Exception as e:
-                print(f"Error moving {bak_file.name}: {e}")
+        for name in (f"{self.input_folder}.kv.txt.bak", self.hash_cache.cache_file.name):
+            bak_file = Path(name)
+            if bak_file.exists():
+                move_path = Path(move_dir)
+                try:
+                    shutil.move(str(bak_file), str(move_path / bak_file.name))
+                    print(f"Moved {bak_file.name} back to {move_dir}")
+                except Exception as e:
+                    print(f"Error moving {bak_file.name}: {e}")
 
 
     
-    def __init__(self, input_folder, vpk_exe_path, chunk_size="100", move_dir=None, move_files=0):
+    def __init__(self, input_folder, vpk_exe_path=None, chunk_size="100", move_dir=None, move_files=0,
+                 rehash_all=False, cache_inode=False, hash_workers=None, packer="native", vpk_version=2,
+                 layout="stable", compact_threshold=0.25, dedup=1):
         self.input_folder = input_folder
-        self.vpk_exe = Path(vpk_exe_path)
+        self.vpk_exe = Path(vpk_exe_path) if vpk_exe_path else None
+        self.packer = packer
+        self.vpk_version = vpk_version
+        self.layout = layout
+        self.compact_threshold = compact_threshold
+        self.dedup = dedup
         self.kv_file = f"{input_folder}.kv.txt"
         self.chunk_size = chunk_size
         self.move_dir = move_dir
         self.move_files = move_files
+        self.rehash_all = rehash_all
+        self.hash_workers = hash_workers
+        self.hash_cache = HashCache(f"{input_folder}.hashcache.json", input_folder, use_inode=cache_inode)
         self.folder_extensions = {
             'materials': ['.vmt', '.vtf'],
             'models': ['.mdl', '.phy', '.ani', '.vtx', '.vvd'],
@@ -99,11 +189,30 @@ class AssetProcessor:
         }
 
     def calculate_md5(self, file_path):
-        hash_md5 = hashlib.md5()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        return hashing.hash_file(file_path, "md5")
+
+    def get_md5s(self, files):
+        # files is a list of (file_path, rel_path), returns the md5s in the same order
+        stats = [os.stat(file_path) for file_path, _ in files]
+        md5s = [None] * len(files)
+        if not self.rehash_all:
+            for i, ((_, rel_path), st) in enumerate(zip(files, stats)):
+                md5s[i] = self.hash_cache.lookup(rel_path, st)
+                if md5s[i] is None:
+                    md5s[i] = self.hash_cache.lookup_renamed(st)
+
+        # Hash everything the cache couldn't answer in one parallel batch
+        missing = [i for i, md5_hash in enumerate(md5s) if md5_hash is None]
+        hashed = hashing.hash_files([files[i][0] for i in missing], "md5", workers=self.hash_workers)
+        instrument.count("hash.files", len(missing))
+        instrument.count("hash.bytes_read", sum(stats[i].st_size for i in missing))
+        for i, md5_hash in zip(missing, hashed):
+            md5s[i] = md5_hash
+        self.hash_cache.misses += len(missing)
+
+        for (_, rel_path), st, md5_hash in zip(files, stats, md5s):
+            self.hash_cache.store(rel_path, st, md5_hash)
+        return md5s
 
     def create_kv_file(self):
         # Delete previous kv file if it exists before writing
@@ -118,45 +227,143 @@ class AssetProcessor:
             f.write(f"//        made = {timestamp}\n")
             f.write(f"//\n\n")
 
+    def scan_assets(self):
+        """Walk the input folder once and return {folder: [rel_path, ...]} in sorted order."""
+        base = str(Path(self.input_folder))
+        wanted = {os.path.normcase(folder): folder for folder in self.folder_extensions}
+        extensions = {folder: tuple(os.path.normcase(ext) for ext in exts)
+                      for folder, exts in self.folder_extensions.items()}
+        found = {folder: [] for folder in self.folder_extensions}
+
+        with os.scandir(base) as it:
+            top_dirs = [(wanted[os.path.normcase(entry.name)], entry.name)
+                        for entry in it if os.path.normcase(entry.name) in wanted and entry.is_dir()]
+
+        for folder, dir_name in top_dirs:
+            exts = extensions[folder]
+            files = found[folder]
+            stack = [dir_name]
+            while stack:
+                rel_dir = stack.pop()
+                with os.scandir(os.path.join(base, rel_dir)) as it:
+                    for entry in it:
+                        rel_path = os.path.join(rel_dir, entry.name)
+                        if entry.is_dir():
+                            stack.append(rel_path)
+                        elif os.path.normcase(entry.name).endswith(exts):
+                            files.append(rel_path)
+
+        # Same ordering as sorting the Path objects (component by component)
+        for files in found.values():
+            files.sort(key=lambda rel_path: os.path.normcase(rel_path).split(os.sep))
+        return found
+
     def process_folders(self):
+        for _ in self.iter_folders():
+            pass
+
+    def iter_folders(self):
+        """Hash and write the kv entries one folder at a time, yielding (folder, [(file_path, rel_path)], md5s)
+        after each one so the build pipeline can start packing before the last folder is hashed."""
+        if self.rehash_all:
+            print("Rehashing all files (--rehash-all)")
+        else:
+            self.hash_cache.load()
+
+        start = time.perf_counter()
+        with instrument.span("scan"):
+            found = self.scan_assets()
+        walk_time = time.perf_counter() - start
+        print(f"Found {sum(len(files) for files in found.values())} files in {walk_time:.2f}s")
+
+        base = str(Path(self.input_folder))
+        write_time = 0.0
         n = 0
-        for folder, extensions in self.folder_extensions.items():
-            folder_path = Path(self.input_folder) / folder
-            if not folder_path.exists():
-                continue
+        with open(self.kv_file, 'a', buffering=1024 * 1024) as f:
+            for folder, rel_paths in found.items():
+                if not rel_paths:
+                    continue
 
-            print(f"Processing {folder}...", end='', flush=True)
-            
-            # Get all files in the folder and its subfolders
-            all_files = []
-            for ext in extensions:
-                all_files.extend(list(folder_path.rglob(f"*{ext}")))
-            
-            # Sort files to ensure consistent ordering
-            all_files.sort()
-
-            for file_path in all_files:
-                rel_path = str(file_path.relative_to(self.input_folder))
-                
-                with open(self.kv_file, 'a') as f:
-                    f.write(f'"{str(file_path)}"\n')
-                    f.write("{\n")
-                    f.write(f'    "destpath"    "{rel_path}"\n')
-                    
-                    # Calculate MD5
-                    md5_hash = self.calculate_md5(file_path)
-                    f.write(f'    "MD5"         "{md5_hash}"\n')
-                    f.write("}\n")
-
-                n += 1
-                if n >= 100:
-                    print(".", end='', flush=True)
-                    n = 0
-            
-            print()  # New line after each folder
+                print(f"Processing {folder}...", end='', flush=True)
+
+                files = [(os.path.join(base, rel_path), rel_path) for rel_path in rel_paths]
+                with instrument.span("hash", folder=folder, files=len(files)):
+                    md5s = self.get_md5s(files)
+                instrument.count("files", len(files))
+
+                start = time.perf_counter()
+                for (file_path, rel_path), md5_hash in zip(files, md5s):
+                    f.write(f'"{file_path}"\n'
+                            "{\n"
+                            f'    "destpath"    "{rel_path}"\n'
+                            f'    "MD5"         "{md5_hash}"\n'
+                            "}\n")
+
+                    n += 1
+                    if n >= 100:
+                        print(".", end='', flush=True)
+                        n = 0
+                end = time.perf_counter()
+                write_time += end - start
+                instrument.add_span("write_kv", start, end, attrs={"folder": folder})
+
+                print()  # New line after each folder
+                yield folder, files, md5s
+
+        print(f"Wrote {self.kv_file} in {write_time:.2f}s (directory walk took {walk_time:.2f}s)")
+
+        deleted = self.hash_cache.save()
+        instrument.count("hash_cache.hits", self.hash_cache.hits)
+        instrument.count("hash_cache.renamed", self.hash_cache.renamed)
+        print(f"Hash cache: {self.hash_cache.hits} unchanged, {self.hash_cache.renamed} renamed, "
+              f"{self.hash_cache.misses} hashed, {len(deleted)} deleted")
 
     def handle_vpk(self):
-        if not self.vpk_exe.exists():
+        with instrument.span("pack", packer=self.packer):
+            if self.packer == "native":
+                packed = self.pack_native()
+            else:
+                packed = self.run_vpk_exe()
+
+        if packed:
+            with instrument.span("backup_kv"):
+                self.backup_kv_file()
+        return packed
+
+    def pack_native(self, entries=None, on_chunk=None):
+        """Pack the kv file's entries, or entries as they arrive from the build pipeline."""
+        print(f"Packing {self.input_folder} with the built-in VPK writer (v{self.vpk_version})")
+
+        private_key = public_key = None
+        if Path("my.privatekey.vdf").exists() and Path("my.publickey.vdf").exists():
+            if self.vpk_version == 2:
+                print("Signing with my.privatekey.vdf")
+                private_key = vpk_file.load_key_from_vdf("my.privatekey.vdf")
+                public_key = vpk_file.load_key_from_vdf("my.publickey.vdf")
+            else:
+                print("Key files found but VPK v1 can't be signed, skipping signature")
+
+        if entries is None:
+            entries = vpk_file.read_kv_control_file(self.kv_file)
+        writer = vpk_file.VPKWriter(self.input_folder, ".", self.vpk_version, self.chunk_size,
+                                    stable_layout=self.layout == "stable",
+                                    compact_threshold=self.compact_threshold,
+                                    dedup=self.dedup == 1)
+        try:
+            # The previous release's _dir.vpk and .kv.txt.bak are the baseline for the stable layout
+            writer.write(entries, private_key, public_key, baseline_kv=f"{self.kv_file}.bak", on_chunk=on_chunk)
+        except pipeline.PipelineAborted:
+            # Another pipeline stage failed and reports it, this isn't a packing error
+            raise
+        except Exception as e:
+            print(f"ERROR: Packing failed: {e}")
+            return False
+        instrument.count("dedup.files", len(writer.duplicates))
+        instrument.count("dedup.bytes_saved", writer.dedup_bytes)
+        return True
+
+    def run_vpk_exe(self):
+        if not self.vpk_exe or not self.vpk_exe.exists():
             print("ERROR: VPK executable not found!")
             return False
 
@@ -183,7 +390,6 @@ class AssetProcessor:
                 self.kv_file
             ])
 
-        self.backup_kv_file()
         return True
 
     def backup_kv_file(self):
@@ -236,9 +442,25 @@ class AssetProcessor:
 def main():
     parser = argparse.ArgumentParser(description='Asset Processing Script')
     
-    parser.add_argument('--vpk_exe', type=str, required=True,
-                        help='Path to the VPK executable')
+    parser.add_argument('--vpk_exe', type=str,
+                        help='Path to the VPK executable (required if packer=vpk_exe)')
+
+    parser.add_argument('--packer', type=str, default="native", choices=["native", "vpk_exe"],
+                        help='Pack with the built-in VPK writer or with vpk.exe (default: native)')
+
+    parser.add_argument('--vpk_version', type=int, default=2, choices=[1, 2],
+                        help='VPK version written by the native packer (default: 2)')
+
+    parser.add_argument('--layout', type=str, default="stable", choices=["stable", "full"],
+                        help='stable keeps unchanged files in their previous chunks and writes the rest '
+                             'to freed or new chunks, full repacks everything (default: stable)')
+
+    parser.add_argument('--compact_threshold', type=float, default=0.25,
+                        help='Fraction of dead space in reused chunks that triggers a full repack (default: 0.25)')
     
+    parser.add_argument('--dedup', type=int, default=1, choices=[0, 1],
+                        help='Store byte-identical files once, every copy points at the same data (0=off, 1=on, default: 1)')
+
     parser.add_argument('--input_folder', type=str, default="pak01",
                         help='Input folder name (default: pak01)')
     
@@ -257,61 +479,85 @@ def main():
     parser.add_argument('--move_dir', type=str,
                         help='Directory to move files to (required if move_files=1)')
 
+    parser.add_argument('--rehash-all', action='store_true',
+                        help='Ignore the hash cache and recompute the MD5 of every file')
+
+    parser.add_argument('--cache-inode', action='store_true',
+                        help='Also key the hash cache on file inodes, lets moved/renamed files keep their cached hash')
+
+    parser.add_argument('--hash-workers', type=int, default=None,
+                        help='Number of threads used to hash files (default: 2x CPU count, max 32)')
+
+    instrument.add_arguments(parser)
+
     args = parser.parse_args()
 
     # Check if move_dir is provided when move_files is enabled
     if args.move_files == 1 and not args.move_dir:
         parser.error("--move_dir is required when --move_files is set to 1!")
 
+    if args.packer == "vpk_exe" and not args.vpk_exe:
+        parser.error("--vpk_exe is required when --packer is set to vpk_exe!")
+
     processor = AssetProcessor(
         args.input_folder, 
         args.vpk_exe, 
         args.chunk_size,
         args.move_dir,
-        args.move_files
+        args.move_files,
+        args.rehash_all,
+        args.cache_inode,
+        args.hash_workers,
+        args.packer,
+        args.vpk_version,
+        args.layout,
+        args.compact_threshold,
+        args.dedup
     )
     
-    # Create move_dir if it's provided
-    if args.move_dir:
-        processor.check_and_create_move_dir(args.move_dir)
-    
-    # Check and move existing VPK files at start
-    print(f"\nChecking for existing VPK files in {args.move_dir}...")
-    processor.check_and_move_existing_vpks(args.move_dir)
-    
-    # Move .bak file to current directory
-    print(f"\nChecking for existing .bak file in {args.move_dir}...")
-    processor.kv_to_current(args.move_dir)
-    
-    print(f"\nCreating Keyvalues File {processor.kv_file}...")
-    print("Collecting MD5 checksums of files...\n")
-    
-    print("Please wait... This entire process could take around 2-10 minutes.\n")
+    with instrument.session("vpk", args):
+        # Create move_dir if it's provided
+        if args.move_dir:
+            processor.check_and_create_move_dir(args.move_dir)
 
-    processor.create_kv_file()
-    processor.process_folders()
-    processor.handle_vpk()
-    
-    print("\nAll done!")
+        # Check and move existing VPK files at start
+        print(f"\nChecking for existing VPK files in {args.move_dir}...")
+        with instrument.span("move_existing_vpks"):
+            processor.check_and_move_existing_vpks(args.move_dir)
 
-    # Run compression if compression is 1
-    if args.compression == 1:
-        try:
-            print("\nRunning compression script...")
-            input_dir = os.getcwd()  # Current directory where VPK files are
-            subprocess.run(["python", "vpk_compress.py", input_dir, "../pak01_compiled", 
-                        "--compress-split", str(args.compress_split)], check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error running compression script: {e}")
-        except FileNotFoundError:
-            print("Error: vpk_compress.py not found in the current directory!")
-
-    # Move VPK files and .bak file if move_files is 1
-    if args.move_files == 1:
-        print(f"\nMoving VPK files to {args.move_dir}...")
-        processor.move_vpk_files(args.move_dir)
-        print(f"\nMoving .bak file to {args.move_dir}...")
-        processor.kv_to_move_dir(args.move_dir)
+        # Move .bak file to current directory
+        print(f"\nChecking for existing .bak file in {args.move_dir}...")
+        with instrument.span("kv_to_current"):
+            processor.kv_to_current(args.move_dir)
+
+        print(f"\nCreating Keyvalues File {processor.kv_file}...")
+        print("Collecting MD5 checksums of files...\n")
+
+        print("Please wait... This entire process could take around 2-10 minutes.\n")
+
+        # Hashing, packing and compression run as one pipeline, each chunk gets compressed
+        # as soon as it's packed instead of after the whole build
+        dest_dir = None
+        options = None
+        if args.compression == 1:
+            import vpk_compress
+            dest_dir = os.path.abspath("../pak01_compiled")
+            options = vpk_compress.default_options(split=args.compression_split == 1)
+            print(f"Compressed archives go to {dest_dir}")
+        if not pipeline.BuildPipeline(processor, dest_dir, options).run():
+            print("\nBuild failed!")
+            sys.exit(1)
+
+        print("\nAll done!")
+
+        # Move VPK files and .bak file if move_files is 1
+        if args.move_files == 1:
+            print(f"\nMoving VPK files to {args.move_dir}...")
+            with instrument.span("move_vpks"):
+                processor.move_vpk_files(args.move_dir)
+            print(f"\nMoving .bak file to {args.move_dir}...")
+            with instrument.span("kv_to_move_dir"):
+                processor.kv_to_move_dir(args.move_dir)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
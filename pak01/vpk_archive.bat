@@ -0,0 +1,2 @@
+python vpk_archive.py list
+pause
\ No newline at end of file
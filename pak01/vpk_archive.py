@@ -0,0 +1,167 @@
+import os
+import sys
+import mmap
+import zlib
+import fnmatch
+import argparse
+import traceback
+
+import vpk_file
+
+class VPKArchive:
+    """Random access to the files of a built VPK without unpacking it.
+
+    The directory tree is loaded into a dict of path -> (archive index, offset, length, crc)
+    and chunks are mmapped the first time something is read from them.
+    """
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.vpk_dir = os.path.dirname(dir_path) or "."
+        base = os.path.basename(dir_path)
+        if not base.endswith("_dir.vpk"):
+            raise ValueError(f"{dir_path} is not a _dir.vpk file")
+        self.name = base[:-len("_dir.vpk")]
+
+        self.version, entries, _ = vpk_file.read_directory(dir_path)
+        self.data_offset = vpk_file.dir_data_offset(dir_path)
+        self.index = {}
+        self.preload = {}  # only the few entries that have preload data
+        for entry in entries:
+            self.index[entry.path] = (entry.archive_index, entry.offset, entry.length, entry.crc)
+            if entry.preload_data:
+                self.preload[entry.path] = entry.preload_data
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return vpk_file.normalize_path(path) in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def glob(self, pattern="*"):
+        """Paths matching a shell pattern, e.g. materials/*.vtf ('*' also matches '/')."""
+        return sorted(fnmatch.filter(self.index, vpk_file.normalize_path(pattern) or "*"))
+
+    def _map(self, archive_index):
+        data = self.maps.get(archive_index)
+        if data is None:
+            if archive_index == vpk_file.DIR_ARCHIVE_INDEX:
+                path = self.dir_path
+            else:
+                path = os.path.join(self.vpk_dir, vpk_file.chunk_file_name(self.name, archive_index))
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[archive_index] = data
+        return data
+
+    def read(self, path):
+        """Contents of path as bytes."""
+        with self.view(path) as view:
+            return bytes(view)
+
+    def view(self, path):
+        """Contents of path as a memoryview straight into the mmapped chunk (a copy if it has preload data).
+
+        The chunk can't be unmapped while a view into it is alive, release it (or use it in a
+        with block) before close().
+        """
+        path = vpk_file.normalize_path(path)
+        archive_index, offset, length, _ = self.index[path]
+        if archive_index == vpk_file.DIR_ARCHIVE_INDEX:
+            offset += self.data_offset
+        data = self._map(archive_index)
+        if offset + length > len(data):
+            raise IOError(f"{path} runs past the end of archive {archive_index}")
+        view = memoryview(data)[offset:offset + length]
+        preload = self.preload.get(path)
+        if preload:
+            return memoryview(preload + view)
+        return view
+
+    def check(self, path):
+        """True if the contents of path match the CRC stored in the directory tree."""
+        with self.view(path) as view:
+            return zlib.crc32(view) == self.index[vpk_file.normalize_path(path)][3]
+
+    def extract(self, path, out_dir):
+        out_path = os.path.join(out_dir, *vpk_file.normalize_path(path).split("/"))
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        with open(out_path, "wb") as f, self.view(path) as view:
+            f.write(view)
+        return out_path
+
+    def close(self):
+        for archive_index, data in list(self.maps.items()):
+            try:
+                data.close()
+            except BufferError:
+                raise BufferError(f"A view into archive {archive_index} is still in use, "
+                                  f"release the memoryviews from view() before close()") from None
+            del self.maps[archive_index]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='List, print or extract files from a built VPK')
+    parser.add_argument('--vpk', default="pak01_dir.vpk", help='Path to the _dir.vpk (default: pak01_dir.vpk)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = commands.add_parser('list', help='List the files in the VPK')
+    list_parser.add_argument('pattern', nargs='?', default="*", help='Only list paths matching this pattern')
+    list_parser.add_argument('-l', '--long', action='store_true', help='Also show archive index, offset, size and CRC')
+
+    cat_parser = commands.add_parser('cat', help='Write a file from the VPK to stdout')
+    cat_parser.add_argument('path', help='Path inside the VPK, e.g. scripts/items/items_game.txt')
+
+    extract_parser = commands.add_parser('extract', help='Extract files from the VPK')
+    extract_parser.add_argument('--glob', default="*", help='Only extract paths matching this pattern (default: all)')
+    extract_parser.add_argument('--out', default=".", help='Output directory (default: current directory)')
+    extract_parser.add_argument('--check', action='store_true', help='Verify the CRC of every extracted file')
+    args = parser.parse_args()
+
+    try:
+        with VPKArchive(args.vpk) as archive:
+            if args.command == 'list':
+                paths = archive.glob(args.pattern)
+                for path in paths:
+                    if args.long:
+                        archive_index, offset, length, crc = archive.index[path]
+                        size = length + len(archive.preload.get(path, b""))
+                        print(f"{archive_index:5d} {offset:10d} {size:10d} {crc:08x} {path}")
+                    else:
+                        print(path)
+
+            elif args.command == 'cat':
+                if args.path not in archive:
+                    print(f"{args.path} not found in {args.vpk}", file=sys.stderr)
+                    sys.exit(1)
+                sys.stdout.buffer.write(archive.read(args.path))
+
+            elif args.command == 'extract':
+                paths = archive.glob(args.glob)
+                bad = 0
+                for path in paths:
+                    if args.check and not archive.check(path):
+                        print(f"CRC mismatch: {path}")
+                        bad += 1
+                        continue
+                    archive.extract(path, args.out)
+                print(f"Extracted {len(paths) - bad} of {len(paths)} files to {os.path.abspath(args.out)}")
+                if bad:
+                    sys.exit(1)
+    except BrokenPipeError:
+        pass  # output piped into head or similar
+    except (KeyError, OSError, ValueError):
+        print(traceback.format_exc(), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,14 @@
 import os
-import hashlib
 import sys
 import subprocess
 import shutil
 import argparse
+import time
 import traceback
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 
-# Try to import py7zr, install if not present
+# Try to import py7zr, install if not present (archives are written by sevenzip.py,
+# but py7zr brings the zstd bindings along and is what vpk_decompress reads them with)
 try:
     import py7zr
 except ImportError:
@@ -16,113 +17,233 @@ except ImportError:
     import py7zr
     print("py7zr installed successfully!")
 
+import compress_policy
+import hashing
+import instrument
+import release_manifest
+import sevenzip
+import volumes
+
+DEFAULT_LEVELS = {"lzma2": 9, "zstd": 19}
+DEFAULT_THREADS = 4
+
 def create_directory_if_not_exists(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
         print(f"Created directory: {directory}")
 
 def calculate_md5(file_path):
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return hashing.hash_file(file_path, "md5")
 
 def delete_existing_archive(archive_path):
-    if os.path.exists(archive_path):
-        try:
-            os.remove(archive_path)
-            print(f"Deleted existing archive: {archive_path}")
-        except Exception as e:
-            print(f"Error deleting archive {archive_path}: {str(e)}")
-
-def compress_file(input_path, output_path):
+    for path in [archive_path] + volumes.find_volumes(archive_path):
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+                print(f"Deleted existing archive: {path}")
+            except Exception as e:
+                print(f"Error deleting archive {path}: {str(e)}")
+
+def archive_exists(entry, dest_dir):
+    return bool(entry) and all(os.path.exists(os.path.join(dest_dir, v["name"])) for v in entry["volumes"])
+
+def compress_file(input_path, output_path, options=None, asset_mix=None):
+    """Compress input_path into output_path, hashing the source on the same read.
+
+    asset_mix is the chunk's compress_policy.entries_mix when the packer passed it along.
+    Returns the manifest entry for the archive.
+    """
+    options = options or {}
+    codec = options.get("codec", "lzma2")
+    level = options.get("level")
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
     try:
-        print(f"Starting compression of {input_path} to {output_path}")
-        filters = [{"id": py7zr.FILTER_LZMA2, "preset": 9}]
-        
-        # Compress with maximum compression
-        with py7zr.SevenZipFile(output_path, 'w', filters=filters) as archive:
+        start = time.perf_counter()
+        policy = None
+        if codec == "lzma2" and options.get("policy", "auto") == "auto":
+            with instrument.span("choose_policy"):
+                policy = compress_policy.choose_policy(input_path, level, asset_mix)
+            codec, level = policy["method"], policy["level"]
+            print(f"Policy for {os.path.basename(input_path)}: {compress_policy.describe(policy)}")
+            instrument.count(f"policy.{policy['reason']}")
+        print(f"Starting compression of {input_path} to {output_path} "
+              f"({'stored' if codec == 'copy' else f'{codec} level {level}'})")
+        source_hasher = hashing.new_hasher("md5")
+
+        # Split archives are written straight into .7z.001, .002, ... while compressing, and every
+        # volume is hashed as it's written, with the 7z start header patched in at the end
+        volume_size = options.get("volume_size", volumes.DEFAULT_VOLUME_SIZE_MB << 20) if options.get("split") else None
+        out = volumes.VolumeWriter(output_path, volume_size, "md5", patch_size=sevenzip.SIGNATURE_HEADER_SIZE)
+        with out:
             print(f"Adding {os.path.basename(input_path)} to archive...")
-            archive.write(input_path, os.path.basename(input_path))
-        
-        # Verify the archive was created
-        if os.path.exists(output_path):
-            print(f"Successfully created archive: {output_path}")
-            print(f"Archive size: {os.path.getsize(output_path) / (1024*1024):.2f} MB")
-        else:
-            print(f"Error: Archive file was not created at {output_path}")
-            
+            result = sevenzip.write_archive(input_path, out, codec, level,
+                                            threads=options.get("threads", 1),
+                                            block_size=options.get("block_size", sevenzip.DEFAULT_BLOCK_SIZE),
+                                            dict_size=policy["dict_size"] if policy else None,
+                                            filters=policy["filters"] if policy else (),
+                                            on_read=source_hasher.update)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+
+        volume_list = out.close()
+        archive_size = sum(size for _, size, _ in volume_list)
+
+        print(f"Successfully created archive: {output_path} ({len(volume_list)} volumes)")
+        print(f"Archive size: {archive_size / (1024*1024):.2f} MB, "
+              f"ratio {result.pack_size / max(result.unpack_size, 1):.3f}, "
+              f"{result.unpack_size / (1024*1024) / elapsed:.2f} MB/s")
+
+        st = os.stat(input_path)
+        instrument.count("files_compressed")
+        instrument.count("bytes_read", st.st_size)
+        instrument.count("bytes_written", archive_size)
+        entry = {
+            "source_md5": source_hasher.hexdigest(),
+            "source_size": st.st_size,
+            "source_mtime_ns": st.st_mtime_ns,
+            "archive": os.path.basename(output_path),
+            "archive_size": archive_size,
+            "codec": codec,
+            "level": level,
+            "ratio": round(archive_size / max(st.st_size, 1), 4),
+            "volumes": [{"name": os.path.basename(path), "size": size, "md5": digest}
+                        for path, size, digest in volume_list],
+        }
+        if policy:
+            entry["policy"] = policy
+        return entry
+
     except Exception as e:
         print(f"Error compressing {input_path}:")
         print(traceback.format_exc())
         raise
 
 def process_single_vpk(args):
+    """Returns (filename, manifest entry), the entry is None if processing failed."""
+    filename, directory, dest_dir, options, previous, asset_mix = args
     try:
-        filename, directory, dest_dir = args
         vpk_path = os.path.join(directory, filename)
-        hash_file_path = os.path.join(dest_dir, filename + ".txt")
         archive_path = os.path.join(dest_dir, filename + ".7z")
-        
+        if options.get("split"):
+            archive_name = os.path.basename(volumes.volume_path(archive_path, 0))
+        else:
+            archive_name = os.path.basename(archive_path)
+
         print(f"\nProcessing {filename}...")
         print(f"VPK path: {vpk_path}")
         print(f"Archive path: {archive_path}")
-        
-        current_hash = calculate_md5(vpk_path)
-        
-        # If hash file doesn't exist, create it
-        if not os.path.exists(hash_file_path):
-            print(f"Creating hash file for {filename}")
-            with open(hash_file_path, "w") as f:
-                f.write(current_hash)
-            print(f"Starting compression for {filename}...")
-            delete_existing_archive(archive_path)
-            compress_file(vpk_path, archive_path)
-            return
-        
-        # Read stored hash
-        with open(hash_file_path, "r") as f:
-            stored_hash = f.read().strip()
-        
-        # If hash is different or archive doesn't exist
-        if current_hash != stored_hash or not os.path.exists(archive_path):
-            if current_hash != stored_hash:
-                print(f"Hash mismatch detected for {filename}")
-            else:
-                print(f"No archive found for {filename}")
-            print(f"Starting compression for {filename}...")
-            
-            with open(hash_file_path, "w") as f:
-                f.write(current_hash)
-            
-            delete_existing_archive(archive_path)
-            compress_file(vpk_path, archive_path)
-            
+
+        st = os.stat(vpk_path)
+        up_to_date = (archive_exists(previous, dest_dir) and
+                      previous["volumes"][0]["name"] == archive_name)
+        if up_to_date and previous["source_size"] == st.st_size:
+            if previous["source_mtime_ns"] == st.st_mtime_ns:
+                print(f"Skipping {filename} - unchanged since last release")
+                instrument.count("files_skipped")
+                return filename, previous
+
+            # Same size but touched, only a hash tells if it actually changed
+            instrument.count("hash.bytes_read", st.st_size)
+            if calculate_md5(vpk_path) == previous["source_md5"]:
+                print(f"Skipping {filename} - content unchanged")
+                instrument.count("files_skipped")
+                return filename, dict(previous, source_mtime_ns=st.st_mtime_ns)
+            print(f"Hash mismatch detected for {filename}")
+        elif previous:
+            print(f"{filename} changed" if up_to_date else f"No archive found for {filename}")
+
+        print(f"Starting compression for {filename}...")
+        delete_existing_archive(archive_path)
+        return filename, compress_file(vpk_path, archive_path, options, asset_mix)
+
     except Exception as e:
         print(f"Error processing {filename}:")
         print(traceback.format_exc())
+        return filename, None
+
+def default_options(**overrides):
+    """The options main() passes to process_vpk_files when no flags are given."""
+    options = {
+        "codec": "lzma2",
+        "level": None,
+        "workers": None,
+        "threads": DEFAULT_THREADS,
+        "block_size": sevenzip.DEFAULT_BLOCK_SIZE,
+        "split": True,
+        "volume_size": volumes.DEFAULT_VOLUME_SIZE_MB * 1024 * 1024,
+        "policy": "auto",
+    }
+    options.update(overrides)
+    return options
 
-def process_vpk_files(directory, dest_dir):
+def default_workers(threads):
+    return max(1, (os.cpu_count() or 1) // max(1, threads))
+
+def process_vpk_files(directory, dest_dir, options=None):
+    options = options or {}
     create_directory_if_not_exists(dest_dir)
-    
+    manifest = release_manifest.load_manifest(dest_dir)
+
     # Get list of VPK files
-    vpk_files = [(f, directory, dest_dir) 
+    vpk_files = [(f, directory, dest_dir, options, manifest.get(f), None)
                  for f in os.listdir(directory) 
                  if f.endswith(".vpk")]
     
     print(f"Found {len(vpk_files)} VPK files to process")
-    
-    # Use ThreadPoolExecutor to process files in parallel
-    with ThreadPoolExecutor(max_workers=4) as executor:  # Using 4 workers for parallel processing
-        executor.map(process_single_vpk, vpk_files)
+    if not vpk_files:
+        return
+
+    threads = options.get("threads", 1)
+    workers = options.get("workers") or default_workers(threads)
+    workers = min(workers, len(vpk_files))
+    print(f"Compressing with {workers} processes x {threads} threads")
+
+    # One process per VPK, each one compresses its LZMA2 blocks on its own threads
+    files = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for filename, entry in instrument.pool_map(executor, process_single_vpk, vpk_files, "compress_vpk", workers,
+                                                   label=lambda job: job[0]):
+            if entry:
+                files[filename] = entry
+
+    # VPKs that are gone drop out of the manifest, failed ones are left out so the next run retries them
+    release_manifest.save_manifest(dest_dir, files)
 
 def main():
     parser = argparse.ArgumentParser(description='Process VPK files and store archives in specified location')
     parser.add_argument('input_dir', help='Directory containing VPK files to process')
-    parser.add_argument('dest_dir', help='Destination directory for hash files and archives')
+    parser.add_argument('dest_dir', help=f'Destination directory for the archives and {release_manifest.MANIFEST_NAME}')
+    parser.add_argument('--codec', choices=sorted(DEFAULT_LEVELS), default="lzma2",
+                        help='lzma2 for releases, zstd (long distance matching) for fast test builds (default: lzma2)')
+    parser.add_argument('--level', type=int, default=None,
+                        help='Compression level/preset (default: 9 for lzma2, 19 for zstd)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='VPKs compressed in parallel, one process each (default: CPU count / threads)')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help=f'Threads compressing blocks of a single VPK (default: {DEFAULT_THREADS})')
+    parser.add_argument('--compress-split', type=int, default=1, choices=[0, 1],
+                        help='Write split .7z.001/.002... volumes while compressing (0=off, 1=on, default: 1)')
+    parser.add_argument('--volume-size', type=int, default=volumes.DEFAULT_VOLUME_SIZE_MB,
+                        help=f'Split volume size in MB (default: {volumes.DEFAULT_VOLUME_SIZE_MB})')
+    parser.add_argument('--block-size', type=int, default=sevenzip.DEFAULT_BLOCK_SIZE // (1024 * 1024),
+                        help='LZMA2 block size in MB, smaller blocks use more threads but compress worse (default: 32)')
+    parser.add_argument('--policy', choices=["auto", "fixed"], default="auto",
+                        help='auto picks the lzma2 preset, filters and dictionary per VPK from its content, '
+                             'fixed uses --level for every VPK (default: auto)')
+    instrument.add_arguments(parser)
     args = parser.parse_args()
 
+    options = {
+        "codec": args.codec,
+        "level": args.level,
+        "workers": args.workers,
+        "threads": args.threads,
+        "block_size": args.block_size * 1024 * 1024,
+        "split": args.compress_split == 1,
+        "volume_size": args.volume_size * 1024 * 1024,
+        "policy": args.policy,
+    }
+
     input_dir = os.path.abspath(args.input_dir)
     dest_dir = os.path.abspath(args.dest_dir)
     
@@ -130,9 +251,11 @@ def main():
     print(f"Input directory: {input_dir}")
     print(f"Destination directory: {dest_dir}")
     
-    create_directory_if_not_exists(dest_dir)
-    process_vpk_files(input_dir, dest_dir)
-    print("Processing complete!")
+    with instrument.session("vpk_compress", args):
+        create_directory_if_not_exists(dest_dir)
+        with instrument.span("process_vpk_files"):
+            process_vpk_files(input_dir, dest_dir, options)
+        print("Processing complete!")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
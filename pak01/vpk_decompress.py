@@ -2,6 +2,9 @@ import os
 import sys
 import subprocess
 import glob
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 # Try to import py7zr, install if not present
 try:
@@ -12,37 +15,92 @@ except ImportError:
     import py7zr
     print("py7zr installed successfully!")
 
+from py7zr.io import Py7zIO, WriterFactory
+
+import hashing
+import instrument
+import release_manifest
+import volumes
+import vpk_patch
+
 def is_split_archive(archive_path):
     return os.path.exists(archive_path + '.001')
 
-def decompress_file(archive_path, output_directory):
-    # If it's a .7z.001 file, use that directly
-    if os.path.exists(archive_path + '.001'):
-        seven_zip_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "7za.exe")
-        
-        if not os.path.exists(seven_zip_path):
-            print("Error: 7za.exe not found in script directory!")
-            print("Please make sure 7za.exe is in the same directory as this script")
-            sys.exit(1)
-        
-        # Use the .001 file directly
-        cmd = f'"{seven_zip_path}" x "{archive_path}.001" -o"{output_directory}"'
-        try:
-            subprocess.run(cmd, shell=True, check=True)
-            print("Split archive extracted successfully")
-        except subprocess.CalledProcessError as e:
-            print(f"Error extracting split archive: {str(e)}")
-            raise
-    else:
-        # Regular .7z file
-        try:
-            with py7zr.SevenZipFile(archive_path, 'r') as archive:
-                archive.extractall(output_directory)
-        except:
-            # Fallback to 7za.exe if py7zr fails
-            seven_zip_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "7za.exe")
-            cmd = f'"{seven_zip_path}" x "{archive_path}" -o"{output_directory}"'
-            subprocess.run(cmd, shell=True, check=True)
+class HashingFile(Py7zIO):
+    """Extraction target that writes to {path}.part and hashes the data on the way through."""
+
+    def __init__(self, path):
+        self.path = path
+        self.part_path = path + ".part"
+        self.file = open(self.part_path, "wb")
+        self.hasher = hashing.new_hasher("md5")
+        self._size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self._size += len(data)
+        return self.file.write(data)
+
+    def read(self, size=None):
+        return b""
+
+    def seek(self, offset, whence=0):
+        return self._size
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        self.file.flush()
+
+    def size(self):
+        return self._size
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+class HashingFileFactory(WriterFactory):
+    def __init__(self, output_directory):
+        self.output_directory = output_directory
+        self.products = {}
+
+    def create(self, filename):
+        product = HashingFile(os.path.join(self.output_directory, filename))
+        self.products[filename] = product
+        return product
+
+def decompress_file(archive_path, output_directory, split=None):
+    """Extract archive_path into output_directory, returns {filename: md5} of what was extracted.
+
+    Files are written as .part and only renamed into place once extraction finished,
+    so an interrupted install never leaves a truncated VPK behind.
+    """
+    if split is None:
+        split = is_split_archive(archive_path)
+
+    # Split volumes are read as one stream straight from .001, .002, ... without joining them on disk
+    source = volumes.VolumeReader(volumes.find_volumes(archive_path)) if split else archive_path
+    factory = HashingFileFactory(output_directory)
+    try:
+        with py7zr.SevenZipFile(source, 'r') as archive:
+            archive.extractall(factory=factory)
+    except Exception:
+        for product in factory.products.values():
+            product.close()
+            if os.path.exists(product.part_path):
+                os.remove(product.part_path)
+        raise
+    finally:
+        if split:
+            source.close()
+
+    digests = {}
+    for filename, product in factory.products.items():
+        product.close()
+        os.replace(product.part_path, product.path)
+        digests[filename] = product.hasher.hexdigest()
+    return digests
 
 def get_file_number(filename):
     # Special case for dir.vpk
@@ -53,57 +111,175 @@ def get_file_number(filename):
     except:
         return float('inf')  # Any other special cases sort last
 
-def process_7z_files(directory):
-    found_files = False
-    processed_bases = set()  # Keep track of processed base names
-    
-    # Get all archive files and sort them
-    archive_files = []
-    for filename in os.listdir(directory):
-        if filename.endswith(".7z.001"):  # Look for split archives first
-            base_name = filename[:-4]  # Remove .001
-            archive_files.append(base_name)
-        elif filename.endswith(".7z"):  # Then look for regular archives
-            if not any(filename[:-3] + ".7z.001" in f for f in os.listdir(directory)):  # Skip if we already found it as .001
-                archive_files.append(filename)
-    
-    # Sort files numerically, with dir.vpk last
-    archive_files = sorted(set(archive_files), key=get_file_number)
-    
-    for base_name in archive_files:
-        found_files = True
-        if base_name in processed_bases:
-            continue
-            
-        processed_bases.add(base_name)
-        archive_path = os.path.join(directory, base_name)
-        vpk_name = base_name[:-3]  # Remove .7z extension
-        vpk_path = os.path.join(directory, vpk_name)
-        
-        # Skip if VPK already exists
-        if os.path.exists(vpk_path):
-            print(f"Skipping {base_name} - {vpk_name} already exists")
+def extract_archive(args):
+    base_name, directory, is_split, expected_md5 = args
+    archive_path = os.path.join(directory, base_name)
+    vpk_name = base_name[:-3]  # Remove .7z extension
+    vpk_path = os.path.join(directory, vpk_name)
+
+    print(f"Found {'split' if is_split else 'single'} archive: {base_name}")
+    print(f"Decompressing {base_name}...")
+
+    try:
+        digests = decompress_file(archive_path, directory, is_split)
+        if vpk_name not in digests or not os.path.exists(vpk_path):
+            print(f"Warning: {vpk_name} not found after decompression!")
+            return False
+        # Hashed while extracting, no second read of the VPK needed
+        if expected_md5 and digests[vpk_name] != expected_md5:
+            print(f"Error: {vpk_name} does not match the release manifest after extraction!")
+            os.remove(vpk_path)
+            return False
+        instrument.count("files_extracted")
+        instrument.count("bytes_written", os.path.getsize(vpk_path))
+        return True
+    except Exception as e:
+        print(f"Error processing {base_name}: {str(e)}")
+        return False
+
+def find_damaged_vpks(directory, manifest, filenames, hash_workers=None):
+    """Return the VPKs from the manifest that are missing or don't match their hash."""
+    damaged = set()
+    to_hash = []
+    for vpk_name, entry in sorted(manifest.items()):
+        if vpk_name not in filenames:
             continue
-        
-        is_split = os.path.exists(archive_path + '.001')
-        print(f"Found {'split' if is_split else 'single'} archive: {base_name}")
-        print(f"Decompressing {base_name}...")
-        
-        try:
-            decompress_file(archive_path, directory)
-            if not os.path.exists(vpk_path):
-                print(f"Warning: {vpk_name} not found after decompression!")
-        except Exception as e:
-            print(f"Error processing {base_name}: {str(e)}")
-    
-    if not found_files:
+        # A size mismatch (truncated by an interrupted install) needs no hashing
+        if os.path.getsize(os.path.join(directory, vpk_name)) != entry["source_size"]:
+            print(f"{vpk_name} has the wrong size")
+            damaged.add(vpk_name)
+        else:
+            to_hash.append(vpk_name)
+
+    print(f"Hashing {len(to_hash)} installed VPK files...")
+    instrument.count("hash.bytes_read", sum(manifest[name]["source_size"] for name in to_hash))
+    digests = hashing.hash_files([os.path.join(directory, name) for name in to_hash], "md5", workers=hash_workers)
+    for vpk_name, digest in zip(to_hash, digests):
+        if digest != manifest[vpk_name]["source_md5"]:
+            print(f"{vpk_name} does not match the release manifest")
+            damaged.add(vpk_name)
+    return damaged
+
+def process_7z_files(directory, workers=None, verify=False, hash_workers=None):
+    # List the directory once and work from sets instead of rescanning it per archive
+    filenames = set(os.listdir(directory))
+    manifest = release_manifest.load_manifest(directory)
+    if verify and not manifest:
+        print(f"No {release_manifest.MANIFEST_NAME} found, can't verify the installed VPK files!")
+        return
+
+    split_archives = {f[:-4] for f in filenames if f.endswith(".7z.001")}
+    single_archives = {f for f in filenames if f.endswith(".7z")} - split_archives
+
+    if not split_archives and not single_archives:
         print("No .7z or .7z.001 files found in the directory!")
+        return
+
+    damaged = set()
+    if verify:
+        with instrument.span("verify"):
+            damaged = find_damaged_vpks(directory, manifest, filenames, hash_workers)
+
+    # Sort files numerically, with dir.vpk last
+    jobs = []
+    for base_name in sorted(split_archives | single_archives, key=get_file_number):
+        vpk_name = base_name[:-3]  # Remove .7z extension
+        entry = manifest.get(vpk_name)
+
+        if vpk_name in filenames and vpk_name not in damaged:
+            # Without --verify only the size is checked, that still catches truncated files
+            if not entry or os.path.getsize(os.path.join(directory, vpk_name)) == entry["source_size"]:
+                print(f"Skipping {base_name} - {vpk_name} already exists")
+                continue
+            print(f"{vpk_name} has the wrong size")
+        jobs.append((base_name, directory, base_name in split_archives, entry["source_md5"] if entry else None))
+
+    if verify:
+        missing = damaged - {job[0][:-3] for job in jobs}
+        for vpk_name in sorted(missing):
+            print(f"Warning: no archive found to repair {vpk_name}")
+
+    if not jobs:
+        if verify and not damaged:
+            print("All installed VPK files match the release manifest")
+        return
+
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    print(f"Extracting {len(jobs)} archives with {workers} workers...")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(instrument.pool_map(executor, extract_archive, jobs, "extract", workers,
+                                           label=lambda job: job[0]))
+    print(f"Extracted {sum(results)} of {len(jobs)} archives")
+
+def apply_patches(patch_dir, directory):
+    manifest_path = os.path.join(patch_dir, vpk_patch.PATCH_MANIFEST_NAME)
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+
+    # Build every patched file next to the original first, old files are still
+    # needed as sources until all patches have been applied
+    verified_sources = {}
+    patched = []
+    needs_full = []
+    try:
+        for filename, info in sorted(manifest["files"].items()):
+            target_path = os.path.join(directory, filename)
+            if not info.get("delta"):
+                needs_full.append(filename)
+                continue
+            print(f"Patching {filename}...")
+            tmp_path = target_path + ".patched"
+            vpk_patch.apply_delta(os.path.join(patch_dir, info["delta"]), directory, tmp_path, verified_sources)
+            patched.append((tmp_path, target_path))
+    except Exception as e:
+        print(f"Error applying patch: {str(e)}")
+        for tmp_path, _ in patched:
+            os.remove(tmp_path)
+        return False
+
+    for tmp_path, target_path in patched:
+        os.replace(tmp_path, target_path)
+    for filename in manifest.get("removed", []):
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            os.remove(path)
+            print(f"Removed {filename}")
+
+    print(f"Patched {len(patched)} files")
+    if needs_full:
+        print("These files have no delta and need their full archive extracted:")
+        for filename in needs_full:
+            print(f"  {filename}")
+    return True
 
 def main():
+    parser = argparse.ArgumentParser(description='Extract VPK archives or apply delta patches in the current directory')
+    parser.add_argument('--apply-patch', metavar='PATCH_DIR',
+                        help=f'Apply the .delta files listed in PATCH_DIR/{vpk_patch.PATCH_MANIFEST_NAME}')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Archives extracted in parallel (default: CPU count)')
+    parser.add_argument('--verify', action='store_true',
+                        help=f'Hash the installed VPK files against {release_manifest.MANIFEST_NAME} and re-extract the damaged ones')
+    parser.add_argument('--hash-workers', type=int, default=None,
+                        help='Threads hashing installed VPK files with --verify (default: 2x CPU count)')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
     current_directory = os.getcwd()
-    print("Starting 7z file decompression...")
-    process_7z_files(current_directory)
-    print("Decompression complete!")
+    with instrument.session("vpk_decompress", args):
+        if args.apply_patch:
+            print("Applying delta patches...")
+            with instrument.span("apply_patches"):
+                patched = apply_patches(args.apply_patch, current_directory)
+            if not patched:
+                sys.exit(1)
+            print("Patching complete!")
+            return
+
+        print("Verifying installed VPK files..." if args.verify else "Starting 7z file decompression...")
+        with instrument.span("process_7z_files"):
+            process_7z_files(current_directory, args.workers, args.verify, args.hash_workers)
+        print("Decompression complete!")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
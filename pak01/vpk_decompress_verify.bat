@@ -0,0 +1,2 @@
+python vpk_decompress.py --verify
+pause
\ No newline at end of file
@@ -0,0 +1,550 @@
+import os
+import re
+import sys
+import struct
+import filecmp
+import hashlib
+import itertools
+import subprocess
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+VPK_SIGNATURE = 0x55AA1234
+DIR_ARCHIVE_INDEX = 0x7FFF  # entry data lives in the _dir.vpk itself
+ENTRY_TERMINATOR = 0xFFFF
+ARCHIVE_MD5_FRACTION = 1024 * 1024  # v2 stores an md5 for every 1 MiB of every chunk
+MAX_PRELOAD_SIZE = 0xFFFF
+
+HEADER_V1 = struct.Struct("<III")
+HEADER_V2 = struct.Struct("<IIIIIII")
+DIR_ENTRY = struct.Struct("<IHHIIH")
+ARCHIVE_MD5_ENTRY = struct.Struct("<III16s")
+
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+class VPKEntry:
+    __slots__ = ("path", "src_path", "size", "md5", "preload_size", "preload_data",
+                 "crc", "archive_index", "offset", "length")
+
+    def __init__(self, path, src_path=None, size=0, md5=None, preload_size=0):
+        self.path = path
+        self.src_path = src_path
+        self.size = size
+        self.md5 = md5
+        self.preload_size = preload_size
+        self.preload_data = b""
+        self.crc = 0
+        self.archive_index = DIR_ARCHIVE_INDEX
+        self.offset = 0
+        self.length = 0
+
+def normalize_path(path):
+    # vpk.exe stores lowercase paths with forward slashes
+    return path.replace("\\", "/").strip("/").lower()
+
+def split_path(path):
+    """Split a vpk path into (extension, directory, filename) the way the tree stores them."""
+    directory, _, filename = path.rpartition("/")
+    name, dot, ext = filename.rpartition(".")
+    if not dot:
+        name, ext = filename, ""
+    return ext or " ", directory or " ", name
+
+def chunk_file_name(name, archive_index):
+    return f"{name}_{archive_index:03d}.vpk"
+
+def dir_file_name(name):
+    return f"{name}_dir.vpk"
+
+def read_kv_control_file(kv_file):
+    """Read the keyvalues control file written by vpk.py into a list of VPKEntry."""
+    entries = []
+    src_path = None
+    values = {}
+    token = re.compile(r'"([^"]*)"')
+    with open(kv_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("//"):
+                continue
+            if line == "{":
+                values = {}
+            elif line == "}":
+                entries.append(VPKEntry(
+                    normalize_path(values.get("destpath", src_path)),
+                    src_path,
+                    md5=values.get("md5"),
+                    preload_size=min(int(values.get("preloadsize", 0)), MAX_PRELOAD_SIZE),
+                ))
+                src_path = None
+            else:
+                parts = token.findall(line)
+                if len(parts) == 1:
+                    src_path = parts[0]
+                elif len(parts) >= 2:
+                    values[parts[0].lower()] = parts[1]
+    return entries
+
+def build_tree(entries):
+    """Serialize the directory tree (extension -> directory -> filename -> entry)."""
+    tree = {}
+    for entry in entries:
+        ext, directory, name = split_path(entry.path)
+        tree.setdefault(ext, {}).setdefault(directory, []).append((name, entry))
+
+    out = bytearray()
+    for ext in sorted(tree):
+        out += ext.encode("utf-8") + b"\0"
+        for directory in sorted(tree[ext]):
+            out += directory.encode("utf-8") + b"\0"
+            for name, entry in sorted(tree[ext][directory], key=lambda item: item[0]):
+                out += name.encode("utf-8") + b"\0"
+                out += DIR_ENTRY.pack(entry.crc, len(entry.preload_data), entry.archive_index,
+                                      entry.offset, entry.length, ENTRY_TERMINATOR)
+                out += entry.preload_data
+            out += b"\0"
+        out += b"\0"
+    out += b"\0"
+    return bytes(out)
+
+def read_directory(dir_path):
+    """Parse a _dir.vpk into (version, entries, archive_md5s).
+
+    archive_md5s is {archive_index: [(offset, count, md5 digest)]}, empty for v1.
+    """
+    with open(dir_path, "rb") as f:
+        data = f.read()
+
+    signature, version = struct.unpack_from("<II", data)
+    if signature != VPK_SIGNATURE:
+        raise ValueError(f"{dir_path} is not a VPK directory file")
+    if version == 1:
+        _, _, tree_size = HEADER_V1.unpack_from(data)
+        header_size = HEADER_V1.size
+        archive_md5_size = 0
+    elif version == 2:
+        _, _, tree_size, file_data_size, archive_md5_size, _, _ = HEADER_V2.unpack_from(data)
+        header_size = HEADER_V2.size
+    else:
+        raise ValueError(f"Unsupported VPK version {version} in {dir_path}")
+
+    entries = []
+    pos = header_size
+
+    def read_string():
+        nonlocal pos
+        end = data.index(b"\0", pos)
+        value = data[pos:end].decode("utf-8", "replace")
+        pos = end + 1
+        return value
+
+    while True:
+        ext = read_string()
+        if not ext:
+            break
+        while True:
+            directory = read_string()
+            if not directory:
+                break
+            while True:
+                name = read_string()
+                if not name:
+                    break
+                crc, preload_size, archive_index, offset, length, _ = DIR_ENTRY.unpack_from(data, pos)
+                pos += DIR_ENTRY.size
+                path = name if ext == " " else f"{name}.{ext}"
+                if directory != " ":
+                    path = f"{directory}/{path}"
+                entry = VPKEntry(path, size=preload_size + length, preload_size=preload_size)
+                entry.preload_data = data[pos:pos + preload_size]
+                entry.crc = crc
+                entry.archive_index = archive_index
+                entry.offset = offset
+                entry.length = length
+                pos += preload_size
+                entries.append(entry)
+
+    archive_md5s = {}
+    if version == 2:
+        section_start = header_size + tree_size + file_data_size
+        for i in range(section_start, section_start + archive_md5_size, ARCHIVE_MD5_ENTRY.size):
+            archive_index, offset, count, digest = ARCHIVE_MD5_ENTRY.unpack_from(data, i)
+            archive_md5s.setdefault(archive_index, []).append((offset, count, digest))
+    return version, entries, archive_md5s
+
+def dir_data_offset(dir_path):
+    """Where the embedded file data starts in a _dir.vpk, DIR_ARCHIVE_INDEX offsets count from here."""
+    with open(dir_path, "rb") as f:
+        data = f.read(HEADER_V2.size)
+    signature, version, tree_size = HEADER_V1.unpack_from(data)
+    if signature != VPK_SIGNATURE:
+        raise ValueError(f"{dir_path} is not a VPK directory file")
+    return (HEADER_V1.size if version == 1 else HEADER_V2.size) + tree_size
+
+def crc32_file(file_path, block_size=COPY_BUFFER_SIZE):
+    crc = 0
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                return crc
+            crc = zlib.crc32(data, crc)
+
+def archive_md5_fractions(chunk_path):
+    fractions = []
+    with open(chunk_path, "rb", buffering=0) as f:
+        offset = 0
+        while True:
+            data = f.read(ARCHIVE_MD5_FRACTION)
+            if not data:
+                return fractions
+            fractions.append((offset, len(data), hashlib.md5(data).digest()))
+            offset += len(data)
+
+def load_key_from_vdf(vdf_path):
+    """Pull the hex encoded DER key out of a my.privatekey.vdf / my.publickey.vdf file."""
+    with open(vdf_path, "r") as f:
+        # The key is the only long hex value in the file ("type" "rsa" etc. are short)
+        values = [v for v in re.findall(r'"([0-9a-fA-F]{64,})"', f.read())]
+    if not values:
+        raise ValueError(f"No key found in {vdf_path}")
+    return bytes.fromhex(max(values, key=len))
+
+def load_private_key(private_key_der):
+    try:
+        from cryptography.hazmat.primitives import serialization
+    except ImportError:
+        print("cryptography package not found. Installing...")
+        subprocess.check_call([sys.executable, "-m", "pip", "install", "cryptography"])
+        from cryptography.hazmat.primitives import serialization
+        print("cryptography installed successfully!")
+    return serialization.load_der_private_key(private_key_der, password=None)
+
+def sign_data(data, private_key):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    return private_key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+
+class VPKWriter:
+    def __init__(self, name, output_dir=".", version=2, chunk_size_mb=100, workers=None,
+                 stable_layout=False, compact_threshold=0.25, dedup=True):
+        if version not in (1, 2):
+            raise ValueError(f"Unsupported VPK version {version}")
+        self.name = name
+        self.output_dir = output_dir
+        self.version = version
+        self.chunk_size = int(float(chunk_size_mb) * 1024 * 1024)
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self.stable_layout = stable_layout
+        self.compact_threshold = compact_threshold
+        self.archive_md5s = {}  # archive_index -> [(offset, count, md5 digest)]
+        # Files with the same md5 are stored once, the directory points every copy at the same bytes
+        self.dedup = dedup
+        self.duplicates = []  # (entry, entry that owns the bytes)
+        self.dedup_bytes = 0
+
+    def blob_key(self, entry):
+        # Same content and the same preload split, so both directory entries can share one chunk offset
+        if not self.dedup or not entry.md5 or not entry.length:
+            return None
+        return entry.md5.lower(), entry.size, entry.preload_size
+
+    def share_blob(self, entry, blobs):
+        """Point entry at an identical entry's bytes if there is one, returns True if it needs no space of its own."""
+        key = self.blob_key(entry)
+        if key is None:
+            return False
+        owner = blobs.get(key)
+        if owner is None:
+            blobs[key] = entry
+            return False
+        # The md5 can come from the hash cache, only bytes that really match get shared
+        if not filecmp.cmp(entry.src_path, owner.src_path, shallow=False):
+            print(f"WARNING: {entry.path} has the same md5 as {owner.path} but different content, "
+                  f"packing it separately (stale hash cache?)")
+            return False
+        entry.archive_index = owner.archive_index
+        entry.offset = owner.offset
+        self.duplicates.append((entry, owner))
+        self.dedup_bytes += entry.length
+        return True
+
+    def iter_layout(self, entries, indices=None, blobs=None):
+        """Assign every entry a chunk and offset in control file order, yields (archive_index, [entry])
+        as soon as a chunk is full, so entries can still be arriving while the first chunks get written.
+
+        Chunks take their archive index from indices in order (0, 1, 2, ... by default).
+        Duplicates of an earlier entry (or of one in blobs, {blob_key: entry}) get its offset and
+        are left out of the chunks.
+        """
+        indices = itertools.count() if indices is None else iter(indices)
+        chunk = []
+        archive_index = next(indices)
+        offset = 0
+        blobs = {} if blobs is None else blobs
+        for entry in entries:
+            entry.size = os.path.getsize(entry.src_path)
+            entry.preload_size = min(entry.preload_size, entry.size)
+            entry.length = entry.size - entry.preload_size
+            if self.share_blob(entry, blobs):
+                continue
+            if offset and offset + entry.length > self.chunk_size:
+                yield archive_index, chunk
+                chunk = []
+                archive_index = next(indices)
+                offset = 0
+            entry.archive_index = archive_index
+            entry.offset = offset
+            offset += entry.length
+            chunk.append(entry)
+        if chunk:
+            yield archive_index, chunk
+
+    def plan_layout(self, entries, indices=None, blobs=None):
+        """{archive_index: [entry]} for all entries at once, see iter_layout."""
+        return dict(self.iter_layout(entries, indices, blobs))
+
+    def plan_stable_layout(self, entries, baseline_dir, baseline_kv=None):
+        """Keep unchanged files at their previous chunk/offset and write everything else to new chunks,
+        filling the indices of chunks that were dropped completely before adding new ones at the end.
+
+        Returns ({archive_index: [entry]} of chunks that need writing, set of reused chunk indices),
+        or None when there's no usable baseline or the old chunks are too fragmented and need a full repack.
+        """
+        if not os.path.exists(baseline_dir):
+            print(f"No previous {os.path.basename(baseline_dir)} found, doing a full pack")
+            return None
+
+        _, old_entries, old_md5s = read_directory(baseline_dir)
+        old = {e.path: e for e in old_entries if e.archive_index != DIR_ARCHIVE_INDEX}
+        old_file_md5s = {}
+        if baseline_kv and os.path.exists(baseline_kv):
+            old_file_md5s = {e.path: e.md5 for e in read_kv_control_file(baseline_kv) if e.md5}
+
+        kept = []
+        added = []
+        for entry in entries:
+            entry.size = os.path.getsize(entry.src_path)
+            prev = old.get(entry.path)
+            if prev is None or prev.size != entry.size:
+                added.append(entry)
+                continue
+            # Trust the md5s from the last .kv.txt.bak, fall back to the CRC in the directory
+            prev_md5 = old_file_md5s.get(entry.path)
+            if prev_md5 and entry.md5:
+                unchanged = prev_md5.lower() == entry.md5.lower()
+            else:
+                unchanged = crc32_file(entry.src_path) == prev.crc
+            if not unchanged:
+                added.append(entry)
+                continue
+
+            entry.preload_size = len(prev.preload_data)
+            entry.preload_data = prev.preload_data
+            entry.crc = prev.crc
+            entry.archive_index = prev.archive_index
+            entry.offset = prev.offset
+            entry.length = prev.length
+            kept.append(entry)
+
+        live_bytes = {}
+        blobs = {}
+        owners = {}
+        for entry in kept:
+            # An empty entry sits at the offset of the file after it but owns no bytes
+            if not entry.length:
+                continue
+            # Paths that already share bytes from an earlier deduplicated pack count once
+            owner = owners.setdefault((entry.archive_index, entry.offset, entry.length, entry.crc), entry)
+            if owner is not entry:
+                self.duplicates.append((entry, owner))
+                self.dedup_bytes += entry.length
+                continue
+            live_bytes[entry.archive_index] = live_bytes.get(entry.archive_index, 0) + entry.length
+            if self.blob_key(entry):
+                blobs.setdefault(self.blob_key(entry), entry)
+
+        total_bytes = 0
+        for archive_index in live_bytes:
+            chunk_path = os.path.join(self.output_dir, chunk_file_name(self.name, archive_index))
+            if not os.path.exists(chunk_path):
+                print(f"Previous chunk {os.path.basename(chunk_path)} is missing, doing a full pack")
+                return None
+            total_bytes += os.path.getsize(chunk_path)
+
+        dead_bytes = total_bytes - sum(live_bytes.values())
+        fragmentation = dead_bytes / total_bytes if total_bytes else 0.0
+        print(f"Stable layout: {len(kept)} unchanged, {len(added)} new/changed, "
+              f"{dead_bytes / (1024*1024):.2f} MB dead space ({fragmentation:.1%})")
+        if fragmentation > self.compact_threshold:
+            print(f"Fragmentation is above {self.compact_threshold:.0%}, compacting with a full pack")
+            return None
+
+        # Reused chunks stay byte-identical, so their md5 fractions carry over
+        for archive_index in live_bytes:
+            if archive_index in old_md5s:
+                self.archive_md5s[archive_index] = old_md5s[archive_index]
+            else:
+                # v1 baselines have no md5 section
+                chunk_path = os.path.join(self.output_dir, chunk_file_name(self.name, archive_index))
+                self.archive_md5s[archive_index] = archive_md5_fractions(chunk_path)
+
+        # Chunk numbers don't keep growing every release, the old files there are overwritten
+        free_indices = (i for i in itertools.count() if i not in live_bytes)
+        # New files that match a kept one just point at its bytes
+        return self.plan_layout(added, free_indices, blobs), set(live_bytes)
+
+    def write_chunk(self, archive_index, chunk_entries):
+        """Stream every entry of one chunk into its _NNN.vpk, computing CRCs and v2 md5 fractions."""
+        chunk_path = os.path.join(self.output_dir, chunk_file_name(self.name, archive_index))
+        fractions = []
+        fraction_md5 = hashlib.md5()
+        fraction_start = 0
+        written = 0
+        buf = bytearray(COPY_BUFFER_SIZE)
+        view = memoryview(buf)
+
+        with open(chunk_path, "wb") as out:
+            for entry in chunk_entries:
+                with open(entry.src_path, "rb", buffering=0) as src:
+                    entry.preload_data = src.read(entry.preload_size)
+                    crc = zlib.crc32(entry.preload_data)
+                    remaining = entry.length
+                    while remaining:
+                        n = src.readinto(view[:min(remaining, len(buf))])
+                        if not n:
+                            raise IOError(f"{entry.src_path} changed size while packing")
+                        remaining -= n
+                        data = view[:n]
+                        crc = zlib.crc32(data, crc)
+                        out.write(data)
+
+                        # Feed the 1 MiB md5 fractions, splitting the buffer on fraction boundaries
+                        pos = 0
+                        while pos < n:
+                            take = min(n - pos, fraction_start + ARCHIVE_MD5_FRACTION - written)
+                            fraction_md5.update(data[pos:pos + take])
+                            pos += take
+                            written += take
+                            if written - fraction_start == ARCHIVE_MD5_FRACTION:
+                                fractions.append((fraction_start, ARCHIVE_MD5_FRACTION, fraction_md5.digest()))
+                                fraction_md5 = hashlib.md5()
+                                fraction_start = written
+                entry.crc = crc
+
+        if written > fraction_start:
+            fractions.append((fraction_start, written - fraction_start, fraction_md5.digest()))
+        self.archive_md5s[archive_index] = fractions
+        return chunk_path, written
+
+    def remove_stale_chunks(self, keep_indices):
+        pattern = re.compile(rf"^{re.escape(self.name)}_(\d{{3}})\.vpk$")
+        for filename in os.listdir(self.output_dir):
+            match = pattern.match(filename)
+            if match and int(match.group(1)) not in keep_indices:
+                os.remove(os.path.join(self.output_dir, filename))
+                print(f"Removed stale chunk {filename}")
+
+    def write_directory(self, entries, private_key=None, public_key=None):
+        """Write the _dir.vpk. private_key/public_key are the DER bytes from the .vdf key files."""
+        tree = build_tree(entries)
+        if self.version == 1:
+            data = HEADER_V1.pack(VPK_SIGNATURE, 1, len(tree)) + tree
+        else:
+            archive_md5_section = b"".join(
+                ARCHIVE_MD5_ENTRY.pack(archive_index, offset, count, digest)
+                for archive_index in sorted(self.archive_md5s)
+                for offset, count, digest in self.archive_md5s[archive_index]
+            )
+            signature_section = b""
+            signature_section_size = 0
+            if private_key:
+                private_key = load_private_key(private_key)
+                # Signature covers everything before it, so size the section up front
+                signature_section_size = 8 + len(public_key) + private_key.key_size // 8
+
+            header = HEADER_V2.pack(VPK_SIGNATURE, 2, len(tree), 0, len(archive_md5_section), 48,
+                                    signature_section_size)
+            tree_md5 = hashlib.md5(tree).digest()
+            archive_md5_section_md5 = hashlib.md5(archive_md5_section).digest()
+            data = header + tree + archive_md5_section + tree_md5 + archive_md5_section_md5
+            data += hashlib.md5(data).digest()
+
+            if private_key:
+                signature = sign_data(data, private_key)
+                signature_section = (struct.pack("<I", len(public_key)) + public_key +
+                                     struct.pack("<I", len(signature)) + signature)
+            data += signature_section
+
+        dir_path = os.path.join(self.output_dir, dir_file_name(self.name))
+        tmp_path = dir_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, dir_path)
+        return dir_path
+
+    def write_and_report(self, archive_index, chunk_entries, on_chunk):
+        chunk_path, written = self.write_chunk(archive_index, chunk_entries)
+        print(f"Wrote {os.path.basename(chunk_path)} ({written / (1024*1024):.2f} MB)")
+        if on_chunk:
+            on_chunk(chunk_path, chunk_entries)
+        return archive_index
+
+    def write(self, entries, private_key=None, public_key=None, baseline_kv=None, on_chunk=None):
+        """Pack entries into the chunks and the _dir.vpk.
+
+        entries can be an iterator that's still being filled (by the build pipeline). Without the
+        stable layout chunks then get written as soon as they're full instead of after the last entry.
+        on_chunk(path, entries) is called for every chunk once it's written with the entries whose
+        bytes went into it, and for the _dir.vpk last with entries None.
+        """
+        if private_key and self.version != 2:
+            raise ValueError("Only VPK version 2 can be signed")
+
+        dir_path = os.path.join(self.output_dir, dir_file_name(self.name))
+        plan = None
+        self.duplicates = []
+        self.dedup_bytes = 0
+        if self.stable_layout:
+            # Reusing old chunks needs every entry before anything can be decided
+            entries = list(entries)
+            plan = self.plan_stable_layout(entries, dir_path, baseline_kv)
+        if plan is None:
+            self.archive_md5s = {}
+            self.duplicates = []
+            self.dedup_bytes = 0
+            all_entries = []
+
+            def collect():
+                for entry in entries:
+                    all_entries.append(entry)
+                    yield entry
+
+            chunks, reused = self.iter_layout(collect()), set()
+            print("Packing files...")
+        else:
+            all_entries = entries
+            planned, reused = plan
+            chunks = planned.items()
+            print(f"Packing {len(entries)} files: writing {len(planned)} chunks, reusing {len(reused)}...")
+
+        # Chunks don't depend on each other so they can be written in parallel
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.write_and_report, archive_index, chunk_entries, on_chunk)
+                       for archive_index, chunk_entries in chunks]
+            written = {future.result() for future in futures}
+
+        # Copies share their owner's CRC and preload bytes, known now that every chunk is written
+        for entry, owner in self.duplicates:
+            entry.crc = owner.crc
+            entry.preload_data = owner.preload_data
+        if self.duplicates:
+            print(f"Deduplicated {len(self.duplicates)} identical files, "
+                  f"saved {self.dedup_bytes / (1024*1024):.2f} MB")
+
+        self.remove_stale_chunks(reused | written)
+        dir_path = self.write_directory(all_entries, private_key, public_key)
+        print(f"Wrote {os.path.basename(dir_path)} ({len(all_entries)} files, {len(written)} chunks written)")
+        if on_chunk:
+            on_chunk(dir_path, None)
+        return dir_path
@@ -0,0 +1,405 @@
+import os
+import sys
+import json
+import lzma
+import struct
+import shutil
+import argparse
+import itertools
+import traceback
+
+import hashing
+import vpk_file
+
+# Delta files: a small header naming the target and every source file it copies from,
+# followed by an xz stream of COPY(source, offset, length) / ADD(data) operations.
+# Matching is VPK aware: every entry of the new chunk is looked up by CRC and size among
+# all entries of the previous release, so assets that moved between chunks on a repack
+# are still copied instead of shipped again. A changed entry is matched rsync style
+# against the old version of the same path, the data between entries against the old
+# file of the same name: the old data is indexed in blocks by a rolling weak checksum
+# that's checked at every byte offset of the new data, and a strong hash confirms a hit,
+# so inserting or removing bytes only costs the bytes around the edit.
+
+DELTA_MAGIC = b"VPKDLT1\0"
+PATCH_MANIFEST_NAME = "patch_manifest.json"
+BLOCK_SIZE = 4 * 1024
+MIN_ENTRY_MATCH = 64  # tiny entries aren't worth a COPY op
+MAX_DELTA_RATIO = 0.9  # ship the full file if the delta doesn't save at least 10%
+
+OP_COPY = b"C"
+OP_ADD = b"A"
+OP_END = b"E"
+COPY_OP = struct.Struct("<HQQ")
+ADD_OP = struct.Struct("<Q")
+
+class SourceIndex:
+    """Everything in the previous release that a new file can copy from."""
+
+    def __init__(self, old_dir, name):
+        self.old_dir = old_dir
+        self.entries = {}  # (crc, preload size, length) -> (file name, offset)
+        self.paths = {}  # path -> (file name, offset, length)
+        self.blocks = {}  # file name -> block index, see index_block
+        self.handles = {}
+
+        dir_path = os.path.join(old_dir, vpk_file.dir_file_name(name))
+        if os.path.exists(dir_path):
+            _, entries, _ = vpk_file.read_directory(dir_path)
+            for entry in entries:
+                if entry.archive_index == vpk_file.DIR_ARCHIVE_INDEX or entry.length < MIN_ENTRY_MATCH:
+                    continue
+                chunk_name = vpk_file.chunk_file_name(name, entry.archive_index)
+                self.entries.setdefault((entry.crc, len(entry.preload_data), entry.length),
+                                        (chunk_name, entry.offset))
+                self.paths[entry.path] = (chunk_name, entry.offset, entry.length)
+
+    def read(self, file_name, offset, length):
+        f = self.handles.get(file_name)
+        if f is None:
+            f = self.handles[file_name] = open(os.path.join(self.old_dir, file_name), "rb")
+        f.seek(offset)
+        return f.read(length)
+
+    def block_index(self, file_name):
+        """Block index of a whole old file, empty if there's no file by that name."""
+        if file_name not in self.blocks:
+            index = {}
+            path = os.path.join(self.old_dir, file_name)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    offset = 0
+                    for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                        index_block(index, block, offset)
+                        offset += len(block)
+            self.blocks[file_name] = index
+        return self.blocks[file_name]
+
+    def entry_source(self, path):
+        """(file name, block index) of the old version of path, None if it wasn't in the previous release."""
+        found = self.paths.get(path)
+        if found is None:
+            return None
+        file_name, offset, length = found
+        data = self.read(file_name, offset, length)
+        index = {}
+        for start in range(0, len(data) - BLOCK_SIZE + 1, BLOCK_SIZE):
+            index_block(index, data[start:start + BLOCK_SIZE], offset + start)
+        return file_name, index
+
+    def close(self):
+        for f in self.handles.values():
+            f.close()
+        self.handles = {}
+
+class DeltaWriter:
+    def __init__(self, out_path, target_size, target_md5):
+        # Ops are compressed into a temp file, the header (which lists the sources) goes in front at the end
+        self.out_path = out_path
+        self.out = open(out_path + ".ops", "wb")
+        self.target_size = target_size
+        self.target_md5 = target_md5
+        self.sources = []
+        self.ops = bytearray()
+        self.pending_copy = None  # [source id, offset, length], merged while contiguous
+        self.compressor = lzma.LZMACompressor(preset=9)
+        self.copied = 0
+        self.added = 0
+
+    def source_id(self, file_name):
+        if file_name not in self.sources:
+            self.sources.append(file_name)
+        return self.sources.index(file_name)
+
+    def _flush_copy(self):
+        if self.pending_copy:
+            self.ops += OP_COPY + COPY_OP.pack(*self.pending_copy)
+            self.pending_copy = None
+        self._drain()
+
+    def _drain(self):
+        if len(self.ops) >= 1024 * 1024:
+            self.out.write(self.compressor.compress(bytes(self.ops)))
+            self.ops = bytearray()
+
+    def copy(self, file_name, offset, length):
+        source = self.source_id(file_name)
+        self.copied += length
+        pending = self.pending_copy
+        if pending and pending[0] == source and pending[1] + pending[2] == offset:
+            pending[2] += length
+            return
+        self._flush_copy()
+        self.pending_copy = [source, offset, length]
+
+    def add(self, data):
+        if not data:
+            return
+        self._flush_copy()
+        self.added += len(data)
+        self.ops += OP_ADD + ADD_OP.pack(len(data)) + data
+        self._drain()
+
+    def finish(self, source_md5s):
+        self._flush_copy()
+        self.ops += OP_END
+        self.out.write(self.compressor.compress(bytes(self.ops)) + self.compressor.flush())
+        self.out.close()
+
+        header = bytearray(DELTA_MAGIC)
+        header += struct.pack("<Q", self.target_size) + bytes.fromhex(self.target_md5)
+        header += struct.pack("<H", len(self.sources))
+        for file_name in self.sources:
+            encoded = file_name.encode("utf-8")
+            header += struct.pack("<H", len(encoded)) + encoded + bytes.fromhex(source_md5s[file_name])
+
+        with open(self.out_path, "wb") as out, open(self.out.name, "rb") as ops:
+            out.write(header)
+            shutil.copyfileobj(ops, out, hashing.DEFAULT_BLOCK_SIZE)
+        os.remove(self.out.name)
+
+def weak_checksum(block):
+    """rsync's rolling checksum of a block as its two 16 bit halves (a, b)."""
+    return sum(block) & 0xFFFF, sum(itertools.accumulate(block)) & 0xFFFF
+
+def strong_hash(block):
+    return hashing.hash_bytes(block, hashing.CACHE_ALGORITHM)
+
+def index_block(index, block, offset):
+    """Add a full block at offset of an old file to index, {weak checksum: {strong hash: offset}}."""
+    if len(block) == BLOCK_SIZE:
+        a, b = weak_checksum(block)
+        index.setdefault(b << 16 | a, {}).setdefault(strong_hash(block), offset)
+
+def diff_region(writer, data, source_name, blocks):
+    """Delta data against the blocks of source_name, trying the block index at every byte offset."""
+    end = len(data)
+    if not blocks or end < BLOCK_SIZE:
+        writer.add(data)
+        return
+    pos = 0
+    literal_start = 0
+    a, b = weak_checksum(data[:BLOCK_SIZE])
+    while True:
+        candidates = blocks.get(b << 16 | a)
+        if candidates:
+            offset = candidates.get(strong_hash(data[pos:pos + BLOCK_SIZE]))
+            if offset is not None:
+                writer.add(data[literal_start:pos])
+                writer.copy(source_name, offset, BLOCK_SIZE)
+                pos += BLOCK_SIZE
+                literal_start = pos
+                if pos + BLOCK_SIZE > end:
+                    break
+                a, b = weak_checksum(data[pos:pos + BLOCK_SIZE])
+                continue
+        if pos + BLOCK_SIZE >= end:
+            break
+        # Slide the window one byte
+        out_byte = data[pos]
+        a = (a - out_byte + data[pos + BLOCK_SIZE]) & 0xFFFF
+        b = (b - BLOCK_SIZE * out_byte + a) & 0xFFFF
+        pos += 1
+    writer.add(data[literal_start:])
+
+def generate_delta(target_path, target_md5, target_entries, index, out_path):
+    """Delta target_path against the previous release, call finish() on the returned writer to write it out."""
+    target_name = os.path.basename(target_path)
+    target_size = os.path.getsize(target_path)
+    writer = DeltaWriter(out_path, target_size, target_md5)
+
+    with open(target_path, "rb") as target:
+        pos = 0
+        for entry in sorted(target_entries, key=lambda e: e.offset):
+            if entry.offset < pos or entry.length == 0:
+                continue  # shared/deduplicated data was already emitted
+            diff_region(writer, target.read(entry.offset - pos), target_name, index.block_index(target_name))
+
+            match = index.entries.get((entry.crc, len(entry.preload_data), entry.length))
+            data = target.read(entry.length)
+            # CRC32 + size only picks the candidate, the bytes decide
+            if match and index.read(match[0], match[1], entry.length) == data:
+                writer.copy(match[0], match[1], entry.length)
+            else:
+                source = index.entry_source(entry.path)
+                if source is None:
+                    source = target_name, index.block_index(target_name)
+                diff_region(writer, data, *source)
+            pos = entry.offset + entry.length
+        diff_region(writer, target.read(), target_name, index.block_index(target_name))
+
+    return writer
+
+def generate_patches(old_dir, new_dir, out_dir, name="pak01"):
+    os.makedirs(out_dir, exist_ok=True)
+    old_files = sorted(f for f in os.listdir(old_dir) if f.endswith(".vpk"))
+    new_files = sorted(f for f in os.listdir(new_dir) if f.endswith(".vpk"))
+
+    print(f"Hashing {len(old_files)} old and {len(new_files)} new VPK files...")
+    old_md5s = dict(zip(old_files, hashing.hash_files([os.path.join(old_dir, f) for f in old_files])))
+    new_md5s = dict(zip(new_files, hashing.hash_files([os.path.join(new_dir, f) for f in new_files])))
+
+    # Entries of every new chunk, from the new directory file
+    new_entries = {}
+    new_dir_path = os.path.join(new_dir, vpk_file.dir_file_name(name))
+    if os.path.exists(new_dir_path):
+        _, entries, _ = vpk_file.read_directory(new_dir_path)
+        for entry in entries:
+            if entry.archive_index != vpk_file.DIR_ARCHIVE_INDEX:
+                new_entries.setdefault(vpk_file.chunk_file_name(name, entry.archive_index), []).append(entry)
+
+    index = SourceIndex(old_dir, name)
+    patches = {}
+    try:
+        for filename in new_files:
+            if old_md5s.get(filename) == new_md5s[filename]:
+                continue
+
+            target_path = os.path.join(new_dir, filename)
+            delta_path = os.path.join(out_dir, filename + ".delta")
+            print(f"Generating delta for {filename}...")
+            writer = generate_delta(target_path, new_md5s[filename], new_entries.get(filename, []), index, delta_path)
+            writer.finish(old_md5s)
+
+            target_size = os.path.getsize(target_path)
+            delta_size = os.path.getsize(delta_path)
+            print(f"  {writer.copied / (1024*1024):.2f} MB copied, {writer.added / (1024*1024):.2f} MB new, "
+                  f"delta {delta_size / (1024*1024):.2f} MB of {target_size / (1024*1024):.2f} MB")
+
+            if delta_size > target_size * MAX_DELTA_RATIO:
+                print(f"  Delta isn't worth it for {filename}, clients get the full file")
+                os.remove(delta_path)
+                patches[filename] = {"target_md5": new_md5s[filename], "target_size": target_size, "delta": None}
+                continue
+
+            patches[filename] = {
+                "target_md5": new_md5s[filename],
+                "target_size": target_size,
+                "delta": os.path.basename(delta_path),
+                "delta_md5": hashing.hash_file(delta_path, "md5"),
+                "delta_size": delta_size,
+                "sources": {source: old_md5s[source] for source in writer.sources},
+            }
+    finally:
+        index.close()
+
+    manifest = {
+        "version": 1,
+        "removed": sorted(set(old_files) - set(new_files)),
+        "files": patches,
+    }
+    manifest_path = os.path.join(out_dir, PATCH_MANIFEST_NAME)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    print(f"Wrote {manifest_path} ({len(patches)} changed files)")
+    return manifest
+
+def read_delta_header(f):
+    if f.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise ValueError("Not a VPK delta file")
+    target_size, = struct.unpack("<Q", f.read(8))
+    target_md5 = f.read(16).hex()
+    count, = struct.unpack("<H", f.read(2))
+    sources = []
+    for _ in range(count):
+        length, = struct.unpack("<H", f.read(2))
+        sources.append((f.read(length).decode("utf-8"), f.read(16).hex()))
+    return target_size, target_md5, sources
+
+class _OpReader:
+    """Reads exact byte counts out of the decompressed op stream."""
+
+    def __init__(self, f):
+        self.f = f
+        self.decompressor = lzma.LZMADecompressor()
+        self.buffer = bytearray()
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            if self.decompressor.eof:
+                raise ValueError("Truncated delta file")
+            chunk = self.f.read(1024 * 1024)
+            if not chunk and self.decompressor.needs_input:
+                raise ValueError("Truncated delta file")
+            self.buffer += self.decompressor.decompress(chunk, max_length=16 * 1024 * 1024)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+def apply_delta(delta_path, source_dir, out_path, verified_sources=None):
+    """Rebuild a file from delta_path and the files in source_dir.
+
+    Source md5s are checked first (verified_sources caches results across calls) and the
+    output is hashed while it's written. Raises ValueError on any hash mismatch.
+    """
+    verified_sources = {} if verified_sources is None else verified_sources
+    with open(delta_path, "rb") as f:
+        target_size, target_md5, sources = read_delta_header(f)
+
+        for name, md5 in sources:
+            if name not in verified_sources:
+                verified_sources[name] = hashing.hash_file(os.path.join(source_dir, name), "md5")
+            if verified_sources[name] != md5:
+                raise ValueError(f"{name} doesn't match the version this patch was made from")
+
+        handles = [open(os.path.join(source_dir, name), "rb") for name, _ in sources]
+        hasher = hashing.new_hasher("md5")
+        written = 0
+        try:
+            ops = _OpReader(f)
+            with open(out_path, "wb") as out:
+                while True:
+                    op = ops.read(1)
+                    if op == OP_END:
+                        break
+                    if op == OP_COPY:
+                        source, offset, length = COPY_OP.unpack(ops.read(COPY_OP.size))
+                        src = handles[source]
+                        src.seek(offset)
+                        while length:
+                            data = src.read(min(length, hashing.DEFAULT_BLOCK_SIZE))
+                            if not data:
+                                raise ValueError(f"{sources[source][0]} is shorter than the patch expects")
+                            hasher.update(data)
+                            out.write(data)
+                            written += len(data)
+                            length -= len(data)
+                    elif op == OP_ADD:
+                        length, = ADD_OP.unpack(ops.read(ADD_OP.size))
+                        data = ops.read(length)
+                        hasher.update(data)
+                        out.write(data)
+                        written += len(data)
+                    else:
+                        raise ValueError(f"Corrupt delta file {delta_path}")
+        except BaseException:
+            # Don't leave a half written file behind for the caller to mistake for a patched one
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            raise
+        finally:
+            for handle in handles:
+                handle.close()
+
+    if written != target_size or hasher.hexdigest() != target_md5:
+        os.remove(out_path)
+        raise ValueError(f"Patched file doesn't match the expected hash ({delta_path})")
+    return target_md5
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate binary delta patches between two VPK releases')
+    parser.add_argument('old_dir', help='Directory with the previous release VPK files')
+    parser.add_argument('new_dir', help='Directory with the new release VPK files')
+    parser.add_argument('out_dir', help=f'Directory for the .delta files and {PATCH_MANIFEST_NAME}')
+    parser.add_argument('--name', default="pak01", help='VPK name (default: pak01)')
+    args = parser.parse_args()
+
+    try:
+        generate_patches(args.old_dir, args.new_dir, args.out_dir, args.name)
+    except Exception:
+        print(traceback.format_exc())
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+python vpk_verify.py
+pause
\ No newline at end of file
@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import mmap
+import zlib
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import vpk_file
+
+# Checks every entry of a VPK against the CRC32 stored for it in the _dir.vpk tree.
+# Chunks are mmapped and zlib.crc32 releases the GIL, so chunks are checked on threads.
+
+def open_chunk(path):
+    """mmap a chunk read-only, returns None for a missing or empty file."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def check_chunk(chunk_path, entries, base_offset=0):
+    """Returns [(entry, problem)] for the entries of one chunk that fail their CRC."""
+    data = open_chunk(chunk_path)
+    if data is None:
+        return [(entry, "missing chunk") for entry in entries]
+
+    bad = []
+    try:
+        # Released even if a check raises, the mmap can't be closed while a view pins it
+        with memoryview(data) as view:
+            for entry in entries:
+                start = base_offset + entry.offset
+                end = start + entry.length
+                if end > len(data):
+                    bad.append((entry, "truncated"))
+                    continue
+                with view[start:end] as part:
+                    crc = zlib.crc32(part, zlib.crc32(entry.preload_data))
+                if crc != entry.crc:
+                    bad.append((entry, f"crc {crc:08x} != {entry.crc:08x}"))
+    finally:
+        data.close()
+    return bad
+
+def verify_vpk(vpk_dir, name="pak01", workers=None):
+    """Check every entry of vpk_dir/{name}_dir.vpk, returns (entry count, [(entry, problem)])."""
+    dir_path = os.path.join(vpk_dir, vpk_file.dir_file_name(name))
+    _, entries, _ = vpk_file.read_directory(dir_path)
+
+    by_chunk = {}
+    for entry in entries:
+        by_chunk.setdefault(entry.archive_index, []).append(entry)
+
+    jobs = []
+    for archive_index, chunk_entries in sorted(by_chunk.items()):
+        if archive_index == vpk_file.DIR_ARCHIVE_INDEX:
+            jobs.append((dir_path, chunk_entries, vpk_file.dir_data_offset(dir_path)))
+        else:
+            jobs.append((os.path.join(vpk_dir, vpk_file.chunk_file_name(name, archive_index)), chunk_entries, 0))
+
+    workers = workers or min(32, (os.cpu_count() or 1) * 2)
+    bad = []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs) or 1))) as executor:
+        for chunk_bad in executor.map(lambda job: check_chunk(*job), jobs):
+            bad.extend(chunk_bad)
+    bad.sort(key=lambda item: (item[0].archive_index, item[0].offset))
+    return len(entries), bad
+
+def repair_entries(vpk_dir, name, bad, source_dir):
+    """Write known good copies of corrupt entries from source_dir back into their chunks.
+
+    Only files whose CRC matches the directory tree are written, returns the repaired paths.
+    """
+    dir_path = os.path.join(vpk_dir, vpk_file.dir_file_name(name))
+    repaired = []
+    for entry, problem in bad:
+        if problem == "missing chunk":
+            continue
+        src_path = os.path.join(source_dir, *entry.path.split("/"))
+        if not os.path.exists(src_path) or os.path.getsize(src_path) != entry.preload_size + entry.length:
+            continue
+        with open(src_path, "rb") as f:
+            data = f.read()
+        if zlib.crc32(data) != entry.crc:
+            continue
+
+        if entry.archive_index == vpk_file.DIR_ARCHIVE_INDEX:
+            chunk_path, offset = dir_path, vpk_file.dir_data_offset(dir_path) + entry.offset
+        else:
+            chunk_path, offset = os.path.join(vpk_dir, vpk_file.chunk_file_name(name, entry.archive_index)), entry.offset
+        with open(chunk_path, "r+b") as f:
+            f.seek(offset)
+            f.write(data[entry.preload_size:])
+        repaired.append(entry.path)
+    return repaired
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify every file in a VPK against the CRCs in its directory tree')
+    parser.add_argument('vpk_dir', nargs='?', default=".", help='Directory with the VPK files (default: current directory)')
+    parser.add_argument('--name', default="pak01", help='VPK name (default: pak01)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Chunks checked in parallel (default: 2x CPU count, max 32)')
+    parser.add_argument('--repair-from', metavar='ASSET_DIR',
+                        help='Loose asset folder (e.g. pak01) to copy good versions of corrupt files from')
+    parser.add_argument('--report', metavar='FILE', help='Write the corrupt entries to a JSON file')
+    args = parser.parse_args()
+
+    try:
+        print(f"Verifying {vpk_file.dir_file_name(args.name)} in {os.path.abspath(args.vpk_dir)}...")
+        total, bad = verify_vpk(args.vpk_dir, args.name, args.workers)
+    except Exception:
+        print(traceback.format_exc())
+        sys.exit(1)
+
+    for entry, problem in bad:
+        print(f"  {entry.path} (archive {entry.archive_index}, offset {entry.offset}): {problem}")
+    print(f"Checked {total} files, {len(bad)} corrupt")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump([{"path": entry.path, "archive_index": entry.archive_index, "offset": entry.offset,
+                        "length": entry.length, "problem": problem} for entry, problem in bad], f, indent=2)
+        print(f"Wrote {args.report}")
+
+    if bad and args.repair_from:
+        repaired = repair_entries(args.vpk_dir, args.name, bad, args.repair_from)
+        print(f"Repaired {len(repaired)} of {len(bad)} corrupt files from {args.repair_from}")
+        if len(repaired) == len(bad):
+            return
+    if bad:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()